@@ -0,0 +1,364 @@
+"""
+Benchmarks of the parser, the matchers and the runners.
+
+```
+python -m dsl.bench                      # table
+python -m dsl.bench --quick --json out.json
+python -m dsl.bench --compare old.json   # ratios against a previous run
+python -m dsl.bench --filter closure
+```
+
+Rules are generated with increasing size (clauses, nesting depth, elseif
+count, `in` list size, regex count) and evaluated against a synthetic SQL
+corpus. Every benchmark reports ops/sec, latency percentiles and the memory
+allocated per operation (tracemalloc, measured in a separate run).
+"""
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+import typing
+
+from . import expression
+from .cache import RuleCache
+from .parser import ConditionParser
+from .ruleset import RuleSet
+from .runner.mysql import MysqlDSL
+from .runner.script import split_statements
+from .runner.sqlscan import statement_type
+
+__all__ = ('make_condition', 'make_grammar', 'make_corpus', 'Benchmark', 'run')
+
+SQL_TYPES = ['select', 'update', 'delete', 'insert', 'replace', 'create', 'alter', 'drop']
+TABLES = ['orders', 'users', 'payments', 'audit_log', 'ops_tasks', 'tmp_import']
+
+
+def make_condition(
+    rng: random.Random, clauses: int, depth: int, in_size: int, regexes: int
+) -> str:
+    """
+    Args:
+        clauses (int): clauses of the condition
+        depth (int): nesting depth of the parentheses
+        in_size (int): values of the `in` lists
+        regexes (int): `matchs` clauses among clauses
+    """
+    values = ', '.join(f'"{value}"' for value in (SQL_TYPES * in_size)[:in_size])
+    # every clause ends with a literal, TreeMatcher does not support a factor before `)`
+    simple = [
+        '@fac.sql_type == "{}"'.format(rng.choice(SQL_TYPES)),
+        '@fun.char_length < {}'.format(rng.randint(10, 5000)),
+        f'@fac.sql_type in [{values}]',
+        f'@fac.sql_type not in [{values}]',
+        '@fac.is_admin_user == true',
+    ]
+    items = []
+    for idx in range(clauses):
+        if idx < regexes:
+            items.append('@fac.sql_type matchs "^{}"'.format(rng.choice(SQL_TYPES)[:3]))
+        else:
+            items.append(rng.choice(simple))
+    rng.shuffle(items)
+    operators = [rng.choice((' and ', ' or ')) for _ in items[1:]]
+    condition = items[0]
+    for level, (operator, item) in enumerate(zip(operators, items[1:])):
+        if level < depth:
+            condition = f'({condition}){operator}{item}'
+        else:
+            condition = f'{condition}{operator}{item}'
+    return condition
+
+
+def make_grammar(
+    clauses: int = 2,
+    depth: int = 0,
+    elseifs: int = 0,
+    in_size: int = 2,
+    regexes: int = 0,
+    seed: int = 0,
+) -> str:
+    rng = random.Random(seed)
+    lines = ['if']
+    for idx in range(elseifs + 1):
+        if idx:
+            lines.append('elseif')
+        lines.append(make_condition(rng, clauses, depth, in_size, regexes))
+        lines.append('then')
+        lines.append(f'@act.reject_execute rule {idx}')
+    lines.extend(['else', '@act.allow_execute', 'end'])
+    return '\n'.join(lines)
+
+
+def make_corpus(size: int = 1000, seed: int = 0) -> typing.List[str]:
+    """synthetic MySQL statements, with comments and long statements"""
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        table = rng.choice(TABLES)
+        kind = rng.choice(SQL_TYPES[:5])
+        if kind == 'select':
+            text = f'SELECT id, name FROM {table} WHERE id = {rng.randint(1, 10**6)} LIMIT 100'
+        elif kind == 'update':
+            text = f"UPDATE {table} SET status = 'done' WHERE id = {rng.randint(1, 10**6)}"
+        elif kind == 'delete':
+            text = f'DELETE FROM {table} WHERE created_at < NOW() - INTERVAL 30 DAY'
+        elif kind == 'insert':
+            rows = ', '.join(f"({idx}, 'name{idx}')" for idx in range(rng.randint(1, 50)))
+            text = f'INSERT INTO {table} (id, name) VALUES {rows}'
+        else:
+            text = f'REPLACE INTO {table} SELECT * FROM tmp_import'
+        if rng.random() < 0.2:
+            text = f'/* app:{rng.randint(1, 9)} */ {text}'
+        corpus.append(text)
+    return corpus
+
+
+class Benchmark(typing.NamedTuple):
+    name: str
+    group: str
+    params: dict
+    # called once per operation with the operation index
+    function: typing.Callable[[int], typing.Any]
+
+
+def _percentile(sorted_values: typing.Sequence[float], fraction: float) -> float:
+    idx = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[idx]
+
+
+def measure(benchmark: Benchmark, iterations: int, alloc_iterations: int) -> dict:
+    function = benchmark.function
+    # warm up, fills the caches of the measured code
+    for idx in range(min(iterations, 10)):
+        function(idx)
+    gc.collect()
+    latencies = []
+    clock = time.perf_counter_ns
+    start = clock()
+    for idx in range(iterations):
+        begin = clock()
+        function(idx)
+        latencies.append(clock() - begin)
+    total = (clock() - start) / 1e9
+    latencies.sort()
+
+    tracemalloc.start()
+    try:
+        peak = 0
+        current_start = tracemalloc.get_traced_memory()[0]
+        for idx in range(alloc_iterations):
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            function(idx)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+        retained = tracemalloc.get_traced_memory()[0] - current_start
+    finally:
+        tracemalloc.stop()
+    return {
+        'name': benchmark.name,
+        'group': benchmark.group,
+        'params': benchmark.params,
+        'iterations': iterations,
+        'ops_per_sec': iterations / total if total else 0.0,
+        'mean_us': sum(latencies) / len(latencies) / 1e3,
+        'p50_us': _percentile(latencies, 0.50) / 1e3,
+        'p90_us': _percentile(latencies, 0.90) / 1e3,
+        'p99_us': _percentile(latencies, 0.99) / 1e3,
+        'max_us': latencies[-1] / 1e3,
+        # largest memory allocated during one operation
+        'peak_bytes_per_op': peak,
+        # memory still allocated after the operations, e.g. caches
+        'retained_bytes_per_op': retained / alloc_iterations if alloc_iterations else 0,
+    }
+
+
+# (name, options of make_grammar), rules of increasing size
+SIZES = [
+    ('small', {'clauses': 2}),
+    ('clauses', {'clauses': 16}),
+    ('depth', {'clauses': 8, 'depth': 6}),
+    ('elseif', {'clauses': 3, 'elseifs': 20}),
+    ('in_list', {'clauses': 3, 'in_size': 200}),
+    ('regex', {'clauses': 8, 'regexes': 6}),
+]
+
+
+def benchmarks(corpus: typing.List[str]) -> typing.List[Benchmark]:
+    size = len(corpus)
+    items = []
+    for label, options in SIZES:
+        grammar = make_grammar(**options)
+        conditions = [
+            branch[0]
+            for branch in ConditionParser(grammar).parsed_string_list
+            if branch[0] is not True
+        ]
+        rule = MysqlDSL.compile(grammar)
+        items.extend(
+            [
+                Benchmark(
+                    f'parse_grammar[{label}]',
+                    'parser',
+                    options,
+                    lambda idx, grammar=grammar: ConditionParser(grammar).parse_string(),
+                ),
+                Benchmark(
+                    f'parse_expression[{label}]',
+                    'parser',
+                    options,
+                    lambda idx, conditions=conditions: [
+                        expression.parse(condition) for condition in conditions
+                    ],
+                ),
+                Benchmark(
+                    f'compile[{label}]',
+                    'parser',
+                    options,
+                    lambda idx, grammar=grammar: RuleCache(maxsize=0).get_or_compile(
+                        MysqlDSL, grammar
+                    ),
+                ),
+                Benchmark(
+                    f'tree_match[{label}]',
+                    'matcher',
+                    options,
+                    lambda idx, grammar=grammar: MysqlDSL(
+                        grammar, corpus[idx % size]
+                    ).match_tree(),
+                ),
+                Benchmark(
+                    f'closure_evaluate[{label}]',
+                    'matcher',
+                    options,
+                    lambda idx, rule=rule: rule.evaluate(corpus[idx % size]),
+                ),
+            ]
+        )
+    rule_set = RuleSet(
+        {
+            f'rule{idx}': MysqlDSL.compile(make_grammar(clauses=4, regexes=1, seed=idx))
+            for idx in range(50)
+        },
+        mode='all',
+    )
+    items.append(
+        Benchmark(
+            'rule_set_evaluate[50 rules]',
+            'matcher',
+            {'rules': 50},
+            lambda idx: rule_set.evaluate(corpus[idx % size]),
+        )
+    )
+    script = ';\n'.join(corpus[:200]) + ';\n'
+    items.extend(
+        [
+            Benchmark(
+                'statement_type',
+                'runner',
+                {},
+                lambda idx: statement_type(corpus[idx % size]),
+            ),
+            Benchmark(
+                'split_script[200 statements]',
+                'runner',
+                {'statements': 200},
+                lambda idx: sum(1 for _ in split_statements(script)),
+            ),
+        ]
+    )
+    return items
+
+
+def run(
+    iterations: int = 2000,
+    alloc_iterations: int = 200,
+    corpus_size: int = 1000,
+    name_filter: typing.Optional[str] = None,
+) -> dict:
+    """
+    Returns:
+        dict: {'meta': {...}, 'results': [{'name': ..., 'ops_per_sec': ..., ...}]}
+    """
+    corpus = make_corpus(corpus_size)
+    results = []
+    for benchmark in benchmarks(corpus):
+        if name_filter and name_filter not in benchmark.name:
+            continue
+        results.append(measure(benchmark, iterations, alloc_iterations))
+    return {
+        'meta': {
+            'python': sys.version.split()[0],
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'iterations': iterations,
+            'alloc_iterations': alloc_iterations,
+            'corpus_size': corpus_size,
+        },
+        'results': results,
+    }
+
+
+def compare(report: dict, baseline: dict) -> typing.Dict[str, float]:
+    """{benchmark name: ops/sec in report / ops/sec in baseline}, benchmarks of both only"""
+    previous = {item['name']: item for item in baseline['results']}
+    ratios = {}
+    for item in report['results']:
+        base = previous.get(item['name'])
+        if base and base['ops_per_sec']:
+            ratios[item['name']] = item['ops_per_sec'] / base['ops_per_sec']
+    return ratios
+
+
+def format_table(report: dict, baseline: typing.Optional[dict] = None) -> str:
+    ratios = compare(report, baseline) if baseline else {}
+    header = f'{"benchmark":<34}{"ops/sec":>12}{"p50 us":>10}{"p99 us":>10}{"peak B":>10}'
+    if baseline:
+        header += f'{"vs base":>10}'
+    lines = [header, '-' * len(header)]
+    for item in report['results']:
+        line = (
+            f'{item["name"]:<34}{item["ops_per_sec"]:>12.0f}{item["p50_us"]:>10.1f}'
+            f'{item["p99_us"]:>10.1f}{item["peak_bytes_per_op"]:>10}'
+        )
+        if item['name'] in ratios:
+            line += f'{ratios[item["name"]]:>9.2f}x'
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main(argv: typing.Optional[typing.Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m dsl.bench', description=__doc__.split('\n\n')[0])
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--alloc-iterations', type=int, default=200)
+    parser.add_argument('--corpus-size', type=int, default=1000)
+    parser.add_argument('--quick', action='store_true', help='200 iterations, for smoke runs')
+    parser.add_argument('--filter', help='only the benchmarks whose name contains FILTER')
+    parser.add_argument('--json', help='write the results as json to JSON, - for stdout')
+    parser.add_argument('--compare', help='json of a previous run, ops/sec ratios in the table or json')
+    args = parser.parse_args(argv)
+    iterations, alloc_iterations = args.iterations, args.alloc_iterations
+    if args.quick:
+        iterations, alloc_iterations = 200, 20
+    report = run(iterations, alloc_iterations, args.corpus_size, args.filter)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        report['comparison'] = compare(report, baseline)
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        print(format_table(report, baseline))
+        if args.json:
+            with open(args.json, 'w') as file:
+                json.dump(report, file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
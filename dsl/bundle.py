@@ -0,0 +1,315 @@
+"""
+Precompiled rule bundles.
+
+A build step writes the parsed rules once:
+
+```
+write_bundle('rules.bundle', {'no_delete': MysqlDSL.compile(grammar), ...})
+```
+
+and a worker loads them without parsing any grammar:
+
+```
+bundle = RuleBundle.load('rules.bundle')
+rule = bundle['no_delete']   # materialized on first use
+```
+
+Layout: MAGIC, then the header length and the sha256 of the header, then the
+header (json: format version, one entry per rule with its dsl type_, dsl
+class, factor references, offset, length and sha256 of its payload), then
+the payloads (json: grammar, branches and expression trees). Loading only
+reads and checks the header; a payload is checked and compiled when its rule
+is first used.
+"""
+import hashlib
+import importlib
+import json
+import os
+import struct
+import typing
+
+from . import compiler, exceptions, expression
+from .expression import And, Compare, Literal, Membership, Node, Or, Ref
+from .parser import ConditionParser
+from .rule import CompiledRule
+
+__all__ = (
+    'FORMAT_VERSION',
+    'BundleError',
+    'RuleBundle',
+    'factor_refs',
+    'dump_bundle',
+    'write_bundle',
+)
+
+MAGIC = b'RULEDSL\0'
+FORMAT_VERSION = 1
+# header length, sha256 of the header
+_PREFIX = struct.Struct('>I32s')
+# fields written by dump_bundle
+_HEADER_KEYS = frozenset(['version', 'rules'])
+_ENTRY_KEYS = frozenset(
+    ['name', 'type', 'dsl_class', 'digest', 'factors', 'offset', 'length', 'sha256']
+)
+_PAYLOAD_KEYS = frozenset(['grammar', 'branches', 'nodes', 'backend', 'reorder', 'options'])
+
+
+class BundleError(exceptions.DSLError):
+    pass
+
+
+def _encode_node(node: typing.Optional[Node]) -> typing.Any:
+    if node is None:
+        return None
+    if isinstance(node, Literal):
+        return ['L', node.value, node.source]
+    if isinstance(node, Ref):
+        return ['R', node.kind, node.name, [_encode_node(arg) for arg in node.args], node.source]
+    if isinstance(node, Compare):
+        return ['C', node.op, _encode_node(node.left), _encode_node(node.right)]
+    if isinstance(node, Membership):
+        return ['M', node.negate, _encode_node(node.left), _encode_node(node.right)]
+    if isinstance(node, And):
+        return ['A', [_encode_node(item) for item in node.operands]]
+    return ['O', [_encode_node(item) for item in node.operands]]
+
+
+def _decode_node(data: typing.Any) -> typing.Optional[Node]:
+    if data is None:
+        return None
+    tag = data[0]
+    if tag == 'L':
+        return Literal(data[1], data[2])
+    if tag == 'R':
+        return Ref(data[1], data[2], tuple(_decode_node(arg) for arg in data[3]), data[4])
+    if tag == 'C':
+        return Compare(data[1], _decode_node(data[2]), _decode_node(data[3]))
+    if tag == 'M':
+        return Membership(data[1], _decode_node(data[2]), _decode_node(data[3]))
+    if tag == 'A':
+        return And(tuple(_decode_node(item) for item in data[1]))
+    if tag == 'O':
+        return Or(tuple(_decode_node(item) for item in data[1]))
+    raise BundleError(f'unknown expression node {tag!r}')
+
+
+def factor_refs(rule: CompiledRule) -> typing.List[str]:
+    """['@fac.sql_type', '@act.allow_execute'], factors used by the rule"""
+    refs = []
+    for idx, (condition_str, then_str) in enumerate(rule.branches):
+        if condition_str is not True:
+            node = rule.nodes[idx] if rule.nodes is not None else expression.parse(condition_str)
+            refs.extend(item for item in expression.walk(node) if isinstance(item, Ref))
+        refs.extend(compiler.action_refs(then_str))
+    return sorted({f'@{ref.kind}.{ref.name}' for ref in refs})
+
+
+def _load_json(data: bytes, keys: frozenset, what: str) -> dict:
+    """
+    Raises:
+        BundleError: data is not a json object holding keys
+    """
+    try:
+        value = json.loads(data)
+    except ValueError as err:
+        raise BundleError(f'invalid {what}: {err}') from err
+    _check_keys(value, keys, what)
+    return value
+
+
+def _check_keys(value: typing.Any, keys: frozenset, what: str) -> None:
+    if not isinstance(value, dict):
+        raise BundleError(f'invalid {what}: not an object')
+    missing = keys.difference(value)
+    if missing:
+        raise BundleError(f'invalid {what}: missing {", ".join(sorted(missing))}')
+
+
+def _class_path(dsl_class: type) -> str:
+    return f'{dsl_class.__module__}:{dsl_class.__qualname__}'
+
+
+def dump_bundle(rules: typing.Mapping[str, CompiledRule]) -> bytes:
+    """
+    Args:
+        rules (Mapping[str, CompiledRule]): {name: rule}, options must be json serializable
+
+    Returns:
+        bytes: bundle content
+    """
+    entries = []
+    payloads = []
+    offset = 0
+    for name, rule in rules.items():
+        if rule.parser is not ConditionParser:
+            raise BundleError(f'{name}: only rules of the default parser can be bundled')
+        try:
+            payload = json.dumps(
+                {
+                    'grammar': rule.grammar,
+                    'branches': [list(branch) for branch in rule.branches],
+                    'nodes': [_encode_node(node) for node in rule.nodes]
+                    if rule.nodes is not None
+                    else None,
+                    'backend': rule.backend,
+                    'reorder': rule.reorder,
+                    'options': rule.options,
+                },
+                ensure_ascii=False,
+            ).encode('utf-8')
+        except (TypeError, ValueError) as err:
+            raise BundleError(f'{name}: {err}') from err
+        entries.append(
+            {
+                'name': name,
+                'type': rule.type_,
+                'dsl_class': _class_path(rule.dsl_class),
+                'digest': rule.digest,
+                'factors': factor_refs(rule),
+                'offset': offset,
+                'length': len(payload),
+                'sha256': hashlib.sha256(payload).hexdigest(),
+            }
+        )
+        payloads.append(payload)
+        offset += len(payload)
+    header = json.dumps(
+        {'version': FORMAT_VERSION, 'rules': entries}, ensure_ascii=False
+    ).encode('utf-8')
+    return b''.join(
+        [MAGIC, _PREFIX.pack(len(header), hashlib.sha256(header).digest()), header, *payloads]
+    )
+
+
+def write_bundle(
+    path: typing.Union[str, os.PathLike], rules: typing.Mapping[str, CompiledRule]
+) -> None:
+    """write dump_bundle(rules) to path, atomically"""
+    data = dump_bundle(rules)
+    tmp_path = f'{os.fspath(path)}.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+
+def _import_class(path: str) -> type:
+    module_name, _, qualname = path.partition(':')
+    target = importlib.import_module(module_name)
+    for attr in qualname.split('.'):
+        target = getattr(target, attr)
+    return target
+
+
+class RuleBundle:
+    """
+    Rules of a bundle, by name. A rule is compiled on first access.
+
+    Args:
+        data (bytes): bundle content
+        dsl_classes (Mapping[str, type]): {type_: dsl class}, dsl classes
+            not given are imported from the module recorded in the bundle
+    """
+
+    def __init__(
+        self,
+        data: typing.Union[bytes, memoryview],
+        dsl_classes: typing.Optional[typing.Mapping[str, type]] = None,
+    ):
+        data = memoryview(data)
+        if bytes(data[: len(MAGIC)]) != MAGIC:
+            raise BundleError('not a rule bundle')
+        start = len(MAGIC) + _PREFIX.size
+        try:
+            header_size, header_sha = _PREFIX.unpack(data[len(MAGIC) : start])
+        except struct.error as err:
+            raise BundleError('truncated rule bundle') from err
+        header = data[start : start + header_size]
+        if hashlib.sha256(header).digest() != header_sha:
+            raise BundleError('rule bundle header checksum mismatch')
+        header = _load_json(bytes(header), _HEADER_KEYS, 'rule bundle header')
+        if header['version'] != FORMAT_VERSION:
+            raise BundleError(
+                f'rule bundle version {header["version"]}, expected {FORMAT_VERSION}'
+            )
+        if not isinstance(header['rules'], list):
+            raise BundleError('invalid rule bundle header: rules is not a list')
+        for entry in header['rules']:
+            _check_keys(entry, _ENTRY_KEYS, 'rule bundle entry')
+        self.version = header['version']
+        self.entries = {entry['name']: entry for entry in header['rules']}
+        self.dsl_classes = dict(dsl_classes or {})
+        self._data = data
+        self._payload_start = start + header_size
+        self._rules = {}
+
+    @classmethod
+    def load(
+        cls,
+        path: typing.Union[str, os.PathLike],
+        dsl_classes: typing.Optional[typing.Mapping[str, type]] = None,
+    ) -> 'RuleBundle':
+        with open(path, 'rb') as file:
+            return cls(file.read(), dsl_classes)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self) -> typing.Iterator[str]:
+        return iter(self.entries)
+
+    def __contains__(self, name) -> bool:
+        return name in self.entries
+
+    def __getitem__(self, name) -> CompiledRule:
+        rule = self._rules.get(name)
+        if rule is None:
+            rule = self._rules[name] = self._materialize(self.entries[name])
+        return rule
+
+    def get(self, name, default=None) -> typing.Optional[CompiledRule]:
+        if name not in self.entries:
+            return default
+        return self[name]
+
+    @property
+    def materialized(self) -> typing.List[str]:
+        """names of the rules compiled so far"""
+        return list(self._rules)
+
+    def dsl_class(self, entry: dict) -> type:
+        dsl_class = self.dsl_classes.get(entry['type'])
+        if dsl_class is None:
+            dsl_class = self.dsl_classes[entry['type']] = _import_class(entry['dsl_class'])
+        return dsl_class
+
+    def missing_factors(self, name) -> typing.List[str]:
+        """factor references of the rule its dsl class does not define"""
+        entry = self.entries[name]
+        dsl_class = self.dsl_class(entry)
+        return [
+            ref
+            for ref in entry['factors']
+            if not callable(getattr(dsl_class, ref.rpartition('.')[2], None))
+        ]
+
+    def _materialize(self, entry: dict) -> CompiledRule:
+        start = self._payload_start + entry['offset']
+        payload = self._data[start : start + entry['length']]
+        if hashlib.sha256(payload).hexdigest() != entry['sha256']:
+            raise BundleError(f'{entry["name"]}: checksum mismatch')
+        payload = _load_json(bytes(payload), _PAYLOAD_KEYS, f'{entry["name"]} payload')
+        nodes = payload['nodes']
+        dsl_class = self.dsl_class(entry)
+        rule = CompiledRule.from_parsed(
+            dsl_class,
+            payload['grammar'],
+            payload['branches'],
+            None if nodes is None else [_decode_node(node) for node in nodes],
+            backend=payload['backend'],
+            reorder=payload['reorder'],
+            **payload['options'],
+        )
+        # the digest covers the dsl class, dsl_classes may replace the recorded one
+        if _class_path(dsl_class) == entry['dsl_class'] and rule.digest != entry['digest']:
+            raise BundleError(f'{entry["name"]}: digest mismatch')
+        return rule
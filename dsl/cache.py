@@ -0,0 +1,460 @@
+import collections
+import functools
+import itertools
+import sys
+import threading
+import time
+import types
+import typing
+
+from . import common, compiler, expression
+from .context import USER_SCOPE
+from .parser import ConditionParser, Parser
+from .registry import registry
+from .rule import CompiledRule
+from .ruleset import RuleSet
+
+__all__ = (
+    'RuleCache',
+    'rule_cache',
+    'compile_rule',
+    'DEPENDS',
+    'factor_dependencies',
+    'DecisionCache',
+)
+
+
+def _shared(obj: typing.Any) -> bool:
+    """objects not owned by one rule: classes, modules, code and module level functions"""
+    if isinstance(obj, (type, types.ModuleType, types.CodeType, types.BuiltinFunctionType)):
+        return True
+    if isinstance(obj, types.FunctionType):
+        return '<locals>' not in obj.__qualname__
+    return obj is None or obj is True or obj is False
+
+
+def _referents(obj: typing.Any) -> typing.Iterable[typing.Any]:
+    if isinstance(obj, (str, bytes, int, float)):
+        return ()
+    if isinstance(obj, (tuple, list, set, frozenset)):
+        return obj
+    if isinstance(obj, dict):
+        return itertools.chain(obj.keys(), obj.values())
+    if isinstance(obj, types.FunctionType):
+        return (obj.__closure__ or (), obj.__defaults__ or (), obj.__kwdefaults__, obj.__dict__)
+    if isinstance(obj, types.CellType):
+        try:
+            return (obj.cell_contents,)
+        except ValueError:
+            # empty cell
+            return ()
+    if isinstance(obj, types.MethodType):
+        return (obj.__self__, obj.__func__)
+    if isinstance(obj, functools.partial):
+        return (obj.func, obj.args, obj.keywords)
+    items = []
+    for cls in type(obj).__mro__:
+        for name in cls.__dict__.get('__slots__', ()):
+            if hasattr(obj, name):
+                items.append(getattr(obj, name))
+    if hasattr(obj, '__dict__'):
+        items.append(obj.__dict__)
+    return items
+
+
+def deep_size(obj: typing.Any, exclude: typing.Iterable[typing.Any] = ()) -> int:
+    """
+    Approximate memory held by obj and the objects it references, in bytes.
+    Classes, modules, code objects and module level functions are shared by
+    all rules and not counted; closures and their cells are.
+
+    Args:
+        exclude (Iterable): other shared objects, neither counted nor walked
+    """
+    seen = {id(item) for item in exclude}
+    size = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen or _shared(item):
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        stack.extend(_referents(item))
+    return size
+
+
+def rule_size(rule: CompiledRule) -> int:
+    """Approximate memory held by a compiled rule, in bytes: grammar, branches,
+    expression trees and the closure program"""
+    # the factors and methods of the dsl class are shared by all its rules
+    members = (
+        value
+        for klass in rule.dsl_class.__mro__
+        for value in vars(klass).values()
+        if callable(value)
+    )
+    return deep_size(rule, members)
+
+
+class RuleCache:
+    """Process-wide LRU cache of CompiledRule objects
+
+    Entries are keyed by (dsl_class, grammar, parser, options); the grammar
+    string is hashed once by the dict and equal grammars share one rule.
+
+    Args:
+        maxsize (int): max number of cached rules, None for unbounded
+        maxbytes (int): max approximate bytes held by cached rules, None for
+                        unbounded; rules are only measured (rule_size) when set
+    """
+
+    def __init__(
+        self, maxsize: typing.Optional[int] = 1024, maxbytes: typing.Optional[int] = None
+    ):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.currbytes = 0
+        self._data = collections.OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    @staticmethod
+    def make_key(dsl_class: type, grammar: str, parser: Parser, options: dict):
+        return dsl_class, grammar, parser, tuple(sorted(options.items()))
+
+    def configure(
+        self, maxsize: typing.Optional[int] = None, maxbytes: typing.Optional[int] = None
+    ) -> None:
+        """change the limits and evict rules above them"""
+        with self._lock:
+            self.maxsize = maxsize
+            self.maxbytes = maxbytes
+            for key in self._data:
+                self._measure(key)
+            self._evict()
+
+    def get_or_compile(
+        self,
+        dsl_class: type,
+        grammar: str,
+        parser: Parser = ConditionParser,
+        **options,
+    ) -> CompiledRule:
+        """
+        Args:
+            dsl_class (type): BaseDSL subclass, e.g. MysqlDSL
+            grammar (str): if ... then ... end
+
+        Returns:
+            CompiledRule: cached rule, compiled on a miss
+        """
+        try:
+            key = self.make_key(dsl_class, grammar, parser, options)
+            hash(key)
+        except TypeError:
+            # unhashable options can not be cached
+            return CompiledRule(dsl_class, grammar, parser=parser, **options)
+        with self._lock:
+            rule = self._data.get(key)
+            if rule is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return rule
+            self.misses += 1
+        rule = CompiledRule(dsl_class, grammar, parser=parser, **options)
+        # walking the rule costs about as much as compiling it, only done for maxbytes
+        size = rule_size(rule) if self.maxbytes is not None else None
+        with self._lock:
+            if key not in self._data:
+                self._data[key] = rule
+                self._measure(key, size)
+                self._evict()
+        return rule
+
+    def invalidate(
+        self,
+        dsl_class: typing.Union[type, str, None] = None,
+        grammar: typing.Optional[str] = None,
+    ) -> int:
+        """Drop cached rules
+
+        Args:
+            dsl_class (type | str): dsl class or its type_, None matches all
+            grammar (str): grammar string, None matches all
+
+        Returns:
+            int: number of dropped rules
+        """
+        with self._lock:
+            keys = [
+                key
+                for key in self._data
+                if (
+                    dsl_class is None
+                    or key[0] is dsl_class
+                    or key[0].type_ == dsl_class
+                )
+                and (grammar is None or key[1] == grammar)
+            ]
+            for key in keys:
+                self._pop(key)
+        return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.currbytes = 0
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._data),
+            'bytes': self.currbytes,
+            'maxsize': self.maxsize,
+            'maxbytes': self.maxbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def _measure(self, key, size: typing.Optional[int] = None) -> None:
+        """record the size of a cached rule when maxbytes is set"""
+        if self.maxbytes is None or key in self._sizes:
+            return
+        if size is None:
+            size = rule_size(self._data[key])
+        self._sizes[key] = size
+        self.currbytes += size
+
+    def _pop(self, key) -> None:
+        self._data.pop(key)
+        self.currbytes -= self._sizes.pop(key, 0)
+
+    def _evict(self) -> None:
+        while self._data and (
+            (self.maxsize is not None and len(self._data) > self.maxsize)
+            or (self.maxbytes is not None and self.currbytes > self.maxbytes)
+        ):
+            self._pop(next(iter(self._data)))
+            self.evictions += 1
+
+
+rule_cache = RuleCache()
+
+
+def compile_rule(
+    dsl_class: type, grammar: str, parser: Parser = ConditionParser, **options
+) -> CompiledRule:
+    """compile grammar through the process-wide rule_cache"""
+    return rule_cache.get_or_compile(dsl_class, grammar, parser=parser, **options)
+
+
+# what a factor result depends on, declared with @fac(depends=...) / @fun(depends=...):
+#   none: nothing, a constant or a function of its arguments only
+#   user: the user only
+#   fingerprint: the statement with its literals normalized away
+#   text: the raw text, e.g. its length
+#   volatile: time or external state, never cached
+DEPENDS = ('none', 'user', 'fingerprint', 'text', 'volatile')
+
+
+def _rule_refs(rule: CompiledRule) -> typing.Set[typing.Tuple[str, str]]:
+    """{('fac', 'sql_type'), ('act', 'allow_execute')}, references of every branch"""
+    refs = set()
+    for idx, (condition_str, then_str) in enumerate(rule.branches):
+        if condition_str is not True:
+            if rule.nodes is not None:
+                node = rule.nodes[idx]
+            else:
+                node = expression.parse(condition_str)
+            refs.update(
+                (item.kind, item.name)
+                for item in expression.walk(node)
+                if isinstance(item, expression.Ref)
+            )
+        refs.update((item.kind, item.name) for item in compiler.action_refs(then_str))
+    return refs
+
+
+def factor_dependencies(rule: CompiledRule) -> typing.Dict[str, typing.Optional[str]]:
+    """
+    Returns:
+        dict: {'@fac.sql_type': 'fingerprint', '@fun.my_fun': None}, None when
+              the factor declares no depends, a scope='user' factor depends on the user
+    """
+    table = registry.dispatch(rule.dsl_class)
+    dependencies = {}
+    for kind, name in sorted(_rule_refs(rule)):
+        function = table.resolve(name)
+        metadata = getattr(function, '_dict', None) or {}
+        depends = metadata.get('depends')
+        if depends is None and metadata.get('scope') == USER_SCOPE:
+            depends = 'user'
+        dependencies[f'@{kind}.{name}'] = depends
+    return dependencies
+
+
+class DecisionCache:
+    """LRU and TTL cache of the decisions of rules and rule sets.
+
+    ```
+    decisions = DecisionCache(maxsize=100000, ttl=60)
+    decisions.evaluate(rule_set, sql, user)
+    ```
+
+    Decisions are keyed by (rule or rule set digest, user, fingerprint of the
+    text). A rule is cached only when every @fac/@fun/@act it references
+    declares a depends the key covers: with the default fingerprint (the
+    text itself) none, user, fingerprint and text; with a normalizing
+    fingerprint none, user and fingerprint. Other rules are evaluated every
+    time, see unsafe().
+
+    Args:
+        maxsize (int): max number of cached decisions
+        ttl (float): seconds a decision is kept, None for no expiry
+        fingerprint (Callable[[str], Hashable]): key of a text, decisions are
+            shared by the texts with the same fingerprint, default the text
+        clock (Callable[[], float]): time source of ttl
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 10000,
+        ttl: typing.Optional[float] = 60.0,
+        fingerprint: typing.Optional[typing.Callable[[str], typing.Hashable]] = None,
+        clock: typing.Callable[[], float] = time.monotonic,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.fingerprint = fingerprint
+        self.clock = clock
+        self.allowed = frozenset(
+            ('none', 'user', 'fingerprint') if fingerprint is not None else DEPENDS[:-1]
+        )
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.bypassed = 0
+        self._data = collections.OrderedDict()
+        # {digest: (unsafe factors, user scoped)}
+        self._checked = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _check(self, target, digest: str) -> typing.Tuple[typing.List[str], bool]:
+        checked = self._checked.get(digest)
+        if checked is None:
+            if isinstance(target, CompiledRule):
+                rules = [target]
+            else:
+                rules = [rule for _, rule in target.entries]
+            dependencies = {}
+            for rule in rules:
+                dependencies.update(factor_dependencies(rule))
+            unsafe = sorted(
+                ref for ref, depends in dependencies.items() if depends not in self.allowed
+            )
+            user_scoped = 'user' in dependencies.values()
+            checked = self._checked[digest] = (unsafe, user_scoped)
+        return checked
+
+    def unsafe(self, target: typing.Union[CompiledRule, RuleSet]) -> typing.List[str]:
+        """factor references preventing the decisions of target from being cached"""
+        return list(self._check(target, target.digest)[0])
+
+    def cacheable(self, target: typing.Union[CompiledRule, RuleSet]) -> bool:
+        return not self.unsafe(target)
+
+    def evaluate(
+        self,
+        target: typing.Union[CompiledRule, RuleSet],
+        text: str,
+        user: typing.Optional[common.User] = None,
+        facts: typing.Optional[typing.Mapping[str, typing.Any]] = None,
+    ) -> typing.Any:
+        """
+        Args:
+            target (CompiledRule | RuleSet): rules to evaluate
+            facts (Mapping): injected facts, the decision is then not cached
+
+        Returns:
+            Decision | list[RuleMatch]: target.evaluate(text, user)
+        """
+        digest = target.digest
+        unsafe, user_scoped = self._check(target, digest)
+        if unsafe or facts:
+            self.bypassed += 1
+            return target.evaluate(text, user, facts=facts)
+        user_key = getattr(user, 'pk', user) if user_scoped else None
+        fingerprint = text if self.fingerprint is None else self.fingerprint(text)
+        key = (digest, user_key, fingerprint)
+        now = self.clock()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires, decision = entry
+                if expires is None or expires > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    # the RuleMatch list of a RuleSet is stored as a tuple
+                    return list(decision) if type(decision) is tuple else decision
+                del self._data[key]
+                self.expirations += 1
+            self.misses += 1
+        decision = target.evaluate(text, user)
+        stored = tuple(decision) if isinstance(decision, list) else decision
+        with self._lock:
+            self._data[key] = (None if self.ttl is None else now + self.ttl, stored)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+        return decision
+
+    def invalidate(self, target: typing.Union[CompiledRule, RuleSet, None] = None) -> int:
+        """drop the decisions of target, all of them by default
+
+        Returns:
+            int: number of dropped decisions
+        """
+        with self._lock:
+            if target is None:
+                count = len(self._data)
+                self._data.clear()
+                return count
+            keys = [key for key in self._data if key[0] == target.digest]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._checked.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'bypassed': self.bypassed,
+        }
@@ -29,24 +29,12 @@ class BoolValue:
 
 
 class CommonFAT:
-    @act
+    @act(depends='none')
     def reject_execute(self, msg: str = None) -> bool:
         self.end_msg = (False, msg)
-        self.log.debug(
-            '[grammar]: %s, [text]: %s, [reject_execute]: %s',
-            self.grammar,
-            self.text.value,
-            self.end_msg,
-        )
         return False
 
-    @act
+    @act(depends='none')
     def allow_execute(self, msg: str = None) -> bool:
         self.end_msg = (True, msg)
-        self.log.debug(
-            '[grammar]: %s, [text]: %s, [allow_execute]: %s',
-            self.grammar,
-            self.text.value,
-            self.end_msg,
-        )
         return True
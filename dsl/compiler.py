@@ -0,0 +1,612 @@
+"""
+Compile conditions and actions into pre-bound closures.
+
+TreeMatcher re-splits and re-decodes the condition string on every
+evaluation; here the condition is parsed once (dsl.expression), literals are
+decoded once and operators/factor methods are looked up once, so evaluating a
+branch is just calling ``condition(dsl)``.
+TreeMatcher stays the reference implementation, both have the same results.
+"""
+import asyncio
+import functools
+import inspect
+import json
+import re
+import time
+import typing
+
+from . import common, constants, enums, exceptions, expression
+from .cost import cost_model
+from .metrics import metrics
+from .registry import registry
+from .expression import decode_literal, unquote
+
+__all__ = (
+    'compile_condition',
+    'compile_node',
+    'compile_action',
+    'compiled_condition',
+    'traced_closure',
+    'decode_literal',
+)
+
+Closure = typing.Callable[[typing.Any], typing.Any]
+
+
+def _constant(value: typing.Any) -> Closure:
+    return lambda dsl: value
+
+
+def _rtype_converter(function) -> typing.Optional[typing.Callable]:
+    rtype_value = getattr(function, '_dict', {}).get('rtype')
+    if not rtype_value:
+        return None
+    rtype = enums.RTYPE_MAP[rtype_value]
+    if rtype in (int, float, str):
+        return rtype
+    if rtype in (list, dict):
+        return json.loads
+    return None
+
+
+def _resolve(dsl_class: type, name: str, source: str) -> typing.Callable:
+    """the function of a reference, an unknown name fails when the rule is compiled"""
+    function = registry.dispatch(dsl_class).resolve(name)
+    if function is None:
+        raise exceptions.GrammarError(
+            f'[Condition error]: {dsl_class.__name__} has no {source}'
+        )
+    return function
+
+
+def traced_closure(kind: str, source: str, closure: Closure) -> Closure:
+    """record the evaluation of closure as a step of context.trace"""
+
+    def traced(dsl):
+        trace = dsl.context.trace
+        if trace is None:
+            return closure(dsl)
+        step = trace.enter(kind, source)
+        try:
+            value = closure(dsl)
+        except BaseException as err:
+            trace.fail(step, err)
+            raise
+        trace.exit(step, value)
+        return value
+
+    return traced
+
+
+def _compile_ref(dsl_class: type, node: expression.Ref, traced: bool = False) -> Closure:
+    if node.kind == 'act':
+        _resolve(dsl_class, node.name, node.source)
+        source = node.source
+
+        def runner(dsl):
+            try:
+                value = dsl.chose_runner(source)
+            except Exception as err:
+                raise exceptions.RunnerError(err) from err
+            return dsl.tree_matcher.parse_rtype_value(unquote(value))
+
+        return runner
+
+    name = node.name
+    args = [compile_operand(dsl_class, arg, traced)[1] for arg in node.args]
+    function = _resolve(dsl_class, name, node.source)
+    convert = _rtype_converter(function)
+    scope = getattr(function, '_dict', {}).get('scope')
+
+    def run(dsl, values):
+        learn = cost_model.learn
+        measure = metrics.enabled
+        if learn or measure:
+            start = time.perf_counter()
+        try:
+            value = function(dsl, *values)
+        except Exception as err:
+            if measure:
+                metrics.factor_error(dsl_class, name)
+            raise exceptions.RunnerError(err) from err
+        if learn or measure:
+            elapsed = time.perf_counter() - start
+            if learn:
+                cost_model.observe(dsl_class, name, elapsed)
+            if measure:
+                metrics.observe_factor(dsl_class, name, elapsed)
+        value = unquote(value)
+        if convert is not None and isinstance(value, str):
+            value = convert(value)
+        return value
+
+    if inspect.iscoroutinefunction(function):
+        call = _compile_async_ref(dsl_class, node, function, args, convert, scope)
+        return traced_closure('fact', node.source, call) if traced else call
+
+    injectable = not args
+
+    def call(dsl):
+        context = dsl.context
+        if injectable and context.injected is not None and name in context.injected:
+            return _injected(context, name, convert)
+        values = [arg(dsl) for arg in args]
+        # the same @fac/@fun call is resolved once per evaluation
+        key = (name, *values)
+        facts = context.cache_for(scope)
+        try:
+            value = facts[key]
+        except KeyError:
+            context.misses += 1
+            value = facts[key] = run(dsl, values)
+            return value
+        except TypeError:
+            # unhashable arguments
+            context.misses += 1
+            return run(dsl, values)
+        context.hits += 1
+        if metrics.enabled:
+            metrics.factor_hit(dsl_class, name)
+        return value
+
+    return traced_closure('fact', node.source, call) if traced else call
+
+
+def _injected(context, name: str, convert: typing.Optional[typing.Callable]) -> typing.Any:
+    """a fact injected in the context, converted like the factor result"""
+    value = unquote(context.injected_value(name))
+    if convert is not None and isinstance(value, str):
+        value = convert(value)
+    return value
+
+
+def _compile_async_ref(
+    dsl_class: type,
+    node: expression.Ref,
+    function: typing.Callable,
+    args: typing.Sequence[Closure],
+    convert: typing.Optional[typing.Callable],
+    scope: typing.Optional[str],
+) -> Closure:
+    """an async def factor, resolved by a task of context.run_async"""
+    name = node.name
+
+    async def resolve(dsl, values):
+        learn = cost_model.learn
+        measure = metrics.enabled
+        if learn or measure:
+            start = time.perf_counter()
+        try:
+            value = await function(dsl, *values)
+        except Exception as err:
+            if measure:
+                metrics.factor_error(dsl_class, name)
+            raise exceptions.RunnerError(err) from err
+        if learn or measure:
+            elapsed = time.perf_counter() - start
+            if learn:
+                cost_model.observe(dsl_class, name, elapsed)
+            if measure:
+                metrics.observe_factor(dsl_class, name, elapsed)
+        value = unquote(value)
+        if convert is not None and isinstance(value, str):
+            value = convert(value)
+        return value
+
+    injectable = not args
+
+    def call(dsl):
+        context = dsl.context
+        if injectable and context.injected is not None and name in context.injected:
+            return _injected(context, name, convert)
+        values = [arg(dsl) for arg in args]
+        key = (name, *values)
+        facts = context.cache_for(scope)
+        try:
+            value = facts[key]
+        except KeyError:
+            pass
+        except TypeError as err:
+            raise exceptions.RunnerError(f'unhashable arguments of async {node.source}') from err
+        else:
+            context.hits += 1
+            if metrics.enabled:
+                metrics.factor_hit(dsl_class, name)
+            return value
+        tasks = context.tasks
+        if tasks is None:
+            raise exceptions.RunnerError(f'{node.source} is async, use evaluate_async')
+        task = tasks.get(key)
+        if task is None:
+            context.misses += 1
+            tasks[key] = asyncio.ensure_future(resolve(dsl, values))
+            raise exceptions.PendingFact(key)
+        if not task.done():
+            raise exceptions.PendingFact(key)
+        value = facts[key] = task.result()
+        return value
+
+    return call
+
+
+def compile_operand(
+    dsl_class: type, node: expression.Node, traced: bool = False
+) -> typing.Tuple[bool, Closure]:
+    """
+    Args:
+        node (expression.Node): 1. Ref('fac', 'sql_type')
+                                2. Literal(['select', 'update'])
+                                3. Or(...)
+
+    Returns:
+        tuple: (is_fat, closure), only a literal is not fat
+    """
+    if isinstance(node, expression.Literal):
+        return False, _constant(node.value)
+    if isinstance(node, expression.Ref):
+        return True, _compile_ref(dsl_class, node, traced)
+    return True, compile_node(dsl_class, node, traced=traced)
+
+
+def _unquoted(closure: Closure) -> Closure:
+    return lambda dsl: unquote(closure(dsl))
+
+
+def _compile_membership(
+    dsl_class: type, node: expression.Membership, traced: bool = False
+) -> Closure:
+    lfat, left = compile_operand(dsl_class, node.left, traced)
+    rfat, right = compile_operand(dsl_class, node.right, traced)
+    left = _unquoted(left) if lfat else _constant(unquote(left(None)))
+    if not rfat:
+        container = unquote(right(None))
+        members = _members(container)
+        if members is not None:
+            contains = _contains(members, container)
+            if node.negate:
+                return lambda dsl: not contains(left(dsl))
+            return lambda dsl: contains(left(dsl))
+        right = _constant(container)
+    else:
+        right = _unquoted(right)
+    if node.negate:
+        return lambda dsl: left(dsl) not in right(dsl)
+    return lambda dsl: left(dsl) in right(dsl)
+
+
+def _members(container: typing.Any) -> typing.Optional[frozenset]:
+    """["select","update"] => frozenset({'select', 'update'}), None when not hashable"""
+    if not isinstance(container, (list, dict)):
+        # str in str is a substring test
+        return None
+    try:
+        return frozenset(container)
+    except TypeError:
+        return None
+
+
+def _contains(members: frozenset, container: typing.Any) -> typing.Callable:
+    """O(1) membership, values that can not be hashed fall back to `in container`"""
+
+    def contains(value):
+        try:
+            return value in members
+        except TypeError:
+            return value in container
+
+    return contains
+
+
+def _compile_compare(
+    dsl_class: type, node: expression.Compare, traced: bool = False
+) -> Closure:
+    operator = constants.OPERATOR_MAP[node.op]
+    lfat, left = compile_operand(dsl_class, node.left, traced)
+    rfat, right = compile_operand(dsl_class, node.right, traced)
+
+    def compare(dsl):
+        left_value = left(dsl)
+        right_value = right(dsl)
+        try:
+            if lfat:
+                right_value = type(left_value)(right_value)
+            elif rfat:
+                left_value = type(right_value)(left_value)
+        except ValueError as err:
+            raise exceptions.TypeParseError(err)
+        if isinstance(right_value, str):
+            right_value = right_value.replace('"', '').replace("'", '')
+            if isinstance(left_value, str):
+                try:
+                    right_value, left_value = float(right_value), float(left_value)
+                except ValueError:
+                    pass
+        return bool(operator(left_value, right_value))
+
+    if not (lfat or rfat):
+        try:
+            return _constant(compare(None))
+        except Exception:
+            # raise when evaluated, like TreeMatcher
+            pass
+    regex = matchs_regex(node)
+    if regex is not None:
+        return _compile_matchs(node, left, regex, compare)
+    if lfat and not rfat:
+        return _compile_compare_literal(operator, left, right(None))
+    return compare
+
+
+# the literal converted to these types is the same for every evaluation
+_CONVERT_ONCE = (str, int, float, bool)
+
+
+def _compile_compare_literal(
+    operator: typing.Callable, left: Closure, literal: typing.Any
+) -> Closure:
+    """`@fac.name > 1000`: the literal is converted once per type of the factor value"""
+    conversions = {}
+
+    def convert(left_type: type) -> tuple:
+        try:
+            right_value = left_type(literal)
+        except ValueError as err:
+            raise exceptions.TypeParseError(err)
+        right_float = None
+        if isinstance(right_value, str):
+            right_value = right_value.replace('"', '').replace("'", '')
+            try:
+                right_float = float(right_value)
+            except ValueError:
+                pass
+        if left_type in _CONVERT_ONCE:
+            conversions[left_type] = right_value, right_float
+        return right_value, right_float
+
+    def compare(dsl):
+        left_value = left(dsl)
+        left_type = type(left_value)
+        try:
+            right_value, right_float = conversions[left_type]
+        except KeyError:
+            right_value, right_float = convert(left_type)
+        if right_float is not None and isinstance(left_value, str):
+            try:
+                return bool(operator(float(left_value), right_float))
+            except ValueError:
+                pass
+        return bool(operator(left_value, right_value))
+
+    return compare
+
+
+def matchs_regex(node: expression.Compare) -> typing.Optional[str]:
+    """the regex of `@fac.name matchs "regex"`, None when it is not a literal"""
+    if (
+        node.op not in expression.MATCH_OPERATORS
+        or isinstance(node.left, expression.Literal)
+        or not isinstance(node.right, expression.Literal)
+        or not isinstance(node.right.value, str)
+    ):
+        return None
+    regex = node.right.value.replace('"', '').replace("'", '')
+    try:
+        float(regex)
+    except ValueError:
+        return regex
+    # compared as float by TreeMatcher
+    return None
+
+
+def _compile_matchs(
+    node: expression.Compare, left: Closure, regex: str, compare: Closure
+) -> Closure:
+    try:
+        pattern = re.compile(regex)
+    except re.error as err:
+        raise exceptions.GrammarError(f'[Condition error]: invalid regex {regex}: {err}')
+    negate = node.op == 'not matchs'
+
+    def match(dsl):
+        value = left(dsl)
+        if not isinstance(value, str):
+            return compare(dsl)
+        patterns = dsl.context.patterns
+        if patterns is not None and not patterns.possible(regex, value, dsl.context):
+            return negate
+        return (pattern.match(value) is None) is negate
+
+    return match
+
+
+def _speculate(
+    closures: typing.Sequence[Closure],
+    pure: typing.Sequence[bool],
+    dsl: typing.Any,
+    conjunction: bool,
+) -> bool:
+    """
+    An operand waits for an async fact: evaluate the following side-effect-free
+    operands, to start their async facts concurrently or to decide the group
+    without waiting (false for `and`, true for `or`).
+    """
+    pending = None
+    for closure, is_pure in zip(closures, pure):
+        if pending is not None and not is_pure:
+            break
+        try:
+            value = closure(dsl)
+        except exceptions.PendingFact as err:
+            pending = pending or err
+            continue
+        except Exception:
+            if pending is None:
+                raise
+            # raised again when reached in order
+            continue
+        if bool(value) is not conjunction:
+            return not conjunction
+    if pending is not None:
+        raise pending
+    return conjunction
+
+
+def _all(closures: typing.Sequence[Closure], pure: typing.Sequence[bool]) -> Closure:
+    if len(closures) == 1:
+        return closures[0]
+
+    def match_and(dsl):
+        try:
+            for closure in closures:
+                if not closure(dsl):
+                    return False
+        except exceptions.PendingFact:
+            return _speculate(closures, pure, dsl, True)
+        return True
+
+    return match_and
+
+
+def _any(closures: typing.Sequence[Closure], pure: typing.Sequence[bool]) -> Closure:
+    if len(closures) == 1:
+        return closures[0]
+
+    def match_or(dsl):
+        try:
+            for closure in closures:
+                if closure(dsl):
+                    return True
+        except exceptions.PendingFact:
+            return _speculate(closures, pure, dsl, False)
+        return False
+
+    return match_or
+
+
+def compile_node(
+    dsl_class: type, node: expression.Node, reorder: bool = False, traced: bool = False
+) -> Closure:
+    """compile an expression tree, the closure returns bool
+
+    Args:
+        reorder (bool): evaluate the side-effect-free operands of and / or
+                        in cost order, see dsl.cost
+        traced (bool): record the and / or groups, comparisons and facts in
+                       context.trace, see dsl.trace
+    """
+    if isinstance(node, (expression.And, expression.Or)):
+        conjunction = isinstance(node, expression.And)
+        operands = node.operands
+        if reorder:
+            operands = cost_model.order(dsl_class, operands, conjunction)
+        closures = [compile_node(dsl_class, item, reorder, traced) for item in operands]
+        pure = [cost_model.pure(dsl_class, item) for item in operands]
+        closure = _all(closures, pure) if conjunction else _any(closures, pure)
+        kind = 'and' if conjunction else 'or'
+    elif isinstance(node, expression.Compare):
+        closure = _compile_compare(dsl_class, node, traced)
+        kind = 'compare'
+    elif isinstance(node, expression.Membership):
+        closure = _compile_membership(dsl_class, node, traced)
+        kind = 'compare'
+    elif isinstance(node, expression.Literal):
+        return _constant(bool(node.value))
+    else:
+        operand = _compile_ref(dsl_class, node, traced)
+        return lambda dsl: bool(operand(dsl))
+    if traced:
+        return traced_closure(kind, expression.to_source(node), closure)
+    return closure
+
+
+def compile_condition(dsl_class: type, condition_str: str) -> Closure:
+    """
+    Args:
+        dsl_class (type): BaseDSL subclass, e.g. MysqlDSL
+        condition_str (str): @fac.sql_type in ["select","update"] and (@fun.char_length < 1000 or @fac.is_admin_user)
+
+    Raises:
+        exceptions.GrammarError: invalid condition
+
+    Returns:
+        Closure: condition(dsl) -> bool
+    """
+    return compile_node(dsl_class, expression.parse(condition_str))
+
+
+@functools.lru_cache(maxsize=4096)
+def compiled_condition(dsl_class: type, condition_str: str, traced: bool = False) -> Closure:
+    """compile_condition cached by (dsl_class, condition_str, traced)"""
+    return compile_node(dsl_class, expression.parse(condition_str), traced=traced)
+
+
+def _action_name(action_str: str) -> typing.Tuple[typing.Optional[str], str]:
+    """@act.reject_execute mail @admin => ('reject_execute', 'mail @admin')"""
+    name = None
+    args = []
+    for arg_str in action_str.split(' '):
+        if enums.ParamsPrefix.ACT.value in arg_str:
+            name = arg_str.strip().replace(enums.ParamsPrefix.ACT.value, '')
+        else:
+            args.append(arg_str)
+    return name, ' '.join(args)
+
+
+def action_refs(action_str: str) -> typing.List[expression.Ref]:
+    """
+    References run by a then action, read like compile_action reads them:
+
+    @act.reject_execute mail @admin => [Ref('act', 'reject_execute')]
+    @fac.is_admin_user              => [Ref('fac', 'is_admin_user')]
+    """
+    action_str = str(action_str).strip()
+    if enums.ParamsPrefix.ACT.value in action_str:
+        name, _ = _action_name(action_str)
+        return [expression.Ref('act', name, source=action_str)]
+    if not constants.MATCH_REGEX.search(action_str):
+        return []
+    try:
+        node = expression.parse(action_str)
+    except exceptions.GrammarError:
+        return []
+    return [item for item in expression.walk(node) if isinstance(item, expression.Ref)]
+
+
+def compile_action(
+    dsl_class: type, action_str: str, allow_no_params: bool = False
+) -> Closure:
+    """
+    Args:
+        action_str (str): 1. @act.allow_execute
+                          2. @act.reject_execute "只能执行查询语句"
+
+    Returns:
+        Closure: action(dsl) -> result
+    """
+    action_str = action_str.strip()
+    if enums.ParamsPrefix.ACT.value not in action_str:
+        if constants.MATCH_REGEX.search(action_str):
+            return lambda dsl: dsl.chose_runner(action_str)
+        if not allow_no_params:
+            raise exceptions.DSLError('Parameter error, parameter name not found')
+        return _constant(common.BoolValue(action_str).to_representation())
+
+    name, arg = _action_name(action_str)
+    function = _resolve(dsl_class, name, action_str)
+
+    def call(dsl):
+        try:
+            return function(dsl, arg)
+        except Exception as err:
+            raise exceptions.ACTError() from err
+
+    def action(dsl):
+        context = dsl.context
+        if context.actions is not None:
+            return context.run_action(action_str, lambda: call(dsl))
+        try:
+            return function(dsl, arg)
+        except Exception as err:
+            raise exceptions.ACTError() from err
+
+    return action
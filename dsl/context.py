@@ -0,0 +1,182 @@
+import asyncio
+import typing
+
+from . import exceptions
+
+__all__ = ('EvaluationContext', 'USER_SCOPE', 'run_async')
+
+# facts that only depend on the user, shared by all texts of one user
+USER_SCOPE = 'user'
+
+
+class EvaluationContext:
+    """
+    Facts (@fac/@fun results) resolved while evaluating one text.
+    @act results are never stored, an action runs every time it is reached.
+
+    Args:
+        shared (dict): facts shared with other evaluations, e.g. the
+                       scope='user' facts of CompiledRule.evaluate_many
+        patterns (PatternSet): regex prefilter of the rule set being evaluated
+        trace (Trace): records the evaluation steps, see dsl.trace
+        injected (Mapping): precomputed facts, see inject()
+
+    tasks is {fact key: asyncio.Task} of the async facts being resolved,
+    actions the [(source, result)] of the @act already run, both None outside
+    of run_async.
+    """
+
+    __slots__ = (
+        'facts',
+        'shared',
+        'patterns',
+        'hits',
+        'misses',
+        'tasks',
+        'trace',
+        'injected',
+        'actions',
+        'action_index',
+    )
+
+    def __init__(
+        self,
+        shared: typing.Optional[dict] = None,
+        patterns=None,
+        trace=None,
+        injected: typing.Optional[typing.Mapping[str, typing.Any]] = None,
+    ):
+        self.facts = {}
+        self.shared = shared
+        self.patterns = patterns
+        self.hits = 0
+        self.misses = 0
+        self.tasks = None
+        self.trace = trace
+        self.injected = None
+        self.actions = None
+        self.action_index = 0
+        if injected:
+            self.inject(injected)
+
+    def inject(self, facts: typing.Mapping[str, typing.Any]) -> None:
+        """
+        Precomputed values of @fac and argument-less @fun, used instead of
+        calling the methods of the dsl class. A callable is a thunk: it is
+        called without arguments the first time the fact is needed.
+
+        Args:
+            facts (Mapping): {'sql_type': 'select', '@fac.tables': lambda: parse_tables(sql)}
+        """
+        injected = self.injected if self.injected is not None else {}
+        for name, value in facts.items():
+            injected[name.rpartition('.')[2] if name.startswith('@') else name] = value
+        self.injected = injected
+
+    def injected_value(self, name: str) -> typing.Any:
+        """the injected fact name, a thunk is called once
+
+        Raises:
+            KeyError: name is not injected
+        """
+        value = self.injected[name]
+        if callable(value):
+            value = self.injected[name] = value()
+        return value
+
+    def run_action(self, source: str, action: typing.Callable[[], typing.Any]) -> typing.Any:
+        """
+        action(), in run_async the @act run before a PendingFact are not run
+        again when run is called again: the n-th @act reached returns the
+        result of the n-th @act of the previous attempts
+
+        Args:
+            source (str): @act.reject_execute only select
+        """
+        actions = self.actions
+        if actions is None:
+            return action()
+        idx = self.action_index
+        self.action_index = idx + 1
+        if idx < len(actions):
+            if actions[idx][0] == source:
+                return actions[idx][1]
+            del actions[idx:]
+        result = action()
+        actions.append((source, result))
+        return result
+
+    def cache_for(self, scope: typing.Optional[str]) -> dict:
+        if scope == USER_SCOPE and self.shared is not None:
+            return self.shared
+        return self.facts
+
+    def resolve(self, key: typing.Hashable, scope: typing.Optional[str], compute):
+        """the fact stored under key, compute() it on the first call
+
+        Args:
+            key (Hashable): ('sql_type',)
+            scope (str): 'user' for the facts shared by all texts of one user
+            compute (Callable): resolves the fact
+        """
+        facts = self.cache_for(scope)
+        try:
+            value = facts[key]
+        except KeyError:
+            self.misses += 1
+            value = facts[key] = compute()
+            return value
+        except TypeError:
+            # unhashable arguments
+            self.misses += 1
+            return compute()
+        self.hits += 1
+        return value
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'facts': len(self.facts),
+            'shared': len(self.shared) if self.shared is not None else 0,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+async def run_async(run: typing.Callable, dsl) -> typing.Any:
+    """
+    run(dsl) with async @fac/@fun: an async fact that is not resolved yet
+    starts a task and raises PendingFact, and the independent async facts of
+    the same and/or group are started too. run is called again each time a
+    task is done, resolved facts are not resolved again and the @act already
+    run are not run again (see run_action); the tasks still running once run
+    returns are no longer needed and are cancelled.
+
+    Args:
+        run (Callable): CompiledRule.run / RuleSet.run
+        dsl (BaseDSL): dsl instance bound to the text
+    """
+    context = dsl.context
+    if context.tasks is None:
+        context.tasks = {}
+    tasks = context.tasks
+    context.actions = []
+    try:
+        while True:
+            context.action_index = 0
+            try:
+                return run(dsl)
+            except exceptions.PendingFact:
+                waiting = [task for task in tasks.values() if not task.done()]
+                if waiting:
+                    await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        context.tasks = None
+        context.actions = None
+        for task in tasks.values():
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                # retrieved, an unused failure is not reported by asyncio
+                task.exception()
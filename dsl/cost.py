@@ -0,0 +1,149 @@
+"""
+Cost model used to order the operands of `and` / `or` of the rules compiled
+with `reorder=True`, the written order is kept by default.
+
+A factor declares the estimated cost of one call, in microseconds:
+
+```
+@fun(cost=500)
+def owner_of_table(self, table_name: str) -> str:
+    ...
+```
+
+With `cost_model.learn = True` the compiled rules also measure every call
+and keep an exponentially weighted moving average per factor, used instead
+of the declared cost by the rules compiled afterwards
+(`rule_cache.invalidate()` recompiles the cached ones).
+
+Operands are only moved across other side-effect-free operands: @act refs,
+factors unknown at compile time and factors declared with `pure=False`
+keep their position and split the group.
+"""
+import math
+import typing
+
+from .expression import And, Compare, Literal, Membership, Node, Or, Ref, walk
+
+__all__ = ('DEFAULT_COST', 'CostModel', 'cost_model')
+
+# cost of a @fac/@fun without declared or observed cost, in microseconds
+DEFAULT_COST = 1.0
+# probability that a comparison is true, without statistics
+TRUE_RATES = {
+    '==': 0.1,
+    'in': 0.25,
+    'matchs': 0.25,
+    '!=': 0.9,
+    'not in': 0.75,
+    'not matchs': 0.75,
+}
+DEFAULT_TRUE_RATE = 0.5
+
+
+def _metadata(dsl_class: type, name: str) -> typing.Optional[dict]:
+    """_dict of the factor, None when dsl_class has no such method"""
+    function = getattr(dsl_class, name, None)
+    if not callable(function):
+        return None
+    return getattr(function, '_dict', {})
+
+
+class CostModel:
+    """
+    Args:
+        alpha (float): weight of the last observation in the moving average
+        learn (bool): measure the @fac/@fun calls of the compiled rules
+    """
+
+    def __init__(self, alpha: float = 0.2, learn: bool = False):
+        self.alpha = alpha
+        self.learn = learn
+        self.observed = {}
+
+    def observe(self, dsl_class: type, name: str, seconds: float) -> None:
+        key = (dsl_class, name)
+        micros = seconds * 1e6
+        previous = self.observed.get(key)
+        if previous is None:
+            self.observed[key] = micros
+        else:
+            self.observed[key] = previous + self.alpha * (micros - previous)
+
+    def reset(self) -> None:
+        self.observed.clear()
+
+    def cost(self, dsl_class: type, node: Node) -> float:
+        """estimated microseconds to evaluate node, literals are free"""
+        if isinstance(node, Literal):
+            return 0.0
+        if isinstance(node, Ref):
+            own = self.observed.get((dsl_class, node.name))
+            if own is None:
+                own = (_metadata(dsl_class, node.name) or {}).get('cost', DEFAULT_COST)
+            return own + sum(self.cost(dsl_class, arg) for arg in node.args)
+        if isinstance(node, (Compare, Membership)):
+            return self.cost(dsl_class, node.left) + self.cost(dsl_class, node.right)
+        return sum(self.cost(dsl_class, item) for item in node.operands)
+
+    def true_rate(self, node: Node) -> float:
+        """estimated probability that node is true"""
+        if isinstance(node, Literal):
+            return 1.0 if node.value else 0.0
+        if isinstance(node, Compare):
+            return TRUE_RATES.get(node.op, DEFAULT_TRUE_RATE)
+        if isinstance(node, Membership):
+            return TRUE_RATES['not in' if node.negate else 'in']
+        if isinstance(node, And):
+            return math.prod(self.true_rate(item) for item in node.operands)
+        if isinstance(node, Or):
+            return 1 - math.prod(1 - self.true_rate(item) for item in node.operands)
+        return DEFAULT_TRUE_RATE
+
+    @staticmethod
+    def pure(dsl_class: type, node: Node) -> bool:
+        """True when evaluating node has no side effect, it can be skipped or moved"""
+        for item in walk(node):
+            if not isinstance(item, Ref):
+                continue
+            if item.kind == 'act':
+                return False
+            metadata = _metadata(dsl_class, item.name)
+            if metadata is None or metadata.get('pure', True) is False:
+                return False
+        return True
+
+    def order(
+        self, dsl_class: type, operands: typing.Sequence[Node], conjunction: bool
+    ) -> typing.List[Node]:
+        """
+        Sort each run of side-effect-free operands by cost / probability of
+        ending the group (false for `and`, true for `or`), the cheapest and
+        most selective operands first. The sort is stable.
+
+        Args:
+            operands (Sequence[Node]): operands of an And / Or node
+            conjunction (bool): True for And
+        """
+
+        def rank(node: Node) -> float:
+            cost = self.cost(dsl_class, node)
+            if not cost:
+                return 0.0
+            rate = self.true_rate(node)
+            stop = 1 - rate if conjunction else rate
+            return cost / stop if stop else math.inf
+
+        ordered = []
+        run = []
+        for node in operands:
+            if self.pure(dsl_class, node):
+                run.append(node)
+                continue
+            ordered.extend(sorted(run, key=rank))
+            ordered.append(node)
+            run = []
+        ordered.extend(sorted(run, key=rank))
+        return ordered
+
+
+cost_model = CostModel()
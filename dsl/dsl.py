@@ -3,15 +3,30 @@ import logging
 import re
 import typing
 
-from . import common, constants, enums, exceptions, text_parser
+from . import cache, common, constants, enums, exceptions, text_parser
+from .context import EvaluationContext
 from .log import logger
 from .matcher import TreeMatcher
+from .metrics import metrics
 from .parser import Parser, ConditionParser
+from .registry import DispatchTable, registry
+from .rule import CompiledRule
+
+
+def _scope(function) -> typing.Optional[str]:
+    return getattr(function, '_dict', {}).get('scope')
 
 
 class BaseEngine:
     type_ = None
     text_parser = text_parser.BaseText
+    # process-wide cache between grammar strings and parsed branches, None disables it
+    rule_cache: typing.Optional[cache.RuleCache] = cache.rule_cache
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.__dict__.get('type_') is not None:
+            registry.register(cls)
 
     def __init__(
         self,
@@ -22,6 +37,8 @@ class BaseEngine:
         tree_matcher: TreeMatcher = TreeMatcher,
         allow_no_params: bool = False,
         log: logging.Logger = logger,
+        parsed_string_list: typing.Optional[typing.Sequence] = None,
+        context: typing.Optional[EvaluationContext] = None,
     ):
         self.grammar = grammar
         self.text_str = text
@@ -33,6 +50,10 @@ class BaseEngine:
         self.allow_no_params = allow_no_params
         self.log = log
         self.chosed_runner = None
+        self.context = EvaluationContext() if context is None else context
+        if parsed_string_list is not None:
+            # already parsed by a CompiledRule, skip the parser
+            self.__dict__['parsed_string_list'] = parsed_string_list
 
     @functools.cached_property
     def text(self):
@@ -48,7 +69,11 @@ class BaseEngine:
 
     @functools.cached_property
     def parsed_string_list(self):
-        return self.parser.parsed_string_list
+        if self.rule_cache is None:
+            return self.parser.parsed_string_list
+        return self.rule_cache.get_or_compile(
+            type(self), self.grammar, parser=self._parser, backend='tree'
+        ).branches
 
     def match_tree(self):
         raise NotImplementedError(
@@ -57,6 +82,20 @@ class BaseEngine:
 
 
 class BaseDSL(BaseEngine):
+    @classmethod
+    def compile(cls, grammar: str, **options) -> CompiledRule:
+        """parse and validate grammar once, evaluate it with CompiledRule.evaluate
+
+        Args:
+            grammar (str): if ... then ... end
+
+        Returns:
+            CompiledRule: reusable rule, shared through rule_cache
+        """
+        if cls.rule_cache is None:
+            return CompiledRule(cls, grammar, **options)
+        return cls.rule_cache.get_or_compile(cls, grammar, **options)
+
     def check_type(self) -> str:
         """check string type
 
@@ -70,119 +109,161 @@ class BaseDSL(BaseEngine):
                 type_ = item.value.replace('@', '').replace('.', '')
         return type_
 
-    @functools.lru_cache
+    @property
+    def dispatch(self) -> DispatchTable:
+        return registry.dispatch(type(self))
+
     def run_fac(self, fac_name: str) -> bool:
-        """
+        """resolved once per evaluation context
+
         Args:
             fac_name (str): @fac.is_admin_user
 
         """
-        fac = getattr(self, fac_name.replace(enums.ParamsPrefix.FAC.value, ''))
+        table = self.dispatch
+        name = table.facs.get(fac_name)
+        if name is None:
+            name = table.facs[fac_name] = fac_name.replace(enums.ParamsPrefix.FAC.value, '')
+        fac = table.resolve(name)
         if not fac:
             raise exceptions.DSLError(f'no {fac_name} factor')
         self.chosed_runner = fac
-        self.log.debug('[chosed_runner]: %s, [fac_name]: %s', fac, fac_name)
-        return fac()
+        injected = self.context.injected
+        if injected is not None and name in injected:
+            return self.context.injected_value(name)
+        return self._resolve((name,), name, fac, functools.partial(fac, self))
 
-    @functools.lru_cache
-    def run_fun(self, func_name: str, *args, **kwargs) -> any:
+    def _parse_fun(self, func_name: str) -> tuple:
+        """
+        @fun.is_char_lower(@fac.sql_type) => ('is_char_lower', [(True, '@fac.sql_type')])
+        @fun.char_length                  => ('char_length', None)
         """
+        find_list = re.findall(constants.BRACKETS_REGEX, func_name)
+        if not find_list:
+            return func_name.replace(enums.ParamsPrefix.FUN.value, ''), None
+        args_string = find_list[0]
+        arg_specs = []
+        for arg in args_string.split(','):
+            if enums.ParamsPrefix.FAC.value not in arg:
+                arg_specs.append(
+                    (
+                        False,
+                        arg.replace('"', '').replace("'", '')
+                        if '"' in arg or "'" in arg
+                        else arg,
+                    )
+                )
+            else:
+                arg_specs.append((True, arg))
+        name = (
+            func_name.replace(enums.ParamsPrefix.FUN.value, '')
+            .replace(args_string, '')
+            .replace('()', '')
+        )
+        return name, arg_specs
+
+    def run_fun(self, func_name: str, *args, **kwargs) -> any:
+        """resolved once per evaluation context and arguments
+
         Args:
             func_name (str): 1. @fun.is_char_lower(@fac.sql_type)
                              2. @fun.is_char_lower("UPPER")
                              3. @func.func_name(4,5)
 
         """
-        find_list = re.findall(constants.BRACKETS_REGEX, func_name)
-        if not find_list:
-            fun = getattr(self, func_name.replace(enums.ParamsPrefix.FUN.value, ''))
-            if not fun:
-                raise exceptions.DSLError(f'There is no {func_name} function')
-            return fun(*args, **kwargs)
-        else:
-            args_string = find_list[0]
-            args = []
-            for arg in args_string.split(','):
-                if enums.ParamsPrefix.FAC.value not in arg:
-                    args.append(
-                        arg.replace('"', '').replace("'", '')
-                        if isinstance(arg, str) and ('"' in arg or "'" in arg)
-                        else arg
-                    )
-                else:
-                    args.append(self.run_fac(arg))
-            fun = getattr(
-                self,
-                func_name.replace(enums.ParamsPrefix.FUN.value, '')
-                .replace(args_string, '')
-                .replace('()', ''),
-            )
-            if not fun:
-                raise exceptions.DSLError(f'There is no {func_name} function')
+        table = self.dispatch
+        spec = table.funs.get(func_name)
+        if spec is None:
+            spec = table.funs[func_name] = self._parse_fun(func_name)
+        name, arg_specs = spec
+        fun = table.resolve(name)
+        if not fun:
+            raise exceptions.DSLError(f'There is no {func_name} function')
+        if arg_specs is not None:
+            args = [self.run_fac(arg) if is_fac else arg for is_fac, arg in arg_specs]
             self.chosed_runner = fun
-            self.log.debug('[chosed_runner]: %s, [func_name]: %s', fun, func_name)
-            return fun(*args, **kwargs)
+        elif not (args or kwargs):
+            injected = self.context.injected
+            if injected is not None and name in injected:
+                return self.context.injected_value(name)
+        key = (name, *args, tuple(kwargs.items())) if kwargs else (name, *args)
+        return self._resolve(key, name, fun, functools.partial(fun, self, *args, **kwargs))
 
-    @functools.lru_cache
-    def run_act(self, act_name: str) -> bool:
+    def _resolve(self, key, name: str, function, compute) -> any:
+        """
+        the fact of the evaluation context, recorded by dsl.metrics when enabled;
+        key is (name, *arguments) like in the compiled closures, a fact resolved
+        by one backend is not resolved again by the other
         """
+        if metrics.enabled:
+            return metrics.resolve(
+                self.context, key, _scope(function), type(self), name, compute
+            )
+        return self.context.resolve(key, _scope(function), compute)
+
+    def run_act(self, act_name: str) -> bool:
+        """never cached, the action runs every time it is reached
+
         Args:
             act_name (str): 1. @act.allow_execute
                             2. @act.reject_execute "只能执行查询语句"
         """
-        act_str_list = act_name.strip().split(' ')
-        args = []
-        act = None
-        for arg_str in act_str_list:
-            if enums.ParamsPrefix.ACT.value in arg_str:
-                act = getattr(
-                    self, arg_str.strip().replace(enums.ParamsPrefix.ACT.value, '')
-                )
-            else:
-                args.append(arg_str)
+        table = self.dispatch
+        spec = table.acts.get(act_name)
+        if spec is None:
+            name = None
+            args = []
+            for arg_str in act_name.strip().split(' '):
+                if enums.ParamsPrefix.ACT.value in arg_str:
+                    name = arg_str.strip().replace(enums.ParamsPrefix.ACT.value, '')
+                else:
+                    args.append(arg_str)
+            spec = table.acts[act_name] = name, ' '.join(args)
+        name, arg = spec
+        act = table.resolve(name) if name is not None else None
         if not act:
             raise exceptions.DSLError(f'no action {act_name}')
         self.chosed_runner = act
-        self.log.debug('[chosed_runner]: %s, [act_name]: %s', act, act_name)
-        return act(' '.join(args))
+        return act(self, arg)
 
-    @functools.lru_cache
     def chose_runner(self, line_string: str) -> any:
-        self.chosed_runner = runner = None
-        for params in enums.ParamsPrefix:
-            if params.value in line_string:
-                runner = getattr(self, f'run_{params.value.replace("@", "").replace(".", "")}')
-        if not runner:
-            self.log.debug(
-                '[chose_runner]: [self.allow_no_params] is %s', self.allow_no_params
-            )
-            if not self.allow_no_params:
-                raise exceptions.DSLError('Parameter error, parameter name not found')
-
-        self.log.debug('[chose_runner]: %s, [line_string]: %s', runner, line_string)
+        self.chosed_runner = None
+        runners = self.dispatch.runners
+        try:
+            runner_name = runners[line_string]
+        except KeyError:
+            runner_name = None
+            for params in enums.ParamsPrefix:
+                if params.value in line_string:
+                    runner_name = f'run_{params.value.replace("@", "").replace(".", "")}'
+            runners[line_string] = runner_name
+        runner = getattr(self, runner_name) if runner_name else None
+        if not runner and not self.allow_no_params:
+            raise exceptions.DSLError('Parameter error, parameter name not found')
+        context = self.context
+        trace = context.trace
+        step = trace.enter('call', line_string) if trace is not None else None
         try:
             if callable(runner):
-                result = runner(line_string)
+                if context.actions is not None and runner_name == 'run_act':
+                    result = context.run_action(line_string, lambda: runner(line_string))
+                else:
+                    result = runner(line_string)
             else:
                 result = common.BoolValue(line_string).to_representation()
         except Exception as err:
+            if step is not None:
+                trace.fail(step, err)
             raise exceptions.ACTError() from err
-        else:
-            self.log.debug(
-                '[chose_runner], %s, [line_string]: %s, [result]: %s',
-                runner,
-                line_string,
-                result,
-            )
-            return result
+        if step is not None:
+            trace.exit(step, result)
+        return result
 
     def match_tree(self):
         try:
             result = self.tree_matcher.match_tree()
         except Exception as err:
             exceptions.exception_handler(err)
-        else:
-            self.log.debug('[matched result]: %s', self.tree_matcher.matched)
         return result
 
 
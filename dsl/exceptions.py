@@ -30,5 +30,13 @@ class ACTError(DSLError):
     pass
 
 
+class PendingFact(Exception):
+    """an async fact is not resolved yet, raised during evaluate_async only"""
+
+    def __init__(self, key):
+        super().__init__(key)
+        self.key = key
+
+
 def exception_handler(exc):
     raise exc
@@ -0,0 +1,456 @@
+"""
+Tokenizer and Pratt parser for condition expressions.
+
+```
+@fac.sql_type in ["select","update"] and (@fun.char_length < 1000 or @fac.is_admin_user)
+=>
+And((
+    Membership(False, Ref('fac', 'sql_type'), Literal(['select', 'update'])),
+    Or((
+        Compare('<', Ref('fun', 'char_length'), Literal('1000')),
+        Ref('fac', 'is_admin_user'),
+    )),
+))
+```
+
+priority: or < and < in = not in = comparison = matchs = not matchs
+
+Both the tokenizer and the parser are single pass, so parsing is linear in the
+condition length whatever the nesting depth of the brackets. Conditions
+nested deeper than MAX_DEPTH raise GrammarError.
+"""
+import functools
+import json
+import typing
+from dataclasses import dataclass
+
+from . import common, enums, exceptions
+
+__all__ = (
+    'Token',
+    'Literal',
+    'Ref',
+    'Compare',
+    'Membership',
+    'And',
+    'Or',
+    'tokenize',
+    'parse',
+    'walk',
+    'to_source',
+)
+
+# token kinds
+LITERAL = 'literal'
+WORD = 'word'
+REF = 'ref'
+OPERATOR = 'operator'
+AND = 'and'
+OR = 'or'
+LPAREN = '('
+RPAREN = ')'
+END = 'end'
+
+COMPARE_OPERATORS = ('==', '!=', '>=', '>', '<=', '<')
+MEMBERSHIP_OPERATORS = ('in', 'not in')
+MATCH_OPERATORS = ('matchs', 'not matchs')
+
+_PREFIXES = {prefix.value: prefix.name.lower() for prefix in enums.ParamsPrefix}
+_WORD_STOP = set(' \t\r\n()[]{}"\'<>=!,')
+_PAIRS = {'(': ')', '[': ']', '{': '}'}
+
+# nesting depth of the brackets and function arguments, deeper conditions are
+# rejected with a GrammarError before the recursion limit of Python is reached;
+# a nested function argument uses 3 times the stack of a bracket
+MAX_DEPTH = 200
+_ARGUMENT_DEPTH = 3
+
+# binding power
+_BP_OR = 10
+_BP_AND = 20
+_BP_COMPARE = 30
+
+
+@dataclass(frozen=True)
+class Token:
+    kind: str
+    value: typing.Any
+    start: int
+    end: int
+
+
+class Node:
+    __slots__ = ()
+
+
+@dataclass(frozen=True)
+class Literal(Node):
+    """decoded like TreeMatcher.get_condition_value: "a" => 'a', 1 => '1', true => True"""
+
+    value: typing.Any
+    source: str = ''
+
+
+@dataclass(frozen=True)
+class Ref(Node):
+    """@fac.name, @fun.name, @fun.name(arg, @fac.name)"""
+
+    kind: str
+    name: str
+    args: tuple = ()
+    source: str = ''
+
+
+@dataclass(frozen=True)
+class Compare(Node):
+    op: str
+    left: Node
+    right: Node
+
+
+@dataclass(frozen=True)
+class Membership(Node):
+    negate: bool
+    left: Node
+    right: Node
+
+
+@dataclass(frozen=True)
+class And(Node):
+    operands: tuple
+
+
+@dataclass(frozen=True)
+class Or(Node):
+    operands: tuple
+
+
+def unquote(value: typing.Any) -> typing.Any:
+    """'"a"' => 'a', '["a","b"]' => ['a', 'b']"""
+    if isinstance(value, str) and ('"' in value or "'" in value):
+        try:
+            return json.loads(value)
+        except json.decoder.JSONDecodeError:
+            return value.replace('"', '').replace("'", '')
+    return value
+
+
+def decode_literal(string: str) -> typing.Any:
+    """decode a literal operand the same way as TreeMatcher.get_condition_value"""
+    return unquote(common.BoolValue(string).to_representation())
+
+
+@functools.lru_cache(maxsize=4096)
+def literal_value(string: str) -> typing.Any:
+    """decode_literal cached by string, the value is shared and must not be mutated"""
+    return decode_literal(string)
+
+
+def _error(source: str, pos: int, msg: str) -> exceptions.GrammarError:
+    return exceptions.GrammarError(f'[Condition error]: {msg} at column {pos}: {source}')
+
+
+def _skip_quoted(source: str, pos: int) -> int:
+    """return the index after the string starting at pos"""
+    quote = source[pos]
+    pos += 1
+    length = len(source)
+    while pos < length:
+        char = source[pos]
+        if char == '\\':
+            pos += 2
+            continue
+        if char == quote:
+            return pos + 1
+        pos += 1
+    raise _error(source, pos, 'unterminated string')
+
+
+def _skip_bracketed(source: str, pos: int) -> int:
+    """return the index after the bracket starting at pos"""
+    stack = [_PAIRS[source[pos]]]
+    pos += 1
+    length = len(source)
+    while pos < length:
+        char = source[pos]
+        if char in '"\'':
+            pos = _skip_quoted(source, pos)
+            continue
+        if char in _PAIRS:
+            stack.append(_PAIRS[char])
+        elif char == stack[-1]:
+            stack.pop()
+            if not stack:
+                return pos + 1
+        elif char in ')]}':
+            raise _error(source, pos, f'unexpected [{char}]')
+        pos += 1
+    raise _error(source, pos, f'missing [{stack[-1]}]')
+
+
+def _word_end(source: str, pos: int) -> int:
+    length = len(source)
+    while pos < length and source[pos] not in _WORD_STOP:
+        pos += 1
+    return pos
+
+
+def tokenize(source: str) -> typing.List[Token]:
+    """
+    Args:
+        source (str): @fac.sql_type in ["select","update"] and @fun.char_length < 1000
+
+    Returns:
+        list: tokens, the last one is END
+    """
+    tokens = []
+    pos = 0
+    length = len(source)
+    while pos < length:
+        char = source[pos]
+        if char in ' \t\r\n':
+            pos += 1
+            continue
+        start = pos
+        if char == '(':
+            tokens.append(Token(LPAREN, char, start, pos + 1))
+            pos += 1
+        elif char == ')':
+            tokens.append(Token(RPAREN, char, start, pos + 1))
+            pos += 1
+        elif char in '"\'':
+            pos = _skip_quoted(source, pos)
+            tokens.append(Token(LITERAL, source[start:pos], start, pos))
+        elif char in '[{':
+            pos = _skip_bracketed(source, pos)
+            tokens.append(Token(LITERAL, source[start:pos], start, pos))
+        elif source.startswith(('==', '!=', '>=', '<='), pos):
+            pos += 2
+            tokens.append(Token(OPERATOR, source[start:pos], start, pos))
+        elif char in '<>':
+            pos += 1
+            tokens.append(Token(OPERATOR, char, start, pos))
+        elif char == '@':
+            pos = _word_end(source, pos)
+            if source[start:pos].count('.') != 1 or source[start:start + 5] not in _PREFIXES:
+                raise _error(source, start, f'invalid parameter [{source[start:pos]}]')
+            if pos < length and source[pos] == '(':
+                pos = _skip_bracketed(source, pos)
+            tokens.append(Token(REF, source[start:pos], start, pos))
+        else:
+            pos = _word_end(source, pos)
+            if pos == start:
+                raise _error(source, start, f'unexpected [{char}]')
+            word = source[start:pos]
+            if word == 'and':
+                tokens.append(Token(AND, word, start, pos))
+            elif word == 'or':
+                tokens.append(Token(OR, word, start, pos))
+            elif word in ('in', 'matchs'):
+                tokens.append(Token(OPERATOR, word, start, pos))
+            elif word == 'not':
+                follow_start = pos
+                while follow_start < length and source[follow_start] in ' \t':
+                    follow_start += 1
+                follow_end = _word_end(source, follow_start)
+                follow = source[follow_start:follow_end]
+                if follow in ('in', 'matchs') and follow_start > pos:
+                    pos = follow_end
+                    tokens.append(Token(OPERATOR, f'not {follow}', start, pos))
+                else:
+                    tokens.append(Token(WORD, word, start, pos))
+            else:
+                tokens.append(Token(WORD, word, start, pos))
+    tokens.append(Token(END, None, length, length))
+    return tokens
+
+
+class ExpressionParser:
+    """Pratt parser from tokens to Node
+
+    Args:
+        source (str): condition expression
+        depth (int): nesting depth of source, not 0 for function arguments
+    """
+
+    def __init__(self, source: str, depth: int = 0):
+        self.source = source
+        self.tokens = tokenize(source)
+        self.pos = 0
+        self.depth = depth
+
+    def peek(self) -> Token:
+        return self.tokens[self.pos]
+
+    def next(self) -> Token:
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def parse(self) -> Node:
+        if self.peek().kind == END:
+            raise _error(self.source, 0, 'empty condition')
+        node = self.expression(0)
+        token = self.peek()
+        if token.kind != END:
+            raise _error(self.source, token.start, f'unexpected [{token.value}]')
+        return node
+
+    def expression(self, min_bp: int) -> Node:
+        left = self.prefix()
+        while True:
+            token = self.peek()
+            if token.kind == OR:
+                bp = _BP_OR
+            elif token.kind == AND:
+                bp = _BP_AND
+            elif token.kind == OPERATOR:
+                bp = _BP_COMPARE
+            else:
+                break
+            if bp <= min_bp:
+                break
+            self.next()
+            right = self.expression(bp)
+            left = self.infix(token, left, right)
+        return left
+
+    def infix(self, token: Token, left: Node, right: Node) -> Node:
+        if token.kind == OR:
+            return Or(_flatten(Or, left) + _flatten(Or, right))
+        if token.kind == AND:
+            return And(_flatten(And, left) + _flatten(And, right))
+        if token.value in MEMBERSHIP_OPERATORS:
+            return Membership(token.value == 'not in', left, right)
+        return Compare(token.value, left, right)
+
+    def prefix(self) -> Node:
+        token = self.next()
+        if token.kind == LPAREN:
+            if self.peek().kind == RPAREN:
+                # '()' is False, like TreeMatcher.match_cached
+                self.next()
+                return Literal(False, '()')
+            self._enter(token)
+            node = self.expression(0)
+            closing = self.next()
+            if closing.kind != RPAREN:
+                raise _error(self.source, closing.start, 'missing [)]')
+            self.depth -= 1
+            return node
+        if token.kind == LITERAL:
+            return Literal(decode_literal(token.value), token.value)
+        if token.kind == REF:
+            return self.ref(token)
+        if token.kind == WORD:
+            # unquoted words are one literal: @fac.sql_type == select
+            end = token.end
+            while self.peek().kind == WORD:
+                end = self.next().end
+            string = self.source[token.start:end]
+            return Literal(decode_literal(string), string)
+        if token.kind == END:
+            raise _error(self.source, token.start, 'unexpected end of condition')
+        raise _error(self.source, token.start, f'unexpected [{token.value}]')
+
+    def ref(self, token: Token) -> Ref:
+        string = token.value
+        kind = _PREFIXES[string[:5]]
+        name, _, args_string = string[5:].partition('(')
+        if not name.isidentifier():
+            raise _error(self.source, token.start, f'invalid parameter [{string}]')
+        args = ()
+        if args_string:
+            self._enter(token, _ARGUMENT_DEPTH)
+            args = tuple(
+                _argument(arg.strip(), self.depth) for arg in _split_arguments(args_string[:-1])
+            )
+            self.depth -= _ARGUMENT_DEPTH
+        return Ref(kind, name, args, string)
+
+    def _enter(self, token: Token, levels: int = 1) -> None:
+        self.depth += levels
+        if self.depth > MAX_DEPTH:
+            raise _error(self.source, token.start, f'nested deeper than {MAX_DEPTH} levels')
+
+
+def _flatten(cls: type, node: Node) -> tuple:
+    return node.operands if isinstance(node, cls) else (node,)
+
+
+def _split_arguments(string: str) -> typing.List[str]:
+    if not string.strip():
+        return []
+    args = []
+    start = pos = 0
+    length = len(string)
+    while pos < length:
+        char = string[pos]
+        if char in '"\'':
+            pos = _skip_quoted(string, pos)
+            continue
+        if char in _PAIRS:
+            pos = _skip_bracketed(string, pos)
+            continue
+        if char == ',':
+            args.append(string[start:pos])
+            start = pos + 1
+        pos += 1
+    args.append(string[start:])
+    return args
+
+
+def _argument(string: str, depth: int = 0) -> Node:
+    """function arguments: @fac.name is called, "a" => 'a', 4 => '4'"""
+    if string.startswith(tuple(_PREFIXES)):
+        return ExpressionParser(string, depth).parse()
+    if '"' in string or "'" in string:
+        return Literal(string.replace('"', '').replace("'", ''), string)
+    return Literal(string, string)
+
+
+def parse(source: str) -> Node:
+    """
+    Args:
+        source (str): @fac.fac_value > 1 and (@fun.is_char_lower("A") or @fac.char_length > 10)
+
+    Raises:
+        exceptions.GrammarError: invalid condition
+
+    Returns:
+        Node: expression tree
+    """
+    return ExpressionParser(source).parse()
+
+
+def walk(node: Node) -> typing.Iterator[Node]:
+    """yield node and all its descendants, depth first"""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        if isinstance(node, (And, Or)):
+            stack.extend(reversed(node.operands))
+        elif isinstance(node, (Compare, Membership)):
+            stack.append(node.right)
+            stack.append(node.left)
+        elif isinstance(node, Ref):
+            stack.extend(reversed(node.args))
+
+
+def to_source(node: Node) -> str:
+    """condition of node, and / or groups inside another group are parenthesized"""
+    if isinstance(node, (Literal, Ref)):
+        return node.source or json.dumps(node.value if isinstance(node, Literal) else node.name)
+    if isinstance(node, Compare):
+        return f'{_operand_source(node.left)} {node.op} {_operand_source(node.right)}'
+    if isinstance(node, Membership):
+        operator = 'not in' if node.negate else 'in'
+        return f'{_operand_source(node.left)} {operator} {_operand_source(node.right)}'
+    separator = ' and ' if isinstance(node, And) else ' or '
+    return separator.join(_operand_source(item) for item in node.operands)
+
+
+def _operand_source(node: Node) -> str:
+    source = to_source(node)
+    return f'({source})' if isinstance(node, (And, Or)) else source
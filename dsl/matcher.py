@@ -3,7 +3,7 @@ import logging
 import re
 import typing
 
-from . import common, constants, enums, exceptions
+from . import compiler, constants, enums, exceptions, expression
 from .log import dsl_parser_log
 
 
@@ -51,7 +51,6 @@ class TreeMatcher:
         Returns:
             bool: _description_
         """
-        self.log.debug('[match_condition]: [condition_str]: %s', condition_str)
         _condition_str = condition_str.strip()
         if enums.ParserEnum.OR.value in _condition_str:
             _contidion_list = _condition_str.split(enums.ParserEnum.OR.value)
@@ -103,8 +102,8 @@ class TreeMatcher:
                 condition_value = self.dsl.chose_runner(condition_str)
                 is_fat = True
             else:
-                # "a" in @fac.fac_value
-                condition_value = common.BoolValue(condition_str).to_representation()
+                # "a" in @fac.fac_value, decoded once per literal string
+                condition_value = expression.literal_value(condition_str)
         except Exception as err:
             raise exceptions.RunnerError(err)
         if isinstance(condition_value, str) and (
@@ -226,7 +225,6 @@ class TreeMatcher:
 
         self._run_brackets(brackets_str_list)
         full_condition_str = self._replace_brackets(full_condition_str)
-        self.log.debug('[match_brackets]: %s ==> %s', condition_str, full_condition_str)
         return full_condition_str
 
     def match_or(self, condition_str: str) -> bool:
@@ -238,7 +236,6 @@ class TreeMatcher:
         Returns:
             bool: True：条件成立; False: 条件不成立
         """
-        self.log.debug('[match_or condition_str]: %s', condition_str)
         _condition_str = condition_str.strip()
         if enums.ParserEnum.AND.value in _condition_str:
             _contidion_list = _condition_str.split(enums.ParserEnum.AND.value)
@@ -315,17 +312,52 @@ class TreeMatcher:
         for condition_str_list in parsed_str_list:
             condition_str, then_str = condition_str_list
             if condition_str is True:
+                trace = self.dsl.context.trace
+                if trace is not None:
+                    trace.add('branch', 'else', True)
                 result = self.dsl.chose_runner(then_str)
                 matched['matched'] = condition_str_list
                 matched['result'] = result
                 self.matched = matched
                 return result
             else:
-                match_brackets_result = self.match_brackets(condition_str)
-                match_result = self.match_condition(match_brackets_result)
+                trace = self.dsl.context.trace
+                if trace is not None:
+                    match_result = self._traced_condition(trace, condition_str)
+                else:
+                    match_brackets_result = self.match_brackets(condition_str)
+                    match_result = self.match_condition(match_brackets_result)
                 if match_result:
                     result = self.dsl.chose_runner(then_str)
                     matched['matched'] = condition_str_list
                     matched['result'] = result
                     self.matched = matched
                     return result
+
+    def _traced_condition(self, trace, condition_str: str) -> bool:
+        step = trace.enter('branch', condition_str)
+        try:
+            result = self.match_condition(self.match_brackets(condition_str))
+        except BaseException as err:
+            trace.fail(step, err)
+            raise
+        trace.exit(step, result)
+        return result
+
+
+class ExpressionMatcher(TreeMatcher):
+    """
+    TreeMatcher without parse_brackets/_replace_brackets: every condition is
+    parsed once by dsl.expression into an expression tree (linear in the
+    condition length) and nested groups are short-circuit evaluated.
+
+    MysqlDSL(grammar, text, tree_matcher=ExpressionMatcher)
+    """
+
+    def match_brackets(self, condition_str: str) -> str:
+        return condition_str
+
+    def match_condition(self, condition_str: str) -> bool:
+        traced = self.dsl.context.trace is not None
+        condition = compiler.compiled_condition(type(self.dsl), condition_str, traced)
+        return condition(self.dsl)
@@ -0,0 +1,305 @@
+"""
+Evaluation counters and latency histograms.
+
+```
+from dsl.metrics import metrics
+
+metrics.enabled = True
+rule_set.evaluate(text, user)
+metrics.snapshot()     # {'rules': {...}, 'factors': {...}, 'caches': {...}}
+metrics.prometheus()   # text exposition format
+```
+
+Recorded per rule (evaluations, latency, branch taken, an unmatched
+evaluation is the branch 'none') and per @fac/@fun (calls, errors, latency
+of the calls, hits of the evaluation context). A rule of a RuleSet is
+labelled by its name, or by the start of the rule set digest and its index
+when the rules were given as a list ('3f2a9c01d4e5[0]'); a rule evaluated
+alone is labelled by the start of its digest. Rules are counted per engine
+type and label.
+
+Disabled (the default), the only cost is reading `metrics.enabled` once per
+rule evaluation and once per fact lookup.
+Counters are per process, ParallelEvaluator workers in processes record
+their own metrics.
+"""
+import bisect
+import threading
+import time
+import typing
+
+__all__ = ('DEFAULT_BUCKETS', 'Histogram', 'Metrics', 'metrics')
+
+# upper bounds of the latency buckets, in seconds
+DEFAULT_BUCKETS = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+
+
+class Histogram:
+    """
+    Args:
+        buckets (Sequence[float]): sorted upper bounds, +Inf is implied
+    """
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets: typing.Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def cumulative(self) -> typing.List[typing.Tuple[float, int]]:
+        """[(upper bound, observations <= upper bound)], the last bound is inf"""
+        total = 0
+        items = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            items.append((bound, total))
+        return items
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': [[bound, count] for bound, count in self.cumulative()],
+        }
+
+
+class _RuleStats:
+    __slots__ = ('latency', 'branches', 'errors')
+
+    def __init__(self, buckets: typing.Sequence[float]):
+        self.latency = Histogram(buckets)
+        self.branches = {}
+        self.errors = 0
+
+
+class _FactorStats:
+    __slots__ = ('calls', 'hits', 'errors', 'latency')
+
+    def __init__(self, buckets: typing.Sequence[float]):
+        self.calls = 0
+        self.hits = 0
+        self.errors = 0
+        self.latency = Histogram(buckets)
+
+
+class Metrics:
+    """
+    Args:
+        enabled (bool): record the evaluations
+        buckets (Sequence[float]): latency histogram upper bounds, in seconds
+    """
+
+    def __init__(self, enabled: bool = False, buckets: typing.Sequence[float] = DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.buckets = tuple(sorted(buckets))
+        self.rules = {}
+        self.factors = {}
+        self._lock = threading.Lock()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.rules.clear()
+            self.factors.clear()
+
+    def _rule(self, type_: str, label: str) -> _RuleStats:
+        key = (type_, label)
+        stats = self.rules.get(key)
+        if stats is None:
+            stats = self.rules[key] = _RuleStats(self.buckets)
+        return stats
+
+    def _factor(self, dsl_class: type, name: str) -> _FactorStats:
+        key = (dsl_class.type_, name)
+        stats = self.factors.get(key)
+        if stats is None:
+            stats = self.factors[key] = _FactorStats(self.buckets)
+        return stats
+
+    def observe_rule(
+        self, type_: str, label: str, branch: typing.Optional[int], seconds: float
+    ) -> None:
+        """
+        Args:
+            type_ (str): mysql
+            label (str): rule name
+            branch (int): index of the branch taken, None when no branch matched
+            seconds (float): evaluation time
+        """
+        with self._lock:
+            stats = self._rule(type_, label)
+            stats.latency.observe(seconds)
+            branch = 'none' if branch is None else branch
+            stats.branches[branch] = stats.branches.get(branch, 0) + 1
+
+    def rule_error(self, type_: str, label: str) -> None:
+        with self._lock:
+            self._rule(type_, label).errors += 1
+
+    def observe_factor(self, dsl_class: type, name: str, seconds: float) -> None:
+        """one call of the @fac/@fun name, the fact was not resolved yet"""
+        with self._lock:
+            stats = self._factor(dsl_class, name)
+            stats.calls += 1
+            stats.latency.observe(seconds)
+
+    def factor_hit(self, dsl_class: type, name: str) -> None:
+        """the fact was already resolved by the evaluation context"""
+        with self._lock:
+            self._factor(dsl_class, name).hits += 1
+
+    def factor_error(self, dsl_class: type, name: str) -> None:
+        with self._lock:
+            self._factor(dsl_class, name).errors += 1
+
+    def resolve(
+        self,
+        context,
+        key: typing.Hashable,
+        scope: typing.Optional[str],
+        dsl_class: type,
+        name: str,
+        compute: typing.Callable,
+    ) -> typing.Any:
+        """context.resolve(key, scope, compute), recorded as a call or a hit of name"""
+        misses = context.misses
+        start = time.perf_counter()
+        try:
+            value = context.resolve(key, scope, compute)
+        except Exception:
+            self.factor_error(dsl_class, name)
+            raise
+        if context.misses == misses:
+            self.factor_hit(dsl_class, name)
+        else:
+            self.observe_factor(dsl_class, name, time.perf_counter() - start)
+        return value
+
+    def snapshot(self) -> dict:
+        """
+        Returns:
+            dict: {'rules': {'mysql:no_delete': {...}}, 'factors': {'mysql:sql_type': {...}}, 'caches': {...}}
+        """
+        from .cache import rule_cache
+
+        with self._lock:
+            rules = {
+                f'{type_}:{label}': {
+                    'type': type_,
+                    'label': label,
+                    'evaluations': stats.latency.count,
+                    'errors': stats.errors,
+                    'seconds': stats.latency.sum,
+                    'branches': dict(stats.branches),
+                    'latency': stats.latency.to_dict(),
+                }
+                for (type_, label), stats in self.rules.items()
+            }
+            factors = {}
+            hits = misses = 0
+            for (type_, name), stats in self.factors.items():
+                lookups = stats.hits + stats.calls
+                hits += stats.hits
+                misses += stats.calls
+                factors[f'{type_}:{name}'] = {
+                    'type': type_,
+                    'name': name,
+                    'calls': stats.calls,
+                    'hits': stats.hits,
+                    'errors': stats.errors,
+                    'hit_rate': stats.hits / lookups if lookups else 0.0,
+                    'seconds': stats.latency.sum,
+                    'latency': stats.latency.to_dict(),
+                }
+        lookups = hits + misses
+        caches = {
+            'facts': {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / lookups if lookups else 0.0,
+            }
+        }
+        if rule_cache is not None:
+            caches['rules'] = rule_cache.stats()
+        return {'rules': rules, 'factors': factors, 'caches': caches}
+
+    def prometheus(self, prefix: str = 'rule_dsl') -> str:
+        """snapshot() in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+
+        def family(name, kind, description):
+            lines.append(f'# HELP {prefix}_{name} {description}')
+            lines.append(f'# TYPE {prefix}_{name} {kind}')
+
+        def histogram(name, labels, data):
+            for bound, count in data['buckets']:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{prefix}_{name}_bucket{{{labels},le="{le}"}} {count}')
+            lines.append(f'{prefix}_{name}_sum{{{labels}}} {data["sum"]!r}')
+            lines.append(f'{prefix}_{name}_count{{{labels}}} {data["count"]}')
+
+        rules = [
+            (f'type="{_escape(item["type"])}",rule="{_escape(item["label"])}"', item)
+            for item in snapshot['rules'].values()
+        ]
+        factors = [
+            (f'type="{_escape(item["type"])}",factor="{_escape(item["name"])}"', item)
+            for item in snapshot['factors'].values()
+        ]
+        family('rule_evaluation_seconds', 'histogram', 'Rule evaluation latency.')
+        for labels, item in rules:
+            histogram('rule_evaluation_seconds', labels, item['latency'])
+        family('rule_errors_total', 'counter', 'Rule evaluations that raised.')
+        for labels, item in rules:
+            lines.append(f'{prefix}_rule_errors_total{{{labels}}} {item["errors"]}')
+        family('rule_branch_total', 'counter', 'Branch taken by the rule evaluations.')
+        for labels, item in rules:
+            for branch, count in item['branches'].items():
+                lines.append(f'{prefix}_rule_branch_total{{{labels},branch="{branch}"}} {count}')
+        family('factor_call_seconds', 'histogram', 'Latency of the @fac/@fun calls.')
+        for labels, item in factors:
+            histogram('factor_call_seconds', labels, item['latency'])
+        family('factor_hits_total', 'counter', 'Facts found in the evaluation context.')
+        for labels, item in factors:
+            lines.append(f'{prefix}_factor_hits_total{{{labels}}} {item["hits"]}')
+        family('factor_errors_total', 'counter', '@fac/@fun calls that raised.')
+        for labels, item in factors:
+            lines.append(f'{prefix}_factor_errors_total{{{labels}}} {item["errors"]}')
+        rule_cache = snapshot['caches'].get('rules')
+        if rule_cache is not None:
+            family('rule_cache_hits_total', 'counter', 'Compiled rules found in the rule cache.')
+            lines.append(f'{prefix}_rule_cache_hits_total {rule_cache["hits"]}')
+            family('rule_cache_misses_total', 'counter', 'Rules compiled by the rule cache.')
+            lines.append(f'{prefix}_rule_cache_misses_total {rule_cache["misses"]}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value: typing.Any) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+metrics = Metrics()
@@ -0,0 +1,204 @@
+"""
+Evaluate a CompiledRule or a RuleSet against a large stream of texts on
+several workers.
+
+The rule is pickled once per worker process (CompiledRule and RuleSet are
+pickled by grammar and compiled again in the worker), the texts are sent in
+chunks and the results are yielded in input order.
+"""
+import collections
+import concurrent.futures
+import itertools
+import os
+import threading
+import time
+import typing
+
+from . import common
+from .rule import CompiledRule
+from .ruleset import RuleSet
+
+__all__ = ('ParallelEvaluator', 'evaluate_parallel')
+
+Target = typing.Union[CompiledRule, RuleSet]
+
+# rule of the worker process, set by _init_worker
+_target = None
+
+
+def _init_worker(target: Target) -> None:
+    global _target
+    _target = target
+
+
+def _evaluate_chunk(
+    target: typing.Optional[Target],
+    texts: typing.List[str],
+    user: typing.Optional[common.User],
+) -> typing.Tuple[str, list, float]:
+    """
+    Returns:
+        tuple: (worker id, results of texts, seconds)
+    """
+    if target is None:
+        target = _target
+    start = time.perf_counter()
+    results = list(target.evaluate_many(texts, user))
+    seconds = time.perf_counter() - start
+    return f'{os.getpid()}-{threading.get_ident()}', results, seconds
+
+
+def _chunks(texts: typing.Iterable[str], size: int) -> typing.Iterator[list]:
+    iterator = iter(texts)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class ParallelEvaluator:
+    """
+    ```
+    with ParallelEvaluator(rule_set, workers=8) as evaluator:
+        for matches in evaluator.evaluate(texts, user):
+            ...
+        evaluator.stats()
+    ```
+
+    Args:
+        target (CompiledRule | RuleSet): rules to evaluate, their dsl class must
+            be importable by the worker processes (MysqlDSL, PgDSL, RedisDSL ...)
+        workers (int): number of workers, default os.cpu_count()
+        executor (str): 'process' for CPU bound factors,
+                        'thread' for I/O bound factors, the rule is not pickled
+        chunksize (int): texts sent to a worker at once
+        prefetch (int): chunks in flight per worker, bounds the memory used
+                        by a stream of texts
+    """
+
+    EXECUTORS = ('process', 'thread')
+
+    def __init__(
+        self,
+        target: Target,
+        workers: typing.Optional[int] = None,
+        executor: str = 'process',
+        chunksize: int = 1000,
+        prefetch: int = 2,
+    ):
+        if executor not in self.EXECUTORS:
+            raise ValueError(f'executor should be one of {self.EXECUTORS}')
+        if chunksize < 1:
+            raise ValueError('chunksize should be at least 1')
+        self.target = target
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = executor
+        self.chunksize = chunksize
+        self.prefetch = max(prefetch, 1)
+        self._pool = None
+        self._lock = threading.Lock()
+        self._workers = {}
+        self._texts = 0
+        self._seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def pool(self) -> concurrent.futures.Executor:
+        if self._pool is None:
+            if self.executor == 'process':
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    self.workers, initializer=_init_worker, initargs=(self.target,)
+                )
+            else:
+                self._pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+        return self._pool
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def evaluate(
+        self, texts: typing.Iterable[str], user: typing.Optional[common.User] = None
+    ) -> typing.Iterator[typing.Any]:
+        """
+        Args:
+            texts (Iterable[str]): consumed lazily, chunk by chunk
+            user (common.User): current user
+
+        Yields:
+            Decision | list[RuleMatch]: result of each text, in input order
+        """
+        # the thread workers share the rule of this process
+        target = self.target if self.executor == 'thread' else None
+        pool = self.pool
+        window = self.workers * self.prefetch
+        pending = collections.deque()
+        start = time.perf_counter()
+        try:
+            for chunk in _chunks(texts, self.chunksize):
+                pending.append(pool.submit(_evaluate_chunk, target, chunk, user))
+                if len(pending) >= window:
+                    yield from self._collect(pending.popleft())
+            while pending:
+                yield from self._collect(pending.popleft())
+        finally:
+            for future in pending:
+                future.cancel()
+            with self._lock:
+                self._seconds += time.perf_counter() - start
+
+    def evaluate_all(
+        self, texts: typing.Iterable[str], user: typing.Optional[common.User] = None
+    ) -> list:
+        return list(self.evaluate(texts, user))
+
+    def _collect(self, future: concurrent.futures.Future) -> list:
+        worker, results, seconds = future.result()
+        with self._lock:
+            stats = self._workers.setdefault(
+                worker, {'chunks': 0, 'texts': 0, 'seconds': 0.0}
+            )
+            stats['chunks'] += 1
+            stats['texts'] += len(results)
+            stats['seconds'] += seconds
+            self._texts += len(results)
+        return results
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: {'texts': ..., 'seconds': ..., 'throughput': texts per second,
+                   'workers': {worker id: {'chunks', 'texts', 'seconds', 'throughput'}}}
+        """
+        with self._lock:
+            workers = {
+                worker: {
+                    **stats,
+                    'throughput': stats['texts'] / stats['seconds'] if stats['seconds'] else 0.0,
+                }
+                for worker, stats in self._workers.items()
+            }
+            return {
+                'texts': self._texts,
+                'seconds': self._seconds,
+                'throughput': self._texts / self._seconds if self._seconds else 0.0,
+                'workers': workers,
+            }
+
+
+def evaluate_parallel(
+    target: Target,
+    texts: typing.Iterable[str],
+    user: typing.Optional[common.User] = None,
+    **options,
+) -> list:
+    """evaluate texts on a temporary ParallelEvaluator, results in input order"""
+    with ParallelEvaluator(target, **options) as evaluator:
+        return evaluator.evaluate_all(texts, user)
@@ -0,0 +1,164 @@
+"""
+Regex prefilter for `matchs` / `not matchs`.
+
+Every regex of a rule set is compiled once, and the literal string any match
+of it must contain is extracted from the parsed regex. For a value, one
+Aho-Corasick scan finds all the required literals it contains, the regexes
+whose literal is missing can not match and are not run.
+"""
+import re
+import typing
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:  # python < 3.11
+    import sre_constants
+    import sre_parse
+
+__all__ = ('required_literal', 'LiteralScanner', 'PatternSet')
+
+
+def _collect(items, literals: list) -> None:
+    run = []
+    for op, av in items:
+        if op is sre_constants.LITERAL:
+            run.append(chr(av))
+            continue
+        if run:
+            literals.append(''.join(run))
+            run = []
+        if op is sre_constants.SUBPATTERN:
+            # (group, add_flags, del_flags, pattern)
+            if not av[1] & re.IGNORECASE:
+                _collect(av[3], literals)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+            # (min, max, pattern), the pattern appears at least once
+            _collect(av[2], literals)
+    if run:
+        literals.append(''.join(run))
+
+
+def required_literal(pattern: str) -> typing.Optional[str]:
+    """the longest literal every match of pattern contains
+
+    Args:
+        pattern (str): ops_\\w+
+
+    Returns:
+        str: 'ops_', None when no literal is required
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+    except re.error:
+        return None
+    if parsed.state.flags & re.IGNORECASE:
+        return None
+    literals = []
+    _collect(parsed, literals)
+    if not literals:
+        return None
+    return max(literals, key=len)
+
+
+class LiteralScanner:
+    """Aho-Corasick automaton, finds all the literals contained in a text in one pass
+
+    Args:
+        literals (Iterable[str]): ['ops_', 'tmp_']
+    """
+
+    def __init__(self, literals: typing.Iterable[str]):
+        goto = [{}]
+        fail = [0]
+        output = [set()]
+        for literal in set(literals):
+            state = 0
+            for char in literal:
+                next_state = goto[state].get(char)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][char] = next_state
+                    goto.append({})
+                    fail.append(0)
+                    output.append(set())
+                state = next_state
+            output[state].add(literal)
+        # breadth first, the fail state of a node is shallower than the node
+        queue = list(goto[0].values())
+        for state in queue:
+            for char, next_state in goto[state].items():
+                queue.append(next_state)
+                fallback = fail[state]
+                while fallback and char not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[next_state] = goto[fallback].get(char, 0)
+                output[next_state] |= output[fail[next_state]]
+        self._goto = goto
+        self._fail = fail
+        self._output = output
+
+    def scan(self, text: str) -> typing.Set[str]:
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found |= output[state]
+        return found
+
+
+class PatternSet:
+    """
+    Regexes of the `matchs` / `not matchs` clauses of a rule set, with their
+    required literal and a LiteralScanner over all the literals.
+
+    Args:
+        patterns (Iterable[str]): ['ops_\\w+', '^tmp_\\d+$']
+    """
+
+    def __init__(self, patterns: typing.Iterable[str]):
+        self.literals = {}
+        for pattern in patterns:
+            self.literals[pattern] = required_literal(pattern)
+        self.scanner = LiteralScanner(
+            literal for literal in self.literals.values() if literal
+        )
+        self.scans = 0
+        self.skipped = 0
+
+    def __len__(self):
+        return len(self.literals)
+
+    def possible(self, pattern: str, value: str, context) -> bool:
+        """False when pattern can not match value, the value is scanned once per context
+
+        Args:
+            pattern (str): ops_\\w+
+            value (str): ops_tom
+            context (EvaluationContext): facts resolved for the text
+        """
+        literal = self.literals.get(pattern)
+        if literal is None:
+            return True
+        key = (PatternSet, value)
+        found = context.facts.get(key)
+        if found is None:
+            self.scans += 1
+            found = context.facts[key] = self.scanner.scan(value)
+        if literal in found:
+            return True
+        self.skipped += 1
+        return False
+
+    def stats(self) -> dict:
+        return {
+            'patterns': len(self.literals),
+            'with_literal': sum(1 for literal in self.literals.values() if literal),
+            'scans': self.scans,
+            'skipped': self.skipped,
+        }
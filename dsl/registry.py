@@ -0,0 +1,194 @@
+"""
+Registry of the dsl classes and of their @fac/@fun/@act factors.
+
+Every BaseEngine subclass defining a type_ is registered when the class is
+created (BaseEngine.__init_subclass__), at any depth of the class hierarchy.
+The runner module of a type_ is imported on first use of the type_, and the
+factor metadata of a class is built once from the class dicts of its MRO.
+"""
+import importlib
+import inspect
+import threading
+import typing
+
+from . import exceptions
+
+__all__ = ('DispatchTable', 'Registry', 'registry')
+
+# runner modules of the built-in types, imported on first use
+RUNNER_MODULES = {
+    'mysql': 'dsl.runner.mysql',
+    'postgres': 'dsl.runner.pg',
+    'redis': 'dsl.runner.redis',
+}
+
+
+class BoundedDict(dict):
+    """dict keeping at most maxsize items, the oldest item is dropped first"""
+
+    __slots__ = ('maxsize',)
+
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __setitem__(self, key, value):
+        if key not in self and len(self) >= self.maxsize:
+            try:
+                self.pop(next(iter(self)), None)
+            except (StopIteration, RuntimeError):
+                # emptied or changed by another thread
+                pass
+        super().__setitem__(key, value)
+
+
+class DispatchTable:
+    """
+    Functions of the @fac/@fun/@act of one dsl class by name, resolved once,
+    and the references of the engine (run_fac/run_fun/run_act/chose_runner)
+    parsed once per reference string; at most maxsize reference strings are
+    kept per kind, a process fed many distinct grammars parses the oldest again.
+
+    Args:
+        dsl_class (type): BaseDSL subclass
+    """
+
+    maxsize = 4096
+
+    def __init__(self, dsl_class: type):
+        self.dsl_class = dsl_class
+        members = {}
+        decorated = set()
+        for klass in reversed(dsl_class.__mro__):
+            for name, value in vars(klass).items():
+                members[name] = value
+                if getattr(value, '_dict', None):
+                    decorated.add(name)
+        # a plain method overriding a factor is still the factor
+        self.functions = {
+            name: members[name] for name in decorated if callable(members[name])
+        }
+        # {reference string: parsed reference}, filled by BaseDSL
+        self.runners = BoundedDict(self.maxsize)
+        self.facs = BoundedDict(self.maxsize)
+        self.funs = BoundedDict(self.maxsize)
+        self.acts = BoundedDict(self.maxsize)
+
+    def resolve(self, name: str) -> typing.Optional[typing.Callable]:
+        """function of the factor, None when the dsl class has no such method"""
+        function = self.functions.get(name)
+        if function is None:
+            function = getattr(self.dsl_class, name, None)
+            if not callable(function):
+                return None
+        return function
+
+
+class Registry:
+    """
+    Args:
+        modules (Mapping[str, str]): {type_: module defining the dsl class}
+    """
+
+    def __init__(self, modules: typing.Optional[typing.Mapping[str, str]] = None):
+        self.modules = dict(RUNNER_MODULES if modules is None else modules)
+        # {type_: dsl class}, utils.DSL_MAP
+        self.classes = {}
+        self._factors = {}
+        self._dispatch = {}
+        self._collected = None
+        self._lock = threading.RLock()
+
+    def register(self, dsl_class: type) -> None:
+        """called by BaseEngine.__init_subclass__ for a class defining type_"""
+        with self._lock:
+            self.classes[dsl_class.type_] = dsl_class
+            self._collected = None
+
+    def unregister(self, type_: str) -> None:
+        with self._lock:
+            self.classes.pop(type_, None)
+            self._collected = None
+
+    def register_module(self, type_: str, module: str) -> None:
+        """import module on first use of type_"""
+        self.modules[type_] = module
+
+    def __contains__(self, type_: str) -> bool:
+        return type_ in self.classes or type_ in self.modules
+
+    def get(self, type_: str) -> type:
+        """
+        Args:
+            type_ (str): mysql
+
+        Raises:
+            exceptions.DSLError: unknown type_
+
+        Returns:
+            type: MysqlDSL, its module is imported if needed
+        """
+        dsl_class = self.classes.get(type_)
+        if dsl_class is not None:
+            return dsl_class
+        module = self.modules.get(type_)
+        if module is not None:
+            importlib.import_module(module)
+            dsl_class = self.classes.get(type_)
+        if dsl_class is None:
+            raise exceptions.DSLError(f'no dsl class registered for type {type_!r}')
+        return dsl_class
+
+    def load(self, types: typing.Optional[typing.Iterable[str]] = None) -> typing.List[type]:
+        """import the runner modules of types, all known types by default"""
+        types = list(self.modules) if types is None else types
+        return [self.get(type_) for type_ in types]
+
+    def factors(self, dsl_class: type) -> typing.Tuple[dict, ...]:
+        """metadata of the @fac/@fun/@act of dsl_class, by name, built once per class"""
+        factors = self._factors.get(dsl_class)
+        if factors is not None:
+            return factors
+        members = {}
+        for klass in reversed(dsl_class.__mro__):
+            members.update(vars(klass))
+        factors = []
+        for name in sorted(members):
+            function = members[name]
+            _dict = getattr(function, '_dict', None) if inspect.isfunction(function) else None
+            if _dict:
+                factors.append(
+                    {
+                        'name': f'@{_dict["type"]}.{function.__name__}',
+                        'title': _dict['title'],
+                        'description': _dict['description'],
+                        'func_type': _dict['type'],
+                        'type': dsl_class.type_,
+                        'enabled': _dict['enabled'],
+                        'ctype': _dict['ctype'],
+                        **_dict,
+                    }
+                )
+        factors = self._factors[dsl_class] = tuple(factors)
+        return factors
+
+    def dispatch(self, dsl_class: type) -> DispatchTable:
+        """dispatch table of dsl_class, built once per class"""
+        table = self._dispatch.get(dsl_class)
+        if table is None:
+            table = self._dispatch[dsl_class] = DispatchTable(dsl_class)
+        return table
+
+    def collect(self) -> typing.List[dict]:
+        """factor metadata of all the registered classes, cached until a class is registered"""
+        with self._lock:
+            if self._collected is None:
+                self._collected = [
+                    factor
+                    for dsl_class in self.classes.values()
+                    for factor in self.factors(dsl_class)
+                ]
+            return list(self._collected)
+
+
+registry = Registry()
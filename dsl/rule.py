@@ -0,0 +1,410 @@
+import hashlib
+import time
+import typing
+
+from . import common, compiler, exceptions, expression
+from .context import EvaluationContext, run_async
+from .metrics import metrics
+from .trace import Trace, run_sampled, run_traced, tracer
+from .parser import ConditionParser, Parser
+
+__all__ = ('Decision', 'BatchDecisions', 'CompiledRule', 'evaluate_many')
+
+
+class Decision(typing.NamedTuple):
+    result: typing.Any
+    end_msg: tuple
+
+
+class BatchDecisions(typing.NamedTuple):
+    """results[i] and end_msgs[i] are the decision of texts[i]"""
+
+    results: list
+    end_msgs: list
+
+    def __len__(self):
+        return len(self.results)
+
+    def __iter__(self) -> typing.Iterator[Decision]:
+        return map(Decision, self.results, self.end_msgs)
+
+    def __getitem__(self, idx) -> Decision:
+        return Decision(self.results[idx], self.end_msgs[idx])
+
+
+def _identity(value) -> str:
+    """text of a class, function or option value, the same in every process"""
+    qualname = getattr(value, '__qualname__', None)
+    if qualname is not None:
+        return f'{value.__module__}:{qualname}'
+    return repr(value)
+
+
+class CompiledRule:
+    """A grammar parsed and validated once, evaluated against many texts.
+
+    ```
+    rule = MysqlDSL.compile(grammar)
+    decision = rule.evaluate('select * from table_name', user)
+    decision.result, decision.end_msg
+    ```
+
+    Args:
+        dsl_class (type): BaseDSL subclass, e.g. MysqlDSL
+        grammar (str): if ... then ... end
+        parser (Parser): grammar parser class
+        backend (str): 'closure' evaluates compiler closures,
+                       'tree' evaluates with the dsl tree_matcher (TreeMatcher)
+        reorder (bool): closure backend, evaluate the side-effect-free operands
+                        of and / or cheapest first, see dsl.cost; off by default,
+                        an operand written first to guard the next one would
+                        no longer be evaluated first
+        **options: keyword arguments passed to every dsl_class instance
+                   (tree_matcher, allow_no_params, log)
+    """
+
+    __slots__ = (
+        'dsl_class',
+        'grammar',
+        'parser',
+        'branches',
+        'digest',
+        'backend',
+        'reorder',
+        'nodes',
+        'program',
+        '_options',
+        '_traced',
+    )
+    BACKENDS = ('closure', 'tree')
+
+    def __init__(
+        self,
+        dsl_class: type,
+        grammar: str,
+        parser: Parser = ConditionParser,
+        backend: str = 'closure',
+        reorder: bool = False,
+        **options,
+    ):
+        if backend not in self.BACKENDS:
+            raise ValueError(f'backend should be one of {self.BACKENDS}')
+        branches = tuple(
+            tuple(branch) for branch in parser(grammar).parsed_string_list
+        )
+        self._build(dsl_class, grammar, parser, branches, None, backend, reorder, options)
+
+    @classmethod
+    def from_parsed(
+        cls,
+        dsl_class: type,
+        grammar: str,
+        branches: typing.Sequence[typing.Sequence],
+        nodes: typing.Optional[typing.Sequence] = None,
+        parser: Parser = ConditionParser,
+        backend: str = 'closure',
+        reorder: bool = False,
+        **options,
+    ) -> 'CompiledRule':
+        """a rule from branches and expression trees already parsed, e.g. by a RuleBundle
+
+        Args:
+            branches (Sequence): parsed_string_list of grammar
+            nodes (Sequence): expression tree of every branch condition, None for else,
+                              parsed again when not given
+        """
+        if backend not in cls.BACKENDS:
+            raise ValueError(f'backend should be one of {cls.BACKENDS}')
+        rule = cls.__new__(cls)
+        branches = tuple(tuple(branch) for branch in branches)
+        rule._build(dsl_class, grammar, parser, branches, nodes, backend, reorder, options)
+        return rule
+
+    def _build(self, dsl_class, grammar, parser, branches, nodes, backend, reorder, options):
+        # version of the rule: two dsl classes of one type_, or one grammar
+        # compiled with other options, evaluate differently
+        digest = hashlib.sha256(
+            '\0'.join(
+                [
+                    dsl_class.type_,
+                    _identity(dsl_class),
+                    _identity(parser),
+                    backend,
+                    repr(reorder),
+                    *(f'{key}={_identity(value)}' for key, value in sorted(options.items())),
+                    grammar,
+                ]
+            ).encode('utf-8')
+        ).hexdigest()
+        object.__setattr__(self, 'dsl_class', dsl_class)
+        object.__setattr__(self, 'grammar', grammar)
+        object.__setattr__(self, 'parser', parser)
+        object.__setattr__(self, 'branches', branches)
+        object.__setattr__(self, 'digest', digest)
+        object.__setattr__(self, 'backend', backend)
+        object.__setattr__(self, 'reorder', reorder)
+        object.__setattr__(self, '_options', tuple(options.items()))
+        program = None
+        if backend != 'closure':
+            nodes = None
+        else:
+            if nodes is None:
+                # expression tree of every branch condition, None for else
+                nodes = tuple(
+                    None if condition_str is True else expression.parse(condition_str)
+                    for condition_str, _ in branches
+                )
+            nodes = tuple(nodes)
+            allow_no_params = options.get('allow_no_params', False)
+            program = tuple(
+                (
+                    None
+                    if node is None
+                    else compiler.compile_node(dsl_class, node, reorder),
+                    compiler.compile_action(dsl_class, then_str, allow_no_params),
+                )
+                for node, (_, then_str) in zip(nodes, branches)
+            )
+        object.__setattr__(self, 'nodes', nodes)
+        object.__setattr__(self, 'program', program)
+        object.__setattr__(self, '_traced', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __reduce__(self):
+        # closures can not be pickled, the rule is compiled again when loaded
+        return _restore, (
+            type(self),
+            self.dsl_class,
+            self.grammar,
+            self.parser,
+            self.backend,
+            self.reorder,
+            self.options,
+        )
+
+    def __repr__(self):
+        return (
+            f'<{type(self).__name__} {self.dsl_class.__name__} '
+            f'{self.digest[:12]} branches={len(self.branches)} backend={self.backend}>'
+        )
+
+    @property
+    def type_(self) -> str:
+        return self.dsl_class.type_
+
+    @property
+    def options(self) -> dict:
+        return dict(self._options)
+
+    def bind(
+        self,
+        text: str,
+        user: typing.Optional[common.User] = None,
+        context: typing.Optional[EvaluationContext] = None,
+        facts: typing.Optional[typing.Mapping[str, typing.Any]] = None,
+    ):
+        """Create a dsl instance for one text, reusing the parsed branches
+
+        Args:
+            facts (Mapping): precomputed @fac/@fun values or thunks, used
+                             instead of the dsl class methods, see EvaluationContext.inject
+        """
+        if facts:
+            if context is None:
+                context = EvaluationContext()
+            context.inject(facts)
+        return self.dsl_class(
+            self.grammar,
+            text,
+            user,
+            parsed_string_list=self.branches,
+            context=context,
+            **dict(self._options),
+        )
+
+    def evaluate(
+        self,
+        text: str,
+        user: typing.Optional[common.User] = None,
+        context: typing.Optional[EvaluationContext] = None,
+        facts: typing.Optional[typing.Mapping[str, typing.Any]] = None,
+    ) -> Decision:
+        """
+        Args:
+            text (str): select * from table_name
+            user (common.User): current user
+            context (EvaluationContext): facts resolved for this text
+            facts (Mapping): precomputed facts, e.g. {'sql_type': 'select'}, see bind
+
+        Returns:
+            Decision: (match_tree() result, end_msg)
+        """
+        dsl = self.bind(text, user, context, facts)
+        if tracer.rate and tracer.sample():
+            return run_sampled(self._decide, dsl)
+        return self.run(dsl)[1]
+
+    def _decide(self, dsl) -> Decision:
+        return self.run(dsl)[1]
+
+    def explain(
+        self,
+        text: str,
+        user: typing.Optional[common.User] = None,
+        context: typing.Optional[EvaluationContext] = None,
+        facts: typing.Optional[typing.Mapping[str, typing.Any]] = None,
+    ) -> Trace:
+        """evaluate and record the conditions, factor values and branch taken
+
+        Returns:
+            Trace: trace.result is the Decision, see dsl.trace
+        """
+        return run_traced(self._decide, self.bind(text, user, context, facts))
+
+    async def evaluate_async(
+        self,
+        text: str,
+        user: typing.Optional[common.User] = None,
+        context: typing.Optional[EvaluationContext] = None,
+        facts: typing.Optional[typing.Mapping[str, typing.Any]] = None,
+    ) -> Decision:
+        """evaluate with async def @fac/@fun, see context.run_async
+
+        The async facts of an and/or group are resolved concurrently, those
+        still running when the condition is decided are cancelled.
+        """
+        if self.program is None:
+            raise ValueError('evaluate_async needs the closure backend')
+        return (await run_async(self.run, self.bind(text, user, context, facts)))[1]
+
+    def run(self, dsl, name=None, label=None) -> typing.Tuple[typing.Optional[int], Decision]:
+        """Evaluate on a dsl instance already bound to the text,
+        closure rules of the same dsl_class can share one instance (RuleSet)
+
+        Args:
+            name: name of the rule in traces, the start of digest by default
+            label (str): label of the rule in dsl.metrics, str(name) by default
+
+        Returns:
+            tuple: (index of the matched branch or None, Decision)
+        """
+        if not metrics.enabled:
+            return self._run(dsl, name)
+        if label is None:
+            label = self.digest[:12] if name is None else str(name)
+        start = time.perf_counter()
+        try:
+            branch, decision = self._run(dsl, name)
+        except exceptions.PendingFact:
+            # evaluated again once the async fact is resolved
+            raise
+        except Exception:
+            metrics.rule_error(self.type_, label)
+            raise
+        metrics.observe_rule(self.type_, label, branch, time.perf_counter() - start)
+        return branch, decision
+
+    def _run(self, dsl, name=None) -> typing.Tuple[typing.Optional[int], Decision]:
+        trace = dsl.context.trace
+        if trace is not None:
+            return self._run_traced(dsl, name, trace)
+        if self.program is None:
+            return self._run_tree(dsl)
+        return self._run_program(dsl, self.program)
+
+    def _run_tree(self, dsl) -> typing.Tuple[typing.Optional[int], Decision]:
+        if dsl.parsed_string_list is not self.branches:
+            dsl = self.bind(dsl.text_str, dsl.user, dsl.context)
+        result = dsl.match_tree()
+        matched = dsl.tree_matcher.matched
+        branch = None
+        if matched:
+            branch = next(
+                idx
+                for idx, item in enumerate(self.branches)
+                if item is matched['matched']
+            )
+        return branch, Decision(result, dsl.end_msg)
+
+    def _run_program(self, dsl, program: tuple) -> typing.Tuple[typing.Optional[int], Decision]:
+        dsl.grammar = self.grammar
+        dsl.end_msg = (None, '')
+        for idx, (condition, action) in enumerate(program):
+            if condition is None or condition(dsl):
+                return idx, Decision(action(dsl), dsl.end_msg)
+        return None, Decision(None, dsl.end_msg)
+
+    def _traced_program(self) -> tuple:
+        """program compiled with the tracing closures, built on first use"""
+        program = self._traced
+        if program is None:
+            program = []
+            for node, (condition_str, then_str), (_, action) in zip(
+                self.nodes, self.branches, self.program
+            ):
+                if node is None:
+                    condition = compiler.traced_closure('branch', 'else', lambda dsl: True)
+                else:
+                    condition = compiler.traced_closure(
+                        'branch',
+                        condition_str,
+                        compiler.compile_node(self.dsl_class, node, self.reorder, traced=True),
+                    )
+                program.append((condition, compiler.traced_closure('act', then_str, action)))
+            program = tuple(program)
+            object.__setattr__(self, '_traced', program)
+        return program
+
+    def _run_traced(self, dsl, name, trace) -> typing.Tuple[typing.Optional[int], Decision]:
+        step = trace.enter('rule', self.digest[:12] if name is None else name)
+        try:
+            if self.program is None:
+                # TreeMatcher records the branches, BaseDSL.chose_runner the runners
+                branch, decision = self._run_tree(dsl)
+            else:
+                branch, decision = self._run_program(dsl, self._traced_program())
+        except BaseException as err:
+            trace.fail(step, err)
+            raise
+        trace.exit(step, branch)
+        return branch, decision
+
+    def evaluate_many(
+        self, texts: typing.Iterable[str], user: typing.Optional[common.User] = None
+    ) -> BatchDecisions:
+        """Evaluate texts of one user, scope='user' facts are resolved once for all texts
+
+        Args:
+            texts (Iterable[str]): ['select * from t1', 'delete from t2']
+            user (common.User): current user
+
+        Returns:
+            BatchDecisions: ([True, False], [(True, ''), (False, 'only select')])
+        """
+        shared = {}
+        results = []
+        end_msgs = []
+        evaluate = self.evaluate
+        for text in texts:
+            result, end_msg = evaluate(text, user, EvaluationContext(shared))
+            results.append(result)
+            end_msgs.append(end_msg)
+        return BatchDecisions(results, end_msgs)
+
+
+def _restore(cls, dsl_class, grammar, parser, backend, reorder, options):
+    return cls(dsl_class, grammar, parser, backend, reorder, **options)
+
+
+def evaluate_many(
+    rule: CompiledRule,
+    texts: typing.Iterable[str],
+    user: typing.Optional[common.User] = None,
+) -> BatchDecisions:
+    """rule.evaluate_many(texts, user)"""
+    return rule.evaluate_many(texts, user)
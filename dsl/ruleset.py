@@ -0,0 +1,385 @@
+import hashlib
+import typing
+
+from . import common, compiler, expression
+from .context import EvaluationContext, run_async
+from .expression import And, Compare, Literal, Membership, Node, Ref
+from .patterns import PatternSet
+from .rule import CompiledRule, Decision
+from .trace import Trace, run_sampled, run_traced, tracer
+
+__all__ = ('RuleMatch', 'PredicateIndex', 'RuleSet')
+
+_MISSING = object()
+
+
+class RuleMatch(typing.NamedTuple):
+    name: typing.Any
+    branch: int
+    result: typing.Any
+    end_msg: tuple
+
+    @property
+    def decision(self) -> Decision:
+        return Decision(self.result, self.end_msg)
+
+
+def _plain(value: typing.Any) -> bool:
+    """a str compared as is by TreeMatcher: no quotes to strip, no float conversion"""
+    if not isinstance(value, str) or '"' in value or "'" in value:
+        return False
+    try:
+        float(value)
+    except ValueError:
+        return True
+    return False
+
+
+def _indexable(node: Node) -> typing.Optional[typing.Tuple[Ref, frozenset]]:
+    """
+    @fac.sql_type == "delete"             => (Ref('fac', 'sql_type'), {'delete'})
+    "delete" == @fac.sql_type             => (Ref('fac', 'sql_type'), {'delete'})
+    @fac.sql_type in ["update","delete"]  => (Ref('fac', 'sql_type'), {'update', 'delete'})
+    """
+    if isinstance(node, Compare) and node.op == '==':
+        for ref, literal in ((node.left, node.right), (node.right, node.left)):
+            if (
+                isinstance(ref, Ref)
+                and ref.kind != 'act'
+                and not ref.args
+                and isinstance(literal, Literal)
+                and _plain(literal.value)
+            ):
+                return ref, frozenset([literal.value])
+    elif (
+        isinstance(node, Membership)
+        and not node.negate
+        and isinstance(node.left, Ref)
+        and node.left.kind != 'act'
+        and not node.left.args
+        and isinstance(node.right, Literal)
+        and isinstance(node.right.value, list)
+    ):
+        try:
+            return node.left, frozenset(node.right.value)
+        except TypeError:
+            return None
+    return None
+
+
+def branch_predicate(node: Node) -> typing.Optional[typing.Tuple[Ref, frozenset]]:
+    """
+    The leading top-level and-operand when usable as an index predicate. The
+    index resolves its factor before the rule runs: a later operand is only
+    used when the operands before it reference no factor, a guard written
+    first (`@fac.table != "" and @fac.kind == "x"`) still runs first.
+    """
+    for item in node.operands if isinstance(node, And) else (node,):
+        predicate = _indexable(item)
+        if predicate:
+            return predicate
+        if any(isinstance(ref, Ref) for ref in expression.walk(item)):
+            return None
+    return None
+
+
+def rule_predicate(rule: CompiledRule) -> typing.Optional[typing.Tuple[Ref, frozenset]]:
+    """
+    A rule is indexed on @fac.name when every branch requires @fac.name to be
+    one of some values, the rule can not match for any other value.
+    Rules with an else branch or with the tree backend are not indexed.
+    """
+    if rule.nodes is None:
+        return None
+    ref = None
+    values = set()
+    for node in rule.nodes:
+        if node is None:
+            return None
+        predicate = branch_predicate(node)
+        if predicate is None:
+            return None
+        if ref is not None and predicate[0].name != ref.name:
+            return None
+        ref = predicate[0]
+        values |= predicate[1]
+    return ref, frozenset(values)
+
+
+class PredicateIndex:
+    """Hash index from factor values to the positions of the rules that can match
+
+    Args:
+        dsl_class (type): dsl class of the rules
+        rules (Sequence[CompiledRule]): rules in evaluation order
+    """
+
+    def __init__(self, dsl_class: type, rules: typing.Sequence[CompiledRule]):
+        self.keys = []
+        self.getters = {}
+        self.values = {}
+        self.unindexed = 0
+        for pos, rule in enumerate(rules):
+            predicate = rule_predicate(rule)
+            if predicate is None:
+                self.keys.append(None)
+                self.unindexed += 1
+                continue
+            ref, values = predicate
+            key = ref.name
+            self.keys.append(key)
+            if key not in self.getters:
+                self.getters[key] = compiler.compile_operand(dsl_class, ref)[1]
+                self.values[key] = {}
+            for value in values:
+                self.values[key].setdefault(value, set()).add(pos)
+        self.lookups = 0
+        self.fallbacks = 0
+        self.candidates = 0
+        self.skipped = 0
+
+    def lookup(self, key: str, dsl) -> typing.Optional[set]:
+        """
+        Returns:
+            set | None: positions of the candidate rules, None when every rule
+                        indexed on key has to be evaluated
+        """
+        self.lookups += 1
+        try:
+            value = self.getters[key](dsl)
+        except Exception:
+            # let the rules raise it when they are evaluated
+            value = None
+        if not _plain(value):
+            self.fallbacks += 1
+            return None
+        return self.values[key].get(value, frozenset())
+
+    def stats(self) -> dict:
+        indexed = len(self.keys) - self.unindexed
+        considered = self.candidates + self.skipped
+        return {
+            'rules': len(self.keys),
+            'indexed': indexed,
+            'unindexed': self.unindexed,
+            'keys': {key: len(values) for key, values in self.values.items()},
+            'lookups': self.lookups,
+            'fallbacks': self.fallbacks,
+            'candidates': self.candidates,
+            'skipped': self.skipped,
+            # share of the indexed rules skipped without being evaluated
+            'selectivity': self.skipped / considered if considered else 0.0,
+        }
+
+
+class RuleSet:
+    """Evaluate an ordered collection of rules against one text
+
+    All rules share one EvaluationContext per text, so every @fac/@fun call
+    with the same arguments is resolved once per text, whatever the number
+    of rules using it.
+
+    ```
+    rule_set = RuleSet({'global': rule1, 'team': rule2}, mode='first')
+    rule_set.evaluate('delete from table_name', user)
+    [RuleMatch(name='team', branch=0, result=False, end_msg=(False, 'no delete'))]
+    ```
+
+    Args:
+        rules (Iterable[CompiledRule] | Mapping[str, CompiledRule]): rules of
+            one dsl class, a sequence is named by index
+        mode (str): 'first': stop at the first rule with a matched branch
+                    'all': every rule with a matched branch
+                    'priority': like 'first', in descending priority order
+        priorities (Mapping): {rule name: priority}, default 0, only for 'priority'
+        index (bool): skip rules whose leading `@fac.name == value` or
+                      `@fac.name in [values]` predicates can not match,
+                      see PredicateIndex
+        prefilter (bool): skip the `matchs` regexes whose required literal is
+                          not in the value, see PatternSet
+    """
+
+    MODES = ('first', 'all', 'priority')
+
+    def __init__(
+        self,
+        rules: typing.Union[
+            typing.Iterable[CompiledRule], typing.Mapping[typing.Any, CompiledRule]
+        ],
+        mode: str = 'first',
+        priorities: typing.Optional[typing.Mapping[typing.Any, int]] = None,
+        index: bool = True,
+        prefilter: bool = True,
+    ):
+        if mode not in self.MODES:
+            raise ValueError(f'mode should be one of {self.MODES}')
+        named = isinstance(rules, typing.Mapping)
+        if named:
+            entries = list(rules.items())
+        else:
+            entries = list(enumerate(rules))
+        if not entries:
+            raise ValueError('RuleSet needs at least one rule')
+        dsl_classes = {rule.dsl_class for _, rule in entries}
+        if len(dsl_classes) != 1:
+            raise ValueError(
+                f'rules of a RuleSet should have the same dsl class, got {dsl_classes}'
+            )
+        if mode == 'priority':
+            priorities = priorities or {}
+            # sorted is stable, rules with the same priority keep their order
+            entries.sort(key=lambda entry: -priorities.get(entry[0], 0))
+        self.mode = mode
+        self.named = named
+        self.dsl_class = dsl_classes.pop()
+        self.entries = tuple(entries)
+        # version of the rule set: its mode, rule names and rule digests
+        self.digest = hashlib.sha256(
+            '\0'.join(
+                [mode, *(f'{name!r}={rule.digest}' for name, rule in self.entries)]
+            ).encode('utf-8')
+        ).hexdigest()
+        # labels of the rules in dsl.metrics, list indexes are prefixed by the rule set
+        self.labels = tuple(
+            str(name) if named else f'{self.digest[:12]}[{name}]' for name, _ in self.entries
+        )
+        self.priorities = dict(priorities or {})
+        self.index = (
+            PredicateIndex(self.dsl_class, [rule for _, rule in self.entries])
+            if index
+            else None
+        )
+        self.patterns = None
+        if prefilter:
+            regexes = [
+                regex
+                for _, rule in self.entries
+                for node in rule.nodes or ()
+                if node is not None
+                for item in expression.walk(node)
+                if isinstance(item, Compare)
+                for regex in (compiler.matchs_regex(item),)
+                if regex is not None
+            ]
+            if regexes:
+                self.patterns = PatternSet(regexes)
+
+    def __reduce__(self):
+        # the rules are pickled by grammar, the index and prefilter are built again
+        if self.named:
+            rules = dict(self.entries)
+        else:
+            # a sequence keeps its indexes as names, in the order it was given
+            rules = [rule for _, rule in sorted(self.entries, key=lambda entry: entry[0])]
+        return type(self), (
+            rules,
+            self.mode,
+            self.priorities,
+            self.index is not None,
+            self.patterns is not None,
+        )
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return f'<{type(self).__name__} {self.dsl_class.__name__} rules={len(self)} mode={self.mode}>'
+
+    @property
+    def type_(self) -> str:
+        return self.dsl_class.type_
+
+    def bind(
+        self,
+        text: str,
+        user: typing.Optional[common.User] = None,
+        context: typing.Optional[EvaluationContext] = None,
+        facts: typing.Optional[typing.Mapping[str, typing.Any]] = None,
+    ):
+        """one dsl instance shared by all rules for the text"""
+        if context is None:
+            context = EvaluationContext(patterns=self.patterns)
+        elif context.patterns is None:
+            context.patterns = self.patterns
+        return self.entries[0][1].bind(text, user, context, facts)
+
+    def evaluate(
+        self,
+        text: str,
+        user: typing.Optional[common.User] = None,
+        context: typing.Optional[EvaluationContext] = None,
+        facts: typing.Optional[typing.Mapping[str, typing.Any]] = None,
+    ) -> typing.List[RuleMatch]:
+        """
+        Args:
+            text (str): delete from table_name
+            user (common.User): current user
+            context (EvaluationContext): facts resolved for this text
+            facts (Mapping): precomputed facts, see CompiledRule.bind
+
+        Returns:
+            list: matched rules in evaluation order, at most one unless mode is 'all'
+        """
+        dsl = self.bind(text, user, context, facts)
+        if tracer.rate and tracer.sample():
+            return run_sampled(self.run, dsl)
+        return self.run(dsl)
+
+    def explain(
+        self,
+        text: str,
+        user: typing.Optional[common.User] = None,
+        context: typing.Optional[EvaluationContext] = None,
+        facts: typing.Optional[typing.Mapping[str, typing.Any]] = None,
+    ) -> Trace:
+        """evaluate and record every rule evaluated, trace.result is the list of RuleMatch"""
+        return run_traced(self.run, self.bind(text, user, context, facts))
+
+    async def evaluate_async(
+        self,
+        text: str,
+        user: typing.Optional[common.User] = None,
+        context: typing.Optional[EvaluationContext] = None,
+        facts: typing.Optional[typing.Mapping[str, typing.Any]] = None,
+    ) -> typing.List[RuleMatch]:
+        """evaluate with async def @fac/@fun, see CompiledRule.evaluate_async"""
+        if any(rule.program is None for _, rule in self.entries):
+            raise ValueError('evaluate_async needs the closure backend')
+        return await run_async(self.run, self.bind(text, user, context, facts))
+
+    def run(self, dsl) -> typing.List[RuleMatch]:
+        """evaluate the rules on a dsl instance already bound to the text"""
+        matches = []
+        first = self.mode != 'all'
+        index = self.index
+        candidates = {}
+        for pos, (name, rule) in enumerate(self.entries):
+            key = index.keys[pos] if index is not None else None
+            if key is not None:
+                allowed = candidates.get(key, _MISSING)
+                if allowed is _MISSING:
+                    allowed = candidates[key] = index.lookup(key, dsl)
+                if allowed is not None and pos not in allowed:
+                    index.skipped += 1
+                    continue
+                index.candidates += 1
+            branch, decision = rule.run(dsl, name, self.labels[pos])
+            if branch is None:
+                continue
+            matches.append(RuleMatch(name, branch, decision.result, decision.end_msg))
+            if first:
+                break
+        return matches
+
+    def index_stats(self) -> dict:
+        return self.index.stats() if self.index is not None else {}
+
+    def evaluate_many(
+        self, texts: typing.Iterable[str], user: typing.Optional[common.User] = None
+    ) -> typing.List[typing.List[RuleMatch]]:
+        """evaluate texts of one user, scope='user' facts are resolved once for all texts"""
+        shared = {}
+        return [
+            self.evaluate(text, user, EvaluationContext(shared, self.patterns))
+            for text in texts
+        ]
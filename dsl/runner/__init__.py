@@ -2,23 +2,27 @@ from dsl.utils import fac, fun
 
 
 class SQLCommonFAT:
-    @fac(title='SQL大类', enabled=True)
+    @fac(title='SQL大类', enabled=True, depends='fingerprint')
     def sql_type(self) -> str:
         return self.text.sql_type
 
-    @fac(title='可以执行的SQL类型')
+    @fac(title='可以执行的SQL类型', depends='none')
     def can_run_type(self) -> bool:
         return self.text.can_run_type
 
-    @fac(title='是否是管理员')
+    @fac(title='SQL指纹', depends='fingerprint')
+    def fingerprint(self) -> str:
+        return self.text.fingerprint
+
+    @fac(title='是否是管理员', scope='user', depends='user')
     def is_admin_user(self) -> bool:
         return getattr(self.text.user, 'pk', None) == 'admin'
 
-    @fun(rtype='int')
+    @fun(rtype='int', depends='text')
     def char_length(self) -> int:
         return len(self.text.value)
 
-    @fun(title='是否是小写字符')
+    @fun(title='是否是小写字符', depends='none')
     def is_char_lower(self, value: str) -> bool:
         """判断字符串是否是小写
 
@@ -0,0 +1,221 @@
+"""
+Fingerprint of a SQL statement: the statement with its literals replaced by
+`?`, comments and trailing `;` dropped, `IN (...)` lists collapsed to
+`in(?+)`, words lower-cased and the tokens spaced the same way whatever the
+whitespace of the statement. The body of the MySQL `/*! ... */` comments,
+run by MySQL, and of the `/*+ ... */` optimizer hints is kept. Statements
+differing only by their literals, comments or spacing have the same
+fingerprint:
+
+```
+fingerprint("SELECT * FROM t WHERE id IN (1, 2, 3) /* app */ AND name='a'")
+'select * from t where id in(?+) and name = ?'
+```
+
+The statement is read once from start to end: quoted strings and comments
+are skipped with str.find, the regexes only match words and numbers at a
+given position, nothing is backtracked on unterminated quotes or comments.
+"""
+import hashlib
+import re
+import typing
+
+__all__ = ('DIALECTS', 'fingerprint', 'hash_fingerprint', 'fingerprint_hash')
+
+DIALECTS = ('mysql', 'postgres')
+
+_SPACE = re.compile(r'\s+')
+_WORD = re.compile(r'[A-Za-z_\x80-\U0010ffff][A-Za-z0-9_$\x80-\U0010ffff]*')
+_NUMBER = re.compile(
+    r'0[xX][0-9a-fA-F]+|0[bB][01]+|(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][+-]?[0-9]+)?'
+)
+_WORD_CHAR = re.compile(r'[A-Za-z0-9_$\x80-\U0010ffff]+')
+_DOLLAR = re.compile(r'\$(?:([0-9]+)|([A-Za-z_][A-Za-z0-9_]*)?\$)')
+_OPERATOR = re.compile(r'[<>=!|&:~^]+')
+_VERSION = re.compile(r'[0-9]*')
+# prefixes of a quoted literal: E'\n', N'text', B'0101', X'ff'
+_LITERAL_PREFIXES = frozenset(['e', 'n', 'b', 'x'])
+# no space after these tokens, nor before the next ones
+_NO_SPACE_AFTER = frozenset(['(', '.', '@'])
+_NO_SPACE_BEFORE = frozenset([')', ',', '.', ';'])
+
+
+def _quoted_end(text: str, pos: int, quote: str, backslash: bool) -> int:
+    """end of the quoted string starting at pos, len(text) when it is not terminated"""
+    size = len(text)
+    pos += 1
+    while True:
+        end = text.find(quote, pos)
+        if end == -1:
+            return size
+        if backslash:
+            # an odd number of backslashes escapes the quote
+            slashes = 0
+            idx = end - 1
+            while idx >= pos and text[idx] == '\\':
+                slashes += 1
+                idx -= 1
+            if slashes % 2:
+                pos = end + 1
+                continue
+        if end + 1 < size and text[end + 1] == quote:
+            # doubled quote
+            pos = end + 2
+            continue
+        return end + 1
+
+
+def fingerprint(text: str, dialect: str = 'mysql') -> str:
+    """
+    Args:
+        text (str): 1. SELECT * FROM t1 WHERE id = 10
+                    2. select * from t1 where id = 20 -- comment
+        dialect (str): mysql: "..." is a string, # starts a comment, \\ escapes quotes,
+                              the body of /*! ... */ is part of the statement
+                       postgres: "..." is an identifier, $1 and $$...$$ are literals
+
+    Returns:
+        str: select * from t1 where id = ?
+    """
+    if dialect not in DIALECTS:
+        raise ValueError(f'dialect should be one of {DIALECTS}')
+    mysql = dialect == 'mysql'
+    out = []
+    # positions in out of the open parentheses
+    opened = []
+    # /*! and /*+ comments being read
+    executable = 0
+    pos = 0
+    size = len(text)
+    while pos < size:
+        char = text[pos]
+        if char.isspace():
+            pos = _SPACE.match(text, pos).end()
+            continue
+        if char == '-' and text.startswith('--', pos) and (
+            not mysql or pos + 2 == size or text[pos + 2].isspace()
+        ) or char == '#' and mysql:
+            end = text.find('\n', pos)
+            pos = size if end == -1 else end + 1
+            continue
+        if char == '/' and text.startswith('/*', pos):
+            if mysql and pos + 2 < size and text[pos + 2] in '!+':
+                # the body of /*!40101 ... */ is run by MySQL, /*+ ... */ are
+                # optimizer hints: their tokens are kept, the version is dropped
+                out.append(text[pos : pos + 3])
+                pos = _VERSION.match(text, pos + 3).end()
+                executable += 1
+                continue
+            end = text.find('*/', pos + 2)
+            pos = size if end == -1 else end + 2
+            continue
+        if char == '*' and executable and text.startswith('*/', pos):
+            out.append('*/')
+            pos += 2
+            executable -= 1
+            continue
+        if char == "'" or char == '"' and mysql:
+            pos = _quoted_end(text, pos, char, mysql)
+            out.append('?')
+        elif char == '"' or char == '`':
+            # quoted identifier, kept as is
+            end = _quoted_end(text, pos, char, False)
+            out.append(text[pos:end])
+            pos = end
+        elif char.isdigit() or char == '.' and pos + 1 < size and text[pos + 1].isdigit():
+            match = _NUMBER.match(text, pos)
+            rest = _WORD_CHAR.match(text, match.end())
+            if rest is not None and char != '.':
+                # 1abc is an identifier in MySQL
+                end = rest.end()
+                out.append(text[pos:end].lower())
+            else:
+                end = match.end()
+                out.append('?')
+            pos = end
+        elif char == '$' and not mysql and _DOLLAR.match(text, pos):
+            match = _DOLLAR.match(text, pos)
+            if match.group(1) is not None:
+                # $1 parameter
+                pos = match.end()
+            else:
+                tag = match.group()
+                end = text.find(tag, match.end())
+                pos = size if end == -1 else end + len(tag)
+            out.append('?')
+        elif char == '?':
+            out.append('?')
+            pos += 1
+        elif char == '(':
+            opened.append(len(out))
+            out.append('(')
+            pos += 1
+        elif char == ')':
+            pos += 1
+            start = opened.pop() if opened else None
+            if start is not None and _in_list(out, start):
+                del out[start:]
+                out.append('(?+)')
+            else:
+                out.append(')')
+        elif char in '<>=!|&:~^':
+            match = _OPERATOR.match(text, pos)
+            out.append(match.group())
+            pos = match.end()
+        else:
+            match = _WORD.match(text, pos)
+            if match is None:
+                out.append(char)
+                pos += 1
+                continue
+            word = match.group().lower()
+            pos = match.end()
+            if pos < size and text[pos] == "'" and word in _LITERAL_PREFIXES:
+                pos = _quoted_end(text, pos, "'", mysql or word == 'e')
+                out.append('?')
+            else:
+                out.append(word)
+    while out and out[-1] == ';':
+        out.pop()
+    return _join(out)
+
+
+def _in_list(out: typing.List[str], start: int) -> bool:
+    """out[start:] is `(?, ?, ...` after `in`"""
+    items = out[start + 1 :]
+    return (
+        start > 0
+        and out[start - 1] == 'in'
+        and '?' in items
+        and all(item == '?' or item == ',' for item in items)
+    )
+
+
+def _join(tokens: typing.List[str]) -> str:
+    """one space between tokens, none inside parentheses, before commas and around dots"""
+    parts = []
+    previous = None
+    for token in tokens:
+        if (
+            previous is not None
+            and previous not in _NO_SPACE_AFTER
+            and token not in _NO_SPACE_BEFORE
+            and not (token[0] == '(' and (previous == ')' or _WORD_CHAR.match(previous[-1])))
+        ):
+            parts.append(' ')
+        parts.append(token)
+        previous = token
+    return ''.join(parts)
+
+
+def hash_fingerprint(value: str) -> str:
+    """16 hex characters, the same in every process and Python version"""
+    return hashlib.blake2b(value.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def fingerprint_hash(text: str, dialect: str = 'mysql') -> str:
+    """
+    stable hash of the fingerprint, a cache key:
+    DecisionCache(fingerprint=fingerprint_hash)
+    """
+    return hash_fingerprint(fingerprint(text, dialect))
@@ -1,23 +1,28 @@
+import functools
+import typing
+
 from ..dsl import BaseCommonDSL
 from ..text_parser import BaseText
 from ..utils import fac
 from . import SQLCommonFAT
+from .fingerprint import fingerprint, hash_fingerprint
+from .sqlscan import statement_type
 
 
 class MysqlText(BaseText):
+    @functools.cached_property
+    def sql_type(self) -> typing.Optional[str]:
+        """type of the statement from its leading keyword, see sqlscan.statement_type"""
+        return statement_type(self.value)
+
+    @functools.cached_property
+    def fingerprint(self) -> str:
+        """statement with its literals replaced by ?, see fingerprint.fingerprint"""
+        return fingerprint(self.value, 'mysql')
+
     @property
-    def sql_type(self) -> str:
-        grammar_upper = self.value.upper()
-        sql_type = None
-        if 'SELECT' in grammar_upper:
-            sql_type = 'select'
-        elif 'UPDATE' in grammar_upper:
-            sql_type = 'update'
-        elif 'DELETE' in grammar_upper:
-            sql_type = 'delete'
-        elif 'INSERT' in grammar_upper:
-            sql_type = 'insert'
-        return sql_type
+    def fingerprint_hash(self) -> str:
+        return hash_fingerprint(self.fingerprint)
 
     @property
     def can_run_type(self) -> list:
@@ -28,6 +33,6 @@ class MysqlDSL(BaseCommonDSL, SQLCommonFAT):
     type_ = 'mysql'
     text_parser = MysqlText
 
-    @fac(rtype='dict')
+    @fac(rtype='dict', depends='none')
     def test_dict(self) -> dict:
         return {'a': 1, 'b': 2}
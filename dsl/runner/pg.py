@@ -1,16 +1,27 @@
+import functools
+
 from ..dsl import BaseCommonDSL
 from ..text_parser import BaseText
 from ..utils import fac
 from . import SQLCommonFAT
+from .fingerprint import fingerprint, hash_fingerprint
 
 
 class PgText(BaseText):
-    pass
+    @functools.cached_property
+    def fingerprint(self) -> str:
+        """statement with its literals replaced by ?, see fingerprint.fingerprint"""
+        return fingerprint(self.value, 'postgres')
+
+    @property
+    def fingerprint_hash(self) -> str:
+        return hash_fingerprint(self.fingerprint)
 
 
 class PgDSL(BaseCommonDSL, SQLCommonFAT):
     type_ = 'postgres'
+    text_parser = PgText
 
-    @fac(title='是否是管理员')
+    @fac(title='是否是管理员', scope='user', depends='user')
     def is_admin_user(self) -> bool:
         return self.text.user == 'admin'
@@ -1,20 +1,63 @@
+import functools
+
 from ..dsl import BaseCommonDSL
 from ..text_parser import BaseText
 from ..utils import fac
+from .resp import Command, RespError, parse_commands
 
 
 class RedisText(BaseText):
-    pass
+    """
+    value: a Command of evaluate_pipeline, RESP bytes or an inline command
+    such as 'GET key', holding one command
+    """
+
+    @functools.cached_property
+    def command(self) -> Command:
+        """
+        Raises:
+            RespError: the value holds more than one command, the commands of
+                       a pipeline are evaluated by resp.evaluate_pipeline
+        """
+        value = self.value
+        if isinstance(value, Command):
+            return value
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+            if not value.endswith(b'\n'):
+                value += b'\r\n'
+        commands = parse_commands(value)
+        if len(commands) > 1:
+            raise RespError(
+                f'{len(commands)} commands in one text, use evaluate_pipeline for pipelines'
+            )
+        return commands[0] if commands else Command('', (), 0, 0)
 
 
 class RedisDSL(BaseCommonDSL):
     type_ = 'redis'
     text_parser = RedisText
 
-    @fac
-    def cmd_type(self):
-        pass
+    @fac(title='命令', depends='fingerprint')
+    def cmd_type(self) -> str:
+        return self.text.command.name
+
+    @fac(title='key数量', rtype='int', depends='text')
+    def key_count(self) -> int:
+        return self.text.command.key_count
+
+    @fac(title='最大参数长度', rtype='int', depends='text')
+    def max_arg_size(self) -> int:
+        return max(self.text.command.arg_sizes, default=0)
+
+    @fac(title='是否阻塞命令', depends='fingerprint')
+    def is_blocking(self) -> bool:
+        return self.text.command.is_blocking
+
+    @fac(title='是否遍历或清空keyspace', depends='fingerprint')
+    def is_keyspace_scan(self) -> bool:
+        return self.text.command.is_keyspace_scan
 
-    @fac
+    @fac(scope='user', depends='user')
     def user_is_admin(self):
         return self.text.user.pk == 'admin'
@@ -0,0 +1,510 @@
+"""
+Parse the commands of a Redis pipeline from the RESP bytes sent by the client
+and evaluate rules against every command.
+
+The arguments of a command are memoryview slices of the received bytes: the
+values are never copied, only their sizes are read. Inline commands
+(`PING\\r\\n`, sent by telnet and redis-cli) are read too.
+
+```
+rule = RedisDSL.compile(grammar)
+for command, decision in evaluate_pipeline(rule, data, user):
+    if decision.result is False:
+        print(command.name, command.start, decision.end_msg)
+```
+
+The commands returned by parse_commands and RespParser.feed reference the
+data passed in, which should not be changed while they are used.
+"""
+import typing
+
+from .. import common, exceptions
+from ..context import EvaluationContext
+
+__all__ = (
+    'RespError',
+    'Command',
+    'RespParser',
+    'parse_commands',
+    'command_keys',
+    'evaluate_pipeline',
+    'BLOCKING_COMMANDS',
+    'KEYSPACE_COMMANDS',
+)
+
+Data = typing.Union[bytes, bytearray, memoryview]
+
+# '$' + 20 digits + CRLF
+_MAX_HEADER = 24
+# same limits as the redis server defaults
+_MAX_BULK = 512 * 1024 * 1024
+_MAX_INLINE = 64 * 1024
+
+BLOCKING_COMMANDS = frozenset(
+    [
+        'blpop',
+        'brpop',
+        'brpoplpush',
+        'blmove',
+        'blmpop',
+        'bzpopmin',
+        'bzpopmax',
+        'bzmpop',
+        'wait',
+        'waitaof',
+    ]
+)
+# commands reading or dropping the whole keyspace
+KEYSPACE_COMMANDS = frozenset(['keys', 'scan', 'flushall', 'flushdb'])
+
+# (first, last, step) positions of the keys in the arguments, from 1 like the
+# COMMAND reply of the server; a negative last counts from the end. Commands
+# missing here and from _NO_KEYS have one key, their first argument.
+_KEY_SPECS = {
+    'mset': (1, -1, 2),
+    'msetnx': (1, -1, 2),
+    'blpop': (1, -2, 1),
+    'brpop': (1, -2, 1),
+    'bzpopmin': (1, -2, 1),
+    'bzpopmax': (1, -2, 1),
+    'object': (2, 2, 1),
+}
+_KEY_SPECS.update(
+    dict.fromkeys(
+        [
+            'mget',
+            'del',
+            'unlink',
+            'exists',
+            'touch',
+            'watch',
+            'sinter',
+            'sunion',
+            'sdiff',
+            'sinterstore',
+            'sunionstore',
+            'sdiffstore',
+            'pfcount',
+            'pfmerge',
+        ],
+        (1, -1, 1),
+    )
+)
+_KEY_SPECS.update(
+    dict.fromkeys(
+        ['rename', 'renamenx', 'rpoplpush', 'brpoplpush', 'lmove', 'blmove', 'smove', 'copy'],
+        (1, 2, 1),
+    )
+)
+# position of numkeys, the keys follow it; a destination key comes first
+_NUMKEYS = {
+    'eval': (2, False),
+    'evalsha': (2, False),
+    'eval_ro': (2, False),
+    'evalsha_ro': (2, False),
+    'fcall': (2, False),
+    'fcall_ro': (2, False),
+    'zunion': (1, False),
+    'zinter': (1, False),
+    'zdiff': (1, False),
+    'zintercard': (1, False),
+    'sintercard': (1, False),
+    'lmpop': (1, False),
+    'zmpop': (1, False),
+    'blmpop': (2, False),
+    'bzmpop': (2, False),
+    'zunionstore': (2, True),
+    'zinterstore': (2, True),
+    'zdiffstore': (2, True),
+}
+_NO_KEYS = frozenset(
+    [
+        'acl',
+        'auth',
+        'bgrewriteaof',
+        'bgsave',
+        'client',
+        'cluster',
+        'command',
+        'config',
+        'dbsize',
+        'debug',
+        'discard',
+        'echo',
+        'exec',
+        'failover',
+        'flushall',
+        'flushdb',
+        'function',
+        'hello',
+        'info',
+        'keys',
+        'lastsave',
+        'latency',
+        'lolwut',
+        'memory',
+        'module',
+        'monitor',
+        'multi',
+        'ping',
+        'psubscribe',
+        'psync',
+        'publish',
+        'pubsub',
+        'punsubscribe',
+        'quit',
+        'randomkey',
+        'readonly',
+        'readwrite',
+        'replicaof',
+        'reset',
+        'role',
+        'save',
+        'scan',
+        'script',
+        'select',
+        'shutdown',
+        'slaveof',
+        'slowlog',
+        'spublish',
+        'ssubscribe',
+        'subscribe',
+        'sunsubscribe',
+        'swapdb',
+        'sync',
+        'time',
+        'unsubscribe',
+        'unwatch',
+        'wait',
+        'waitaof',
+    ]
+)
+
+
+class RespError(exceptions.DSLError):
+    """malformed or truncated RESP data"""
+
+
+class _Incomplete(Exception):
+    """
+    the data ends inside a command
+
+    needed: size the data should reach before parsing again
+    state: (start, count, spans, pos) of the array being read, to resume it
+    """
+
+    def __init__(self, needed: int, state: typing.Optional[tuple] = None):
+        super().__init__(needed)
+        self.needed = needed
+        self.state = state
+
+
+def _lower(value: memoryview) -> bytes:
+    return value.tobytes().lower()
+
+
+def _int(value: memoryview) -> int:
+    try:
+        return int(value.tobytes())
+    except ValueError:
+        return -1
+
+
+def command_keys(name: str, args: typing.Sequence[memoryview]) -> typing.Tuple[int, ...]:
+    """
+    Args:
+        name (str): mset
+        args (Sequence): arguments after the command name, [b'k1', b'v1', b'k2', b'v2']
+
+    Returns:
+        tuple: indexes of the keys in args, (0, 2)
+    """
+    size = len(args)
+    if name in _NO_KEYS or not size:
+        return ()
+    if name in _NUMKEYS:
+        position, destination = _NUMKEYS[name]
+        if size < position:
+            return ()
+        count = _int(args[position - 1])
+        if count < 0:
+            return ()
+        keys = tuple(range(position, min(position + count, size)))
+        return ((0,) + keys) if destination else keys
+    if name in ('xread', 'xreadgroup'):
+        for idx, arg in enumerate(args):
+            if len(arg) == 7 and _lower(arg) == b'streams':
+                # STREAMS key [key ...] id [id ...]
+                count = (size - idx - 1) // 2
+                return tuple(range(idx + 1, idx + 1 + count))
+        return ()
+    first, last, step = _KEY_SPECS.get(name, (1, 1, 1))
+    if last < 0:
+        last += size + 1
+    return tuple(range(first - 1, min(last, size), step))
+
+
+class Command(typing.NamedTuple):
+    """
+    name: command name, lower case: get
+    args: arguments after the name, memoryview slices of the data
+    start, end: byte offsets of the command in the data
+    """
+
+    name: str
+    args: typing.Tuple[memoryview, ...]
+    start: int
+    end: int
+
+    def __str__(self):
+        args = ' '.join(arg.tobytes().decode('utf-8', 'replace') for arg in self.args)
+        return f'{self.name.upper()} {args}' if args else self.name.upper()
+
+    @property
+    def keys(self) -> typing.Tuple[memoryview, ...]:
+        return tuple(self.args[idx] for idx in command_keys(self.name, self.args))
+
+    @property
+    def key_count(self) -> int:
+        return len(command_keys(self.name, self.args))
+
+    @property
+    def arg_sizes(self) -> typing.Tuple[int, ...]:
+        return tuple(len(arg) for arg in self.args)
+
+    @property
+    def is_blocking(self) -> bool:
+        if self.name in BLOCKING_COMMANDS:
+            return True
+        if self.name in ('xread', 'xreadgroup'):
+            for arg in self.args:
+                if len(arg) == 7 and _lower(arg) == b'streams':
+                    break
+                if len(arg) == 5 and _lower(arg) == b'block':
+                    return True
+        return False
+
+    @property
+    def is_keyspace_scan(self) -> bool:
+        return self.name in KEYSPACE_COMMANDS
+
+
+def _header(view: memoryview, pos: int, prefix: int) -> typing.Tuple[int, int]:
+    """(value, position after CRLF) of the `*3\\r\\n` / `$5\\r\\n` line at pos"""
+    chunk = view[pos : pos + _MAX_HEADER].tobytes()
+    end = chunk.find(b'\r\n')
+    if end == -1:
+        if len(chunk) < _MAX_HEADER:
+            raise _Incomplete(len(view) + 1)
+        raise RespError(f'header too long at {pos}')
+    digits = chunk[1:end]
+    if chunk[0] != prefix or not digits.isdigit():
+        raise RespError(f'expected {chr(prefix)}<length> at {pos}: {chunk[:end]!r}')
+    return int(digits), pos + end + 2
+
+
+def _inline(view: memoryview, pos: int) -> typing.Tuple[typing.List[memoryview], int]:
+    """arguments and end of the inline command at pos"""
+    size = len(view)
+    stop = min(size, pos + _MAX_INLINE)
+    line = view[pos:stop].tobytes()
+    end = line.find(b'\n')
+    if end == -1:
+        if stop == size:
+            raise _Incomplete(size + 1)
+        raise RespError(f'inline command too long at {pos}')
+    args = []
+    idx = 0
+    length = end - 1 if end and line[end - 1] == 13 else end
+    while idx < length:
+        if line[idx] in b' \t':
+            idx += 1
+            continue
+        word_end = idx
+        while word_end < length and line[word_end] not in b' \t':
+            word_end += 1
+        args.append(view[pos + idx : pos + word_end])
+        idx = word_end
+    return args, pos + end + 1
+
+
+def _parse(
+    view: memoryview, pos: int, state: typing.Optional[tuple] = None
+) -> typing.Tuple[typing.Optional[Command], int]:
+    """
+    the command starting at pos, None for an empty command
+
+    Args:
+        state (tuple): _Incomplete.state of the command, its bulk strings
+                       already read are not read again
+
+    Raises:
+        _Incomplete: the data ends inside the command
+    """
+    size = len(view)
+    if state is not None:
+        start, count, spans, pos = state
+    elif view[pos] != 42:
+        start = pos
+        args, pos = _inline(view, pos)
+        if not args:
+            return None, pos
+        name = args[0].tobytes().decode('latin-1').lower()
+        return Command(name, tuple(args[1:]), start, pos), pos
+    else:
+        start = pos
+        count, pos = _header(view, pos, 42)
+        spans = []
+    while len(spans) < count:
+        try:
+            length, data = _header(view, pos, 36)
+        except _Incomplete:
+            raise _Incomplete(size + 1, (start, count, spans, pos)) from None
+        if length > _MAX_BULK:
+            raise RespError(f'bulk string of {length} bytes at {data}')
+        end = data + length
+        if end + 2 > size:
+            raise _Incomplete(end + 2, (start, count, spans, pos))
+        if view[end] != 13 or view[end + 1] != 10:
+            raise RespError(f'bulk string not ended by CRLF at {end}')
+        spans.append((data, end))
+        pos = end + 2
+    if not spans:
+        return None, pos
+    name = view[spans[0][0] : spans[0][1]].tobytes().decode('latin-1').lower()
+    args = tuple(view[data:end] for data, end in spans[1:])
+    return Command(name, args, start, pos), pos
+
+
+def _shift(state: typing.Optional[tuple], delta: int) -> typing.Optional[tuple]:
+    if state is None or not delta:
+        return state
+    start, count, spans, pos = state
+    return start + delta, count, [(data + delta, end + delta) for data, end in spans], pos + delta
+
+
+def parse_commands(data: Data) -> typing.List[Command]:
+    """
+    Args:
+        data (bytes): *1\\r\\n$4\\r\\nPING\\r\\n*2\\r\\n$3\\r\\nGET\\r\\n$1\\r\\nk\\r\\n
+
+    Raises:
+        RespError: the data is malformed or ends inside a command
+
+    Returns:
+        list: [Command('ping', (), 0, 14), Command('get', (<memory>,), 14, 33)]
+    """
+    view = memoryview(data)
+    if view.format != 'B':
+        view = view.cast('B')
+    commands = []
+    pos = 0
+    size = len(view)
+    while pos < size:
+        try:
+            command, pos = _parse(view, pos)
+        except _Incomplete:
+            raise RespError(f'truncated command at {pos}') from None
+        if command is not None:
+            commands.append(command)
+    return commands
+
+
+class RespParser:
+    """
+    Incremental parser, feed() the bytes as they are received:
+
+    ```
+    parser = RespParser()
+    for chunk in chunks:
+        for command in parser.feed(chunk):
+            ...
+    parser.close()
+    ```
+
+    A command split between chunks is buffered and parsed once the bytes it
+    needs are received: a bulk string received in many chunks is read once,
+    the bulk strings already read are not read again. The other commands
+    are views of their chunk. Offsets count from the first byte fed.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # size _buffer should reach before parsing again
+        self._needed = 0
+        # _Incomplete.state of the command in _buffer
+        self._state = None
+        # offset of _buffer in the bytes fed
+        self._offset = 0
+
+    def feed(self, chunk: Data) -> typing.List[Command]:
+        buffer = self._buffer
+        if buffer:
+            buffer += chunk
+            if len(buffer) < self._needed:
+                return []
+            # the commands are views of the buffer, a new buffer is used afterwards
+            view = memoryview(buffer)
+            self._buffer = bytearray()
+        else:
+            view = memoryview(chunk)
+            if view.format != 'B':
+                view = view.cast('B')
+        offset = self._offset
+        state, self._state = self._state, None
+        commands = []
+        pos = 0
+        size = len(view)
+        while pos < size:
+            try:
+                command, end = _parse(view, pos, state)
+            except _Incomplete as err:
+                if pos == 0 and view.obj is buffer:
+                    # nothing parsed, the buffer is kept and grows
+                    view.release()
+                    self._buffer = buffer
+                else:
+                    self._buffer = bytearray(view[pos:])
+                self._needed = err.needed - pos
+                self._state = _shift(err.state, -pos)
+                break
+            state = None
+            if command is not None:
+                commands.append(
+                    command._replace(start=command.start + offset, end=command.end + offset)
+                    if offset
+                    else command
+                )
+            pos = end
+        self._offset = offset + pos
+        return commands
+
+    def close(self) -> None:
+        """
+        Raises:
+            RespError: the data fed ends inside a command
+        """
+        if self._buffer:
+            raise RespError(f'truncated command at {self._offset}')
+
+
+def evaluate_pipeline(
+    target,
+    data: typing.Union[Data, typing.Iterable[Command]],
+    user: typing.Optional[common.User] = None,
+) -> typing.List[typing.Tuple[Command, typing.Any]]:
+    """
+    Args:
+        target (CompiledRule | RuleSet): rules of a RedisDSL evaluated against every command
+        data (bytes | Iterable[Command]): RESP bytes of the pipeline or parsed commands
+        user (common.User): current user, scope='user' facts are resolved once
+
+    Returns:
+        list: [(Command, Decision | list[RuleMatch])] in pipeline order
+    """
+    commands = parse_commands(data) if isinstance(data, (bytes, bytearray, memoryview)) else data
+    shared = {}
+    return [
+        (command, target.evaluate(command, user, EvaluationContext(shared)))
+        for command in commands
+    ]
@@ -0,0 +1,303 @@
+"""
+Split a MySQL script or dump into statements and evaluate them one by one.
+
+The script is read in chunks, only the statement being read is kept in
+memory: the memory used depends on the longest statement, not on the size of
+the script. Quotes, comments and the `DELIMITER` command of the mysql client
+are handled like the client does; `/*! ... */` comments, run by MySQL, are
+statements like any other: `/*!40101 SET NAMES utf8 */;` is yielded.
+
+```
+rule = MysqlDSL.compile(grammar)
+with open('dump.sql', 'rb') as script:
+    for statement, decision in evaluate_script(rule, script, user):
+        if decision.result is False:
+            print(statement.line, statement.start, decision.end_msg)
+```
+"""
+import codecs
+import mmap
+import os
+import re
+import typing
+
+from .. import common
+from ..context import EvaluationContext
+
+__all__ = ('Statement', 'StatementSplitter', 'split_statements', 'evaluate_script')
+
+Source = typing.Union[str, bytes, bytearray, memoryview, mmap.mmap, os.PathLike, typing.IO]
+
+_DELIMITER_COMMAND = re.compile(r'delimiter[ \t]+(\S+)[^\n]*(?:\n|\Z)', re.I)
+_QUOTE_END = {
+    "'": re.compile(r"\\|'"),
+    '"': re.compile(r'\\|"'),
+    '`': re.compile(r'`'),
+}
+
+
+class Statement(typing.NamedTuple):
+    """
+    text: statement without its delimiter and surrounding whitespace
+    start, end: character offsets of text in the script
+    line: line of start, from 1
+    """
+
+    text: str
+    start: int
+    end: int
+    line: int
+
+
+class StatementSplitter:
+    """
+    Incremental splitter, feed() chunks of the script then close():
+
+    ```
+    splitter = StatementSplitter()
+    for chunk in chunks:
+        yield from splitter.feed(chunk)
+    yield from splitter.close()
+    ```
+
+    Args:
+        delimiter (str): statement delimiter, changed by `DELIMITER //` lines
+    """
+
+    def __init__(self, delimiter: str = ';'):
+        self.delimiter = delimiter
+        self._special = self._compile(delimiter)
+        # text received, scanned up to self._pos; self._offset is the offset of _pos
+        self._buffer = ''
+        self._pos = 0
+        self._offset = 0
+        self._line = 1
+        # None, a quote, '\n' in a line comment, '*/' in a block comment
+        self._state = None
+        self._reset()
+
+    @staticmethod
+    def _compile(delimiter: str) -> typing.Pattern:
+        return re.compile(re.escape(delimiter) + r"""|['"`#]|--|/\*""")
+
+    def _reset(self) -> None:
+        self._pieces = []
+        self._start = self._offset
+        self._start_line = self._line
+        self._code = False
+
+    def _advance(self, end: int) -> str:
+        piece = self._buffer[self._pos : end]
+        self._pos = end
+        self._offset += len(piece)
+        self._line += piece.count('\n')
+        return piece
+
+    def _consume(self, end: int, code: bool = False) -> None:
+        """add the text up to end to the statement"""
+        piece = self._advance(end)
+        if not piece:
+            return
+        self._pieces.append(piece)
+        if code and not self._code and not piece.isspace():
+            self._code = True
+
+    def _skip(self, end: int) -> None:
+        """drop the text up to end, it belongs to no statement"""
+        self._advance(end)
+        self._reset()
+
+    def _emit(self) -> typing.Optional[Statement]:
+        if not self._code:
+            return None
+        raw = ''.join(self._pieces)
+        text = raw.strip()
+        leading = raw[: len(raw) - len(raw.lstrip())]
+        start = self._start + len(leading)
+        line = self._start_line + leading.count('\n')
+        return Statement(text, start, start + len(text), line)
+
+    def feed(self, chunk: str) -> typing.Iterator[Statement]:
+        self._buffer = self._buffer[self._pos :] + chunk
+        self._pos = 0
+        return self._scan(final=False)
+
+    def close(self) -> typing.Iterator[Statement]:
+        yield from self._scan(final=True)
+        self._consume(len(self._buffer), code=self._state is None)
+        statement = self._emit()
+        self._reset()
+        if statement is not None:
+            yield statement
+
+    def _scan(self, final: bool) -> typing.Iterator[Statement]:
+        buffer = self._buffer
+        size = len(buffer)
+        while self._pos < size:
+            pos = self._pos
+            state = self._state
+            if state is None:
+                if not self._code:
+                    waiting, consumed = self._delimiter_command(final)
+                    if waiting:
+                        return
+                    if consumed:
+                        continue
+                match = self._special.search(buffer, pos)
+                if match is None:
+                    # a delimiter or a comment start may continue in the next chunk
+                    keep = 0 if final else max(len(self.delimiter), 2) - 1
+                    self._consume(max(size - keep, pos), code=True)
+                    return
+                token = match.group()
+                if token == '--':
+                    if match.end() == size and not final:
+                        self._consume(match.start(), code=True)
+                        return
+                    if match.end() < size and not buffer[match.end()].isspace():
+                        # --x is not a comment
+                        self._consume(match.end(), code=True)
+                        continue
+                    state = '\n'
+                elif token == '#':
+                    state = '\n'
+                elif token == '/*':
+                    if match.end() == size and not final:
+                        # /*! may be split between two chunks
+                        self._consume(match.start(), code=True)
+                        return
+                    state = '*/'
+                elif token in _QUOTE_END:
+                    state = token
+                self._consume(match.start(), code=True)
+                if state is None:
+                    # the delimiter ends the statement
+                    statement = self._emit()
+                    self._skip(match.end())
+                    if statement is not None:
+                        yield statement
+                    continue
+                # the body of /*! ... */ is run by MySQL, /*+ ... */ are optimizer hints
+                self._consume(
+                    match.end(),
+                    code=state in _QUOTE_END or buffer.startswith(('/*!', '/*+'), match.start()),
+                )
+                self._state = state
+                continue
+            if state in _QUOTE_END:
+                match = _QUOTE_END[state].search(buffer, pos)
+                if match is None:
+                    self._consume(size)
+                    return
+                if match.group() == '\\':
+                    if match.end() == size:
+                        # the escaped character is in the next chunk
+                        self._consume(size if final else match.start())
+                        return
+                    self._consume(match.end() + 1)
+                    continue
+                self._consume(match.end())
+                self._state = None
+                continue
+            end = buffer.find(state, pos)
+            if end == -1:
+                # '*/' may be split between two chunks
+                keep = 0 if final else len(state) - 1
+                self._consume(max(size - keep, pos))
+                return
+            self._consume(end + len(state))
+            self._state = None
+
+    def _delimiter_command(self, final: bool) -> typing.Tuple[bool, bool]:
+        """
+        `DELIMITER //` before any code of the statement, comments may precede it
+
+        Returns:
+            tuple: (waiting for more text, command consumed)
+        """
+        buffer = self._buffer
+        pos = self._pos
+        start = pos
+        while start < len(buffer) and buffer[start].isspace():
+            start += 1
+        word = buffer[start : start + 10].lower()
+        if not final and len(word) < 10 and 'delimiter '.startswith(word):
+            return True, False
+        if not (word.startswith('delimiter') and word[9:10] in (' ', '\t')):
+            return False, False
+        match = _DELIMITER_COMMAND.match(buffer, start)
+        if match is None or not (final or match.group().endswith('\n')):
+            return not final, False
+        self.delimiter = match.group(1)
+        self._special = self._compile(self.delimiter)
+        self._skip(match.end())
+        return False, True
+
+
+def _chunks(source: Source, chunksize: int, encoding: str) -> typing.Iterator[str]:
+    if isinstance(source, str):
+        for pos in range(0, len(source), chunksize):
+            yield source[pos : pos + chunksize]
+        return
+    if isinstance(source, os.PathLike):
+        with open(source, 'rb') as file:
+            yield from _chunks(file, chunksize, encoding)
+        return
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+        view = memoryview(source)
+        try:
+            for pos in range(0, len(view), chunksize):
+                yield decoder.decode(view[pos : pos + chunksize])
+        finally:
+            view.release()
+    else:
+        while True:
+            chunk = source.read(chunksize)
+            if not chunk:
+                break
+            yield decoder.decode(chunk) if isinstance(chunk, (bytes, bytearray)) else chunk
+    yield decoder.decode(b'', final=True)
+
+
+def split_statements(
+    source: Source,
+    delimiter: str = ';',
+    chunksize: int = 1 << 16,
+    encoding: str = 'utf-8',
+) -> typing.Iterator[Statement]:
+    """
+    Args:
+        source: str, bytes, mmap, path, text or binary file
+        delimiter (str): initial statement delimiter
+        chunksize (int): characters or bytes read at once
+        encoding (str): encoding of a binary source
+
+    Yields:
+        Statement: statements in script order, offsets are in characters
+    """
+    splitter = StatementSplitter(delimiter)
+    for chunk in _chunks(source, chunksize, encoding):
+        yield from splitter.feed(chunk)
+    yield from splitter.close()
+
+
+def evaluate_script(
+    target,
+    source: Source,
+    user: typing.Optional[common.User] = None,
+    **options,
+) -> typing.Iterator[typing.Tuple[Statement, typing.Any]]:
+    """
+    Args:
+        target (CompiledRule | RuleSet): rules evaluated against every statement
+        source: see split_statements
+        user (common.User): current user, scope='user' facts are resolved once
+        **options: split_statements options
+
+    Yields:
+        tuple: (Statement, Decision | list[RuleMatch])
+    """
+    shared = {}
+    for statement in split_statements(source, **options):
+        yield statement, target.evaluate(statement.text, user, EvaluationContext(shared))
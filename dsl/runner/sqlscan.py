@@ -0,0 +1,134 @@
+"""
+Classify a MySQL statement from its leading keyword.
+
+The statement is scanned from the start with one regex, skipping whitespace,
+comments and parentheses, until the keyword deciding its type: the text is
+neither copied nor upper-cased, only the keyword is.
+"""
+import re
+import typing
+
+__all__ = ('STATEMENT_TYPES', 'statement_type')
+
+# leading keyword: statement type
+STATEMENT_TYPES = {
+    'SELECT': 'select',
+    'TABLE': 'select',
+    'VALUES': 'select',
+    'INSERT': 'insert',
+    'REPLACE': 'replace',
+    'UPDATE': 'update',
+    'DELETE': 'delete',
+    'LOAD': 'load',
+    'CALL': 'call',
+    'DO': 'do',
+    'HANDLER': 'handler',
+    'IMPORT': 'import',
+    'CREATE': 'create',
+    'ALTER': 'alter',
+    'DROP': 'drop',
+    'RENAME': 'rename',
+    'TRUNCATE': 'truncate',
+    'GRANT': 'grant',
+    'REVOKE': 'revoke',
+    'SHOW': 'show',
+    'DESC': 'describe',
+    'DESCRIBE': 'describe',
+    'EXPLAIN': 'explain',
+    'HELP': 'help',
+    'USE': 'use',
+    'SET': 'set',
+    'START': 'begin',
+    'BEGIN': 'begin',
+    'COMMIT': 'commit',
+    'ROLLBACK': 'rollback',
+    'SAVEPOINT': 'savepoint',
+    'RELEASE': 'release',
+    'LOCK': 'lock',
+    'UNLOCK': 'unlock',
+    'XA': 'xa',
+    'PREPARE': 'prepare',
+    'EXECUTE': 'execute',
+    'DEALLOCATE': 'deallocate',
+    'ANALYZE': 'analyze',
+    'CHECK': 'check',
+    'CHECKSUM': 'checksum',
+    'OPTIMIZE': 'optimize',
+    'REPAIR': 'repair',
+    'FLUSH': 'flush',
+    'KILL': 'kill',
+    'RESET': 'reset',
+    'PURGE': 'purge',
+    'CHANGE': 'change',
+    'INSTALL': 'install',
+    'UNINSTALL': 'uninstall',
+    'CACHE': 'cache',
+    'BINLOG': 'binlog',
+    'CLONE': 'clone',
+    'SHUTDOWN': 'shutdown',
+    'RESTART': 'restart',
+    'SIGNAL': 'signal',
+    'RESIGNAL': 'resignal',
+    'GET': 'get',
+}
+# statements following the common table expressions of WITH
+WITH_STATEMENTS = frozenset(['SELECT', 'TABLE', 'VALUES', 'UPDATE', 'DELETE'])
+
+_TOKEN = re.compile(
+    r"""
+    (?P<skip>
+        \s+
+        | (?:--(?=\s|\Z)|\#)[^\n]*
+        | /\*(?!!).*?(?:\*/|\Z)
+        | /\*!\d*           # executable comment, its body is part of the statement
+        | \*/
+    )
+    | (?P<word>[A-Za-z_][A-Za-z0-9_$]*)
+    | (?P<quoted>'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*"|`(?:[^`]|``)*`)
+    | (?P<open>\()
+    | (?P<close>\))
+    | (?P<other>.)
+    """,
+    re.S | re.X,
+)
+
+
+def statement_type(text: str) -> typing.Optional[str]:
+    """
+    Args:
+        text (str): 1. /* app */ SELECT * FROM table_name
+                    2. INSERT INTO t1 SELECT * FROM t2
+                    3. WITH t AS (SELECT 1) DELETE FROM t1 WHERE ...
+
+    Returns:
+        str: 'select', 'insert', 'delete', None for an unknown statement
+    """
+    depth = 0
+    with_depth = None
+    match = _TOKEN.match
+    pos = 0
+    end = len(text)
+    while pos < end:
+        token = match(text, pos)
+        pos = token.end()
+        kind = token.lastgroup
+        if kind == 'skip':
+            continue
+        if kind == 'open':
+            depth += 1
+            continue
+        if kind == 'close':
+            depth -= 1
+            continue
+        if with_depth is None:
+            if kind != 'word':
+                return None
+            keyword = token.group().upper()
+            if keyword != 'WITH':
+                return STATEMENT_TYPES.get(keyword)
+            with_depth = depth
+        elif kind == 'word' and depth == with_depth:
+            keyword = token.group().upper()
+            if keyword in WITH_STATEMENTS:
+                return STATEMENT_TYPES[keyword]
+    return None
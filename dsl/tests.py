@@ -1,9 +1,47 @@
 import logging
+import sys
+
+import pytest
 
 from .log import logger
 logger.setLevel(logging.DEBUG)
 
 
+def make_dsl(name: str, calls: list = None, base: type = None, **factors) -> type:
+    """
+    A subclass of base (MysqlDSL) for a test. Every keyword is a factor: a
+    decorator (fac, fun(cost=1000), act) wrapping the method of base of that
+    name, or (decorator, result) where result is a value or a function
+    called with the dsl instance and the arguments. The name of every factor
+    run is appended to calls.
+
+    ```
+    calls = []
+    CountingDSL = make_dsl('CountingDSL', calls, sql_type=fac, owner=(fun(cost=1000), 'tom'))
+    ```
+    """
+    if base is None:
+        from dsl.runner.mysql import MysqlDSL
+
+        base = MysqlDSL
+
+    def factor(factor_name, spec):
+        decorator, result = spec if isinstance(spec, tuple) else (spec, getattr(base, factor_name))
+
+        def run(self, *args, **kwargs):
+            if calls is not None:
+                calls.append(factor_name)
+            return result(self, *args, **kwargs) if callable(result) else result
+
+        run.__name__ = factor_name
+        return decorator(run)
+
+    namespace = {key: factor(key, spec) for key, spec in factors.items()}
+    # qualified like a class defined in the test, rule digests include it
+    namespace['__qualname__'] = f'{sys._getframe(1).f_code.co_name}.<locals>.{name}'
+    return type(name, (base,), namespace)
+
+
 def test_parse_string():
     from .parser import ConditionParser
     string = """if
@@ -257,4 +295,1304 @@ def test_regex():
     assert md.end_msg == (True, 'success')
 
 
+def test_compiled_rule():
+    from dsl.runner.mysql import MysqlDSL
+    from dsl import exceptions
+    string = """
+    if
+    @fac.sql_type == "select"
+    then
+    @act.allow_execute select ok
+    else
+    @act.reject_execute only select
+    end
+    """
+    rule = MysqlDSL.compile(string)
+    assert rule.branches == (('@fac.sql_type == "select"', '@act.allow_execute select ok'), (True, '@act.reject_execute only select'))
+    assert rule.evaluate('select * from table_name') == (True, (True, 'select ok'))
+    assert rule.evaluate('delete from table_name') == (False, (False, 'only select'))
+    with pytest.raises(AttributeError):
+        rule.grammar = ''
+    with pytest.raises(exceptions.DSLError):
+        MysqlDSL.compile('@fac.sql_type == "select"')
+
+
+def test_rule_cache():
+    from dsl.cache import RuleCache
+    from dsl.runner.mysql import MysqlDSL
+    cache = RuleCache(maxsize=2)
+    grammars = [f'if\n@fac.sql_type == "{t}"\nthen\n@act.allow_execute\nend' for t in ('select', 'update', 'delete')]
+    rule = cache.get_or_compile(MysqlDSL, grammars[0])
+    assert cache.get_or_compile(MysqlDSL, grammars[0]) is rule
+    cache.get_or_compile(MysqlDSL, grammars[1])
+    cache.get_or_compile(MysqlDSL, grammars[2])
+    stats = cache.stats()
+    assert (stats['size'], stats['hits'], stats['misses'], stats['evictions']) == (2, 1, 3, 1)
+    assert cache.get_or_compile(MysqlDSL, grammars[0]) is not rule
+    assert cache.invalidate('mysql', grammars[0]) == 1
+    # rules are only measured with maxbytes
+    assert cache.stats()['bytes'] == 0
+    cache.configure(maxsize=None, maxbytes=1 << 20)
+    assert len(cache) == 1 and cache.stats()['bytes'] > 0
+    cache.configure(maxsize=None, maxbytes=1)
+    assert len(cache) == 0 and cache.stats()['evictions'] == 3
+
+    md = MysqlDSL(grammars[0], 'select * from table_name')
+    assert md.parsed_string_list is MysqlDSL.compile(grammars[0], backend='tree').branches
+
+
+PARITY_GRAMMARS = [
+    """
+    if
+    "select" == @fac.sql_type
+    then
+    @act.reject_execute '只能执行查询语句'
+    elseif
+    @fun.char_length > 1 and @fac.sql_type in ["select","insert"]
+    then
+    @act.allow_execute
+    end
+    """,
+    """
+    if
+    @fun.char_length < 1 and @fac.sql_type == "select2" or "" or @fac.sql_type not in ["delete"]
+    then
+    @act.allow_execute
+    end
+    """,
+    """
+    if
+    44 == @fac.char_length
+    then
+    @act.allow_execute
+    elseif
+    @fac.sql_type not in ["select"] and @fac.sql_type != "delete"
+    then
+    @act.allow_execute allow select
+    elseif
+    @fac.test_dict == {"a":1,"b":2}
+    then
+    @act.allow_execute dict ok
+    else
+    @act.reject_execute
+    end
+    """,
+    """
+    if
+    (1 and False) and 4 or (False or 5) and 4 > 20
+    then
+    @act.allow_execute
+    elseif
+    (1 or False) and True and ()
+    then
+    @act.allow_execute 1
+    elseif
+    ((@fac.sql_type == "update" or @fac.char_length > 10) and (@fun.is_admin_user or "a" in ["a"]))
+    then
+    @act.allow_execute nested
+    else
+    @act.reject_execute reject
+    end
+    """,
+    """
+    if
+    "idx_aa" matchs "idx_\\w+" and "idx_aa" not matchs "^a" and @fun.is_char_lower("UPPER") == false
+    then
+    @act.allow_execute success
+    else
+    @act.reject_execute failed
+    end
+    """,
+]
+
+
+def test_closure_backend_parity():
+    from dsl.matcher import ExpressionMatcher
+    from dsl.runner.mysql import MysqlDSL
+    texts = ['select * from table_name', 'update t set a = 1', 'delete from t', 'DELETE']
+    for grammar in PARITY_GRAMMARS:
+        closure = MysqlDSL.compile(grammar, allow_no_params=True)
+        tree = MysqlDSL.compile(grammar, backend='tree', allow_no_params=True)
+        assert closure.program is not None and tree.program is None
+        for text in texts:
+            md = MysqlDSL(grammar, text, allow_no_params=True)
+            expected = (md.match_tree(), md.end_msg)
+            assert closure.evaluate(text) == expected
+            assert tree.evaluate(text) == expected
+            md = MysqlDSL(grammar, text, allow_no_params=True, tree_matcher=ExpressionMatcher)
+            assert (md.match_tree(), md.end_msg) == expected
+
+
+def test_expression_parser():
+    from dsl import exceptions
+    from dsl.expression import And, Compare, Literal, Membership, Or, Ref, parse
+    node = parse('@fac.sql_type in ["select","update"] and (@fun.char_length < 1000 or @fac.is_admin_user)')
+    assert node == And((
+        Membership(False, Ref('fac', 'sql_type', source='@fac.sql_type'), Literal(['select', 'update'], '["select","update"]')),
+        Or((
+            Compare('<', Ref('fun', 'char_length', source='@fun.char_length'), Literal('1000', '1000')),
+            Ref('fac', 'is_admin_user', source='@fac.is_admin_user'),
+        )),
+    ))
+    assert parse('@fun.is_char_lower(@fac.sql_type, "A")').args == (Ref('fac', 'sql_type', source='@fac.sql_type'), Literal('A', '"A"'))
+    assert parse('@fac.user == "log in" or "a b" not in "[a b]"').operands[0].right == Literal('log in', '"log in"')
+    nested = '(' * 200 + '@fac.sql_type == "select"' + ')' * 200
+    assert parse(nested) == Compare('==', Ref('fac', 'sql_type', source='@fac.sql_type'), Literal('select', '"select"'))
+    for invalid in ('@fac.sql_type not in ["select"] and', '(@fac.sql_type', '@fac.sql_type = 1', ''):
+        with pytest.raises(exceptions.GrammarError):
+            parse(invalid)
+
+
+def test_evaluate_many():
+    from dsl.common import User
+    from dsl.rule import evaluate_many
+    from dsl.utils import fac
+
+    calls = []
+    CountingDSL = make_dsl('CountingDSL', calls, is_admin_user=fac(scope='user'))
+
+    string = """
+    if
+    @fac.is_admin_user or @fac.sql_type == "select"
+    then
+    @act.allow_execute
+    else
+    @act.reject_execute only select
+    end
+    """
+    rule = CountingDSL.compile(string)
+    texts = ['select * from t1', 'delete from t2', 'update t3 set a = 1']
+    decisions = evaluate_many(rule, texts, user=User(pk='tom'))
+    assert calls == ['is_admin_user']
+    assert decisions.results == [True, False, False]
+    assert decisions.end_msgs == [(True, ''), (False, 'only select'), (False, 'only select')]
+    assert list(decisions) == [rule.evaluate(text, User(pk='tom')) for text in texts]
+
+
+def test_rule_set():
+    from dsl.ruleset import RuleSet
+    from dsl.runner.mysql import MysqlDSL
+    from dsl.utils import fac
+
+    calls = []
+    CountingDSL = make_dsl('CountingDSL', calls, sql_type=fac)
+    rules = {
+        'no_delete': CountingDSL.compile('if\n@fac.sql_type == "delete"\nthen\n@act.reject_execute no delete\nend'),
+        'no_drop': CountingDSL.compile('if\n@fac.sql_type in ["drop","truncate"]\nthen\n@act.reject_execute no drop\nend'),
+        'small': CountingDSL.compile('if\n@fac.sql_type != "select" and @fun.char_length < 100\nthen\n@act.allow_execute small\nend'),
+        'tree': CountingDSL.compile('if\n@fac.sql_type == "delete"\nthen\n@act.allow_execute tree\nend', backend='tree'),
+    }
+    text = 'delete from table_name'
+    assert RuleSet(rules).evaluate(text) == [('no_delete', 0, False, (False, 'no delete'))]
+    assert calls == ['sql_type']
+    assert RuleSet(rules, mode='all').evaluate(text) == [
+        ('no_delete', 0, False, (False, 'no delete')),
+        ('small', 0, True, (True, 'small')),
+        ('tree', 0, True, (True, 'tree')),
+    ]
+    matches = RuleSet(rules, mode='priority', priorities={'small': 10}).evaluate(text)
+    assert [match.name for match in matches] == ['small']
+    assert RuleSet(rules).evaluate('select 1') == []
+    with pytest.raises(ValueError):
+        RuleSet([rules['no_delete'], MysqlDSL.compile('if\ntrue\nthen\n@act.allow_execute\nend')])
+
+
+def test_rule_set_index():
+    from dsl.ruleset import RuleSet
+    from dsl.runner.mysql import MysqlDSL
+    grammars = {
+        'delete': 'if\n@fac.sql_type == "delete"\nthen\n@act.reject_execute no delete\nend',
+        'write': 'if\n@fac.sql_type in ["update","delete"] and @fun.char_length > 1000\nthen\n@act.reject_execute too long\nelseif\n"insert" == @fac.sql_type\nthen\n@act.allow_execute insert\nend',
+        'else': 'if\n@fac.sql_type == "select"\nthen\n@act.allow_execute\nelse\n@act.allow_execute else\nend',
+        'any': 'if\n@fun.char_length > 0\nthen\n@act.allow_execute any\nend',
+    }
+    rules = {name: MysqlDSL.compile(grammar) for name, grammar in grammars.items()}
+    indexed = RuleSet(rules, mode='all')
+    plain = RuleSet(rules, mode='all', index=False)
+    assert indexed.index.keys == ['sql_type', 'sql_type', None, None]
+    for text in ('select 1', 'delete from t', 'insert into t values (1)', 'update t set a = 1'):
+        assert indexed.evaluate(text) == plain.evaluate(text)
+    stats = indexed.index_stats()
+    assert (stats['indexed'], stats['unindexed'], stats['keys']) == (2, 2, {'sql_type': 3})
+    assert (stats['lookups'], stats['fallbacks'], stats['skipped'], stats['candidates']) == (4, 0, 4, 4)
+    assert stats['selectivity'] == 0.5
+    assert plain.index_stats() == {}
+
+
+def test_regex_prefilter():
+    from dsl.common import User
+    from dsl.patterns import LiteralScanner, required_literal
+    from dsl.ruleset import RuleSet
+    from dsl.utils import fac
+
+    UserDSL = make_dsl('UserDSL', user=(fac, lambda dsl: dsl.text.user.pk))
+
+    assert [required_literal(p) for p in ('ops_\\w+', '^tmp_\\d+$', '(a|b)cd', '(?i)ops', '\\w+')] == ['ops_', 'tmp_', 'cd', None, None]
+    assert LiteralScanner(['he', 'she', 'his', 'hers']).scan('ushers') == {'she', 'he', 'hers'}
+    rules = [
+        UserDSL.compile('if\n@fac.user matchs "ops_\\w+"\nthen\n@act.allow_execute ops\nend'),
+        UserDSL.compile('if\n@fac.user matchs "dba_\\w+" or @fac.user matchs "\\w+_admin$"\nthen\n@act.allow_execute dba\nend'),
+        UserDSL.compile('if\n@fac.user not matchs "^tmp_"\nthen\n@act.reject_execute not tmp\nend'),
+    ]
+    rule_set = RuleSet(rules, mode='all')
+    plain = RuleSet(rules, mode='all', prefilter=False)
+    assert len(rule_set.patterns) == 4 and plain.patterns is None
+    for pk in ('ops_tom', 'dba_jerry', 'tom_admin', 'tmp_1', 'guest'):
+        user = User(pk=pk)
+        assert rule_set.evaluate('select 1', user) == plain.evaluate('select 1', user)
+    stats = rule_set.patterns.stats()
+    assert stats['with_literal'] == 4 and stats['scans'] == 5 and stats['skipped'] > 0
+
+
+def test_literal_constants():
+    from dsl.utils import fac, fun
+
+    ValueDSL = make_dsl(
+        'ValueDSL',
+        value=(fac, lambda dsl: dsl.text.user),
+        size=(fun, lambda dsl: len(dsl.text.value)),
+    )
+
+    names = ','.join(f'"t{i}"' for i in range(1000))
+    string = f"""
+    if
+    @fac.value in [{names}] and @fac.value not in {{"t1": 1}}
+    then
+    @act.allow_execute member
+    elseif
+    @fac.value in [[1, 2], {{"a": 1}}] or @fun.size >= 10 and @fun.size < "13"
+    then
+    @act.allow_execute fallback
+    end
+    """
+    closure = ValueDSL.compile(string)
+    tree = ValueDSL.compile(string, backend='tree')
+    assert closure.evaluate('select 1', 't999') == (True, (True, 'member'))
+    for text, value in (('select 1', 't1'), ('x', [1, 2]), ('x', {'a': 1}), ('select 12', None), ('select 1234', 't')):
+        assert closure.evaluate(text, value) == tree.evaluate(text, value)
+
+
+def test_evaluation_context_cache():
+    from dsl.context import EvaluationContext
+    from dsl.utils import act, fac
+
+    calls = []
+    CountingDSL = make_dsl('CountingDSL', calls, sql_type=fac(), allow_execute=act())
+
+    string = """
+    if
+    @fac.sql_type == "delete"
+    then
+    @act.reject_execute
+    elseif
+    @fac.sql_type == "select" and @fac.sql_type != "update"
+    then
+    @act.allow_execute
+    end
+    """
+    context = EvaluationContext()
+    md = CountingDSL(string, 'select * from table_name', context=context)
+    md.match_tree()
+    assert md.end_msg == (True, '')
+    md.run_act('@act.allow_execute')
+    assert calls == ['sql_type', 'allow_execute', 'allow_execute']
+    assert context.stats()['misses'] == 1 and context.stats()['hits'] == 2
+
+    context = EvaluationContext()
+    CountingDSL.compile(string).evaluate('select * from table_name', context=context)
+    assert (context.hits, context.misses) == (2, 1)
+
+
+def test_cost_order():
+    from dsl.cost import cost_model
+    from dsl.utils import fac, fun
+
+    calls = []
+    LookupDSL = make_dsl(
+        'LookupDSL', calls, table_owner=(fun(cost=1000), 'tom'), audit=(fac(pure=False), True)
+    )
+
+    string = """
+    if
+    @fun.table_owner == "tom" and @fac.sql_type == "select"
+    then
+    @act.allow_execute
+    elseif
+    @fac.audit and @fun.table_owner == "tom" and @fac.sql_type == "update"
+    then
+    @act.allow_execute
+    end
+    """
+    rule = LookupDSL.compile(string, reorder=True)
+    assert rule.evaluate('delete from table_name').result is None
+    # @fac.audit keeps its place, the cheap sql_type checks run before table_owner
+    assert calls == ['audit']
+
+    calls.clear()
+    rule = LookupDSL.compile(string)
+    assert rule.evaluate('delete from table_name').result is None
+    assert calls == ['table_owner', 'audit']
+
+    cost_model.learn = True
+    try:
+        rule.evaluate('select * from table_name')
+    finally:
+        cost_model.learn = False
+    assert (LookupDSL, 'table_owner') in cost_model.observed
+    cost_model.reset()
+
+
+def test_evaluate_async():
+    import asyncio
+    import time
+
+    from dsl.exceptions import RunnerError
+    from dsl.runner.mysql import MysqlDSL
+    from dsl.utils import fac
+
+    events = []
+
+    class AsyncDSL(MysqlDSL):
+        @fac()
+        async def user_role(self) -> str:
+            events.append('user_role')
+            await asyncio.sleep(0.01)
+            events.append('user_role done')
+            return 'dba'
+
+        @fac()
+        async def table_exists(self) -> bool:
+            events.append('table_exists')
+            await asyncio.sleep(0.01)
+            events.append('table_exists done')
+            return True
+
+        @fac()
+        async def slow_lookup(self) -> bool:
+            await asyncio.sleep(10)
+            return False
+
+    string = """
+    if
+    @fac.user_role == "dba" and @fac.table_exists
+    then
+    @act.allow_execute
+    elseif
+    @fac.slow_lookup or @fac.sql_type == "delete"
+    then
+    @act.reject_execute no delete
+    end
+    """
+    rule = AsyncDSL.compile(string, reorder=False)
+
+    decision = asyncio.run(rule.evaluate_async('select * from table_name'))
+    assert decision == (True, (True, ''))
+    # both lookups run concurrently
+    assert events[:2] == ['user_role', 'table_exists']
+
+    class DeleteDSL(AsyncDSL):
+        @fac()
+        async def user_role(self) -> str:
+            return 'dev'
+
+    events.clear()
+    rule = DeleteDSL.compile(string, reorder=False)
+    start = time.perf_counter()
+    decision = asyncio.run(rule.evaluate_async('delete from table_name'))
+    assert decision.end_msg == (False, 'no delete')
+    # decided by @fac.sql_type, the slow lookup and the unneeded table_exists are cancelled
+    assert time.perf_counter() - start < 1
+    assert 'table_exists done' not in events
+
+    with pytest.raises(RunnerError):
+        rule.evaluate('delete from table_name')
+
+
+def test_parallel_evaluator():
+    import pickle
+
+    from dsl.parallel import ParallelEvaluator, evaluate_parallel
+    from dsl.runner.mysql import MysqlDSL
+    from dsl.ruleset import RuleSet
+
+    string = """
+    if
+    @fac.sql_type == "delete"
+    then
+    @act.reject_execute no delete
+    else
+    @act.allow_execute
+    end
+    """
+    rule = MysqlDSL.compile(string)
+    texts = ['select * from t1', 'delete from t2', 'update t3 set a = 1'] * 7
+    expected = list(rule.evaluate_many(texts))
+    with ParallelEvaluator(rule, workers=2, chunksize=4) as evaluator:
+        assert evaluator.evaluate_all(texts) == expected
+        stats = evaluator.stats()
+    assert stats['texts'] == len(texts)
+    assert sum(worker['texts'] for worker in stats['workers'].values()) == len(texts)
+
+    rule_set = RuleSet({'tree': MysqlDSL.compile(string, backend='tree')}, mode='all')
+    results = evaluate_parallel(rule_set, iter(texts), workers=3, executor='thread', chunksize=5)
+    assert results == [rule_set.evaluate(text) for text in texts]
+
+    # a sequence is pickled as a sequence, its names and metrics labels are kept
+    select = MysqlDSL.compile('if\n@fac.sql_type == "select"\nthen\n@act.allow_execute\nend')
+    for rule_set in (
+        RuleSet([rule, select], mode='all'),
+        RuleSet([rule, select], mode='priority', priorities={1: 10}),
+        RuleSet({'a': rule, 'b': select}, mode='priority', priorities={'b': 10}),
+    ):
+        loaded = pickle.loads(pickle.dumps(rule_set))
+        assert (loaded.labels, loaded.digest) == (rule_set.labels, rule_set.digest)
+        assert [name for name, _ in loaded.entries] == [name for name, _ in rule_set.entries]
+    assert evaluate_parallel(rule_set, texts[:3], workers=2) == [rule_set.evaluate(text) for text in texts[:3]]
+
+
+def test_statement_type():
+    from dsl.runner.mysql import MysqlText
+    from dsl.runner.sqlscan import statement_type
+
+    cases = {
+        'select * from table_name': 'select',
+        '  /* app */ -- note\n # note\n INSERT INTO t1 SELECT * FROM t2': 'insert',
+        '(SELECT 1) UNION (SELECT 2)': 'select',
+        'WITH c(n) AS (SELECT "update(") DELETE FROM t1': 'delete',
+        '/*!40101 SET NAMES utf8 */': 'set',
+        'replace into t1 values (1)': 'replace',
+        'Truncate table t1': 'truncate',
+        "'select'": None,
+        'hello select': None,
+        '': None,
+    }
+    for text, sql_type in cases.items():
+        assert statement_type(text) == sql_type, text
+    text = MysqlText('UPDATE t1 SET a = "select"', None)
+    assert text.sql_type == 'update' and text.__dict__['sql_type'] == 'update'
+
+
+def test_split_script():
+    import io
+
+    from dsl.runner.mysql import MysqlDSL
+    from dsl.runner.script import evaluate_script, split_statements
+
+    script = """-- header
+select 'a;b', "c\\";d" from t;  # trailing ; comment
+/* block ; */ insert into t values (1)
+;
+DELIMITER //
+CREATE PROCEDURE p() BEGIN delete from t; END//
+delimiter ;
+delete from t where `x;` = 1 -- end;
+"""
+    statements = list(split_statements(script))
+    assert [script[st.start:st.end] for st in statements] == [st.text for st in statements]
+    assert [st.line for st in statements] == [1, 2, 6, 8]
+    assert statements[2].text == 'CREATE PROCEDURE p() BEGIN delete from t; END'
+    # tokens split between chunks
+    for chunksize in (1, 2, 3, 7):
+        assert list(split_statements(io.BytesIO(script.encode()), chunksize=chunksize)) == statements
+
+    rule = MysqlDSL.compile("""
+    if
+    @fac.sql_type == "delete"
+    then
+    @act.reject_execute no delete
+    else
+    @act.allow_execute
+    end
+    """)
+    decisions = [
+        (statement.line, decision.end_msg)
+        for statement, decision in evaluate_script(rule, script.encode(), chunksize=16)
+    ]
+    assert decisions == [(1, (True, '')), (2, (True, '')), (6, (True, '')), (8, (False, 'no delete'))]
+
+
+def test_rule_bundle(tmp_path):
+    import hashlib
+
+    from dsl.bundle import _PREFIX, MAGIC, BundleError, RuleBundle, write_bundle
+    from dsl.runner.mysql import MysqlDSL
+
+    string = """
+    if
+    @fac.sql_type in ["select","update"] and (@fun.char_length < 1000 or @fac.is_admin_user)
+    then
+    @act.allow_execute
+    else
+    @act.reject_execute only select
+    end
+    """
+    rules = {
+        'closure': MysqlDSL.compile(string),
+        'tree': MysqlDSL.compile(string, backend='tree'),
+    }
+    path = tmp_path / 'rules.bundle'
+    write_bundle(path, rules)
+
+    bundle = RuleBundle.load(path)
+    assert list(bundle) == ['closure', 'tree'] and bundle.materialized == []
+    rule = bundle['closure']
+    assert bundle.materialized == ['closure']
+    assert rule.nodes == rules['closure'].nodes and rule.digest == rules['closure'].digest
+    for name, expected in rules.items():
+        for text in ('select * from t1', 'delete from t2'):
+            assert bundle[name].evaluate(text) == expected.evaluate(text)
+    assert bundle.entries['closure']['factors'] == [
+        '@act.allow_execute',
+        '@act.reject_execute',
+        '@fac.is_admin_user',
+        '@fac.sql_type',
+        '@fun.char_length',
+    ]
+    assert bundle.missing_factors('closure') == []
+
+    data = bytearray(path.read_bytes())
+    data[-3] ^= 1
+    damaged = RuleBundle(bytes(data))
+    with pytest.raises(BundleError):
+        damaged['tree']
+
+    # a header with a valid checksum but missing fields
+    for header in (b'{"version": 1}', b'{"version": 1, "rules": [{"name": "x"}]}', b'[]'):
+        data = MAGIC + _PREFIX.pack(len(header), hashlib.sha256(header).digest()) + header
+        with pytest.raises(BundleError):
+            RuleBundle(data)
+
+    mail = MysqlDSL.compile('if\n@fac.sql_type == "drop"\nthen\n@act.reject_execute mail @admin\nend')
+    write_bundle(path, {'mail': mail})
+    bundle = RuleBundle.load(path)
+    assert bundle.entries['mail']['factors'] == ['@act.reject_execute', '@fac.sql_type']
+    assert bundle.missing_factors('mail') == []
+
+
+def test_registry():
+    from dsl.exceptions import DSLError
+    from dsl.registry import registry
+    from dsl.runner.mysql import MysqlDSL
+    from dsl.utils import DSL_MAP, collect_register_fat, fac
+
+    assert registry.get('mysql') is MysqlDSL and DSL_MAP['mysql'] is MysqlDSL
+    factors = registry.factors(MysqlDSL)
+    assert registry.factors(MysqlDSL) is factors
+    assert '@fac.sql_type' in [factor['name'] for factor in factors]
+
+    class AuditDSL(MysqlDSL):
+        pass
+
+    class Mysql8DSL(AuditDSL):
+        type_ = 'mysql8'
+
+        @fac(title='版本')
+        def version(self) -> str:
+            return '8.0'
+
+        def sql_type(self) -> str:
+            return 'select'
+
+    try:
+        # registered at any depth, subclasses without their own type_ are not
+        assert registry.get('mysql') is MysqlDSL and registry.get('mysql8') is Mysql8DSL
+        names = [factor['name'] for factor in registry.factors(Mysql8DSL)]
+        assert '@fac.version' in names and '@fac.sql_type' not in names
+        collected = collect_register_fat([])
+        assert {factor['type'] for factor in collected if factor['name'] == '@fac.version'} == {'fac'}
+        assert len(collected) == len(registry.collect())
+    finally:
+        registry.unregister('mysql8')
+
+    assert registry.get('redis').type_ == 'redis'
+    with pytest.raises(DSLError):
+        registry.get('oracle')
+
+
+def test_dispatch_table():
+    from dsl.exceptions import GrammarError
+    from dsl.registry import registry
+    from dsl.runner.mysql import MysqlDSL
+
+    table = registry.dispatch(MysqlDSL)
+    assert registry.dispatch(MysqlDSL) is table
+    assert table.functions['sql_type'] is table.resolve('sql_type')
+    assert table.resolve('no_such_factor') is None
+
+    for string in (
+        'if\n@fac.no_such_factor == 1\nthen\n@act.allow_execute\nend',
+        'if\n@fac.sql_type == "select"\nthen\n@act.no_such_action\nend',
+    ):
+        with pytest.raises(GrammarError):
+            MysqlDSL.compile(string)
+
+    md = MysqlDSL(
+        'if\n@fun.is_char_lower("abc") and @fac.sql_type == "select"\nthen\n@act.reject_execute lower\nend',
+        'select 1',
+    )
+    md.match_tree()
+    assert md.end_msg == (False, 'lower')
+    assert table.funs['@fun.is_char_lower("abc")'] == ('is_char_lower', [(False, 'abc')])
+    assert table.acts['@act.reject_execute lower'] == ('reject_execute', 'lower')
+
+
+def test_bench():
+    from dsl import bench
+
+    report = bench.run(iterations=5, alloc_iterations=2, corpus_size=20, name_filter='[small]')
+    names = [item['name'] for item in report['results']]
+    assert names == [
+        'parse_grammar[small]',
+        'parse_expression[small]',
+        'compile[small]',
+        'tree_match[small]',
+        'closure_evaluate[small]',
+    ]
+    for item in report['results']:
+        assert item['ops_per_sec'] > 0
+        assert item['p50_us'] <= item['p99_us'] <= item['max_us']
+    assert 'vs base' in bench.format_table(report, report)
+
+
+def test_metrics():
+    from dsl.metrics import Metrics, metrics
+    from dsl.ruleset import RuleSet
+    from dsl.runner.mysql import MysqlDSL
+
+    grammar = '''
+    if
+    @fac.sql_type == "select" and @fun.char_length < 1000
+    then
+    @act.allow_execute
+    else
+    @act.reject_execute "no"
+    end
+    '''
+    rule_set = RuleSet({'only_select': MysqlDSL.compile(grammar)})
+    metrics.reset()
+    rule_set.evaluate('select 1')
+    assert metrics.snapshot()['rules'] == {}
+    metrics.enabled = True
+    try:
+        rule_set.evaluate('select 1')
+        rule_set.evaluate('delete from t')
+        MysqlDSL(grammar, 'select 2').match_tree()
+        snapshot = metrics.snapshot()
+    finally:
+        metrics.enabled = False
+        metrics.reset()
+    rule = snapshot['rules']['mysql:only_select']
+    assert rule['evaluations'] == 2
+    assert rule['branches'] == {0: 1, 1: 1}
+    assert rule['latency']['buckets'][-1] == [float('inf'), 2]
+    sql_type = snapshot['factors']['mysql:sql_type']
+    assert sql_type['calls'] == 3 and sql_type['errors'] == 0
+    assert snapshot['factors']['mysql:char_length']['calls'] == 2
+
+    local = Metrics(enabled=True, buckets=[0.1, 0.01])
+    local.observe_rule('mysql', 'r"1', None, 0.05)
+    text = local.prometheus()
+    assert 'rule_dsl_rule_evaluation_seconds_bucket{type="mysql",rule="r\\"1",le="0.01"} 0' in text
+    assert 'rule_dsl_rule_evaluation_seconds_bucket{type="mysql",rule="r\\"1",le="0.1"} 1' in text
+    assert 'rule_dsl_rule_branch_total{type="mysql",rule="r\\"1",branch="none"} 1' in text
+
+
+def test_explain():
+    from dsl.context import EvaluationContext
+    from dsl.ruleset import RuleSet
+    from dsl.runner.mysql import MysqlDSL
+    from dsl.trace import Trace, tracer
+
+    grammar = '''
+    if
+    @fac.sql_type == "select" and (@fun.char_length < 1000 or @fac.is_admin_user == true)
+    then
+    @act.allow_execute
+    else
+    @act.reject_execute only select
+    end
+    '''
+    rule = MysqlDSL.compile(grammar)
+    trace = rule.explain('delete from t1')
+    assert trace.result == (False, (False, 'only select'))
+    assert trace.facts() == {'@fac.sql_type': 'delete'}
+    [step] = trace.steps
+    assert (step.kind, step.value) == ('rule', 1)
+    assert [(child.kind, child.value) for child in step.children] == [
+        ('branch', False),
+        ('branch', True),
+        ('act', False),
+    ]
+    assert 'fact     @fac.sql_type => \'delete\'' in trace.format()
+    assert rule.evaluate('delete from t1') == trace.result
+
+    tree = MysqlDSL.compile(grammar, backend='tree').explain('select 1')
+    assert tree.steps[0].value == 0
+    assert tree.facts()['@fac.sql_type'] == 'select'
+
+    matches = RuleSet({'only_select': rule}).explain('select 1')
+    assert matches.steps[0].source == 'only_select'
+    assert matches.result[0].branch == 0
+
+    trace = Trace()
+    MysqlDSL(grammar, 'select 2', context=EvaluationContext(trace=trace)).match_tree()
+    assert [step.kind for step in trace.steps] == ['branch', 'call']
+
+    tracer.rate = 1.0
+    try:
+        rule.evaluate('select 3')
+    finally:
+        tracer.rate = 0.0
+    assert tracer.traces.pop().result == (True, (True, ''))
+
+
+def test_injected_facts():
+    from dsl.context import EvaluationContext
+    from dsl.ruleset import RuleSet
+    from dsl.runner.mysql import MysqlDSL
+
+    grammar = '''
+    if
+    @fac.sql_type == "select" and @fun.char_length < 1000
+    then
+    @act.allow_execute
+    elseif
+    @fac.sql_type in ["update", "delete"]
+    then
+    @act.reject_execute no write
+    else
+    @act.allow_execute
+    end
+    '''
+    calls = []
+
+    def sql_type():
+        calls.append('sql_type')
+        return 'delete'
+
+    for backend in ('closure', 'tree'):
+        rule = MysqlDSL.compile(grammar, backend=backend)
+        assert rule.evaluate('delete from t1', facts={'sql_type': 'select'}).result is True
+        assert rule.evaluate('select 1', facts={'@fac.sql_type': sql_type}).result is False
+        assert rule.evaluate('select 1', facts={'char_length': 5000}).result is True
+        assert rule.evaluate('select 1').end_msg == (True, '')
+    assert calls == ['sql_type', 'sql_type']
+
+    context = EvaluationContext(injected={'sql_type': 'update'})
+    assert MysqlDSL(grammar, 'select 1', context=context).match_tree() is False
+    matches = RuleSet([MysqlDSL.compile(grammar)]).evaluate('select 1', facts={'sql_type': 'drop'})
+    assert matches[0].branch == 2
+
+
+def test_decision_cache():
+    from dsl import common
+    from dsl.cache import DecisionCache, factor_dependencies
+    from dsl.ruleset import RuleSet
+    from dsl.runner.mysql import MysqlDSL
+    from dsl.utils import fac
+
+    grammar = '''
+    if
+    @fac.sql_type == "select" or @fac.is_admin_user == true
+    then
+    @act.allow_execute
+    else
+    @act.reject_execute only select
+    end
+    '''
+    rule = MysqlDSL.compile(grammar)
+    assert factor_dependencies(rule) == {
+        '@act.allow_execute': 'none',
+        '@act.reject_execute': 'none',
+        '@fac.is_admin_user': 'user',
+        '@fac.sql_type': 'fingerprint',
+    }
+    now = [0.0]
+    cache = DecisionCache(maxsize=2, ttl=10, clock=lambda: now[0])
+    admin, guest = common.User('admin'), common.User('guest')
+    assert cache.evaluate(rule, 'delete from t1', guest).result is False
+    assert cache.evaluate(rule, 'delete from t1', admin).result is True
+    assert cache.evaluate(rule, 'delete from t1', guest) == (False, (False, 'only select'))
+    assert (cache.hits, cache.misses) == (1, 2)
+    now[0] = 11
+    cache.evaluate(rule, 'delete from t1', guest)
+    assert cache.stats()['expirations'] == 1
+    cache.evaluate(rule, 'select 1', guest)
+    assert len(cache) == 2 and cache.evictions == 1
+
+    rule_set = RuleSet({'only_select': rule})
+    assert cache.evaluate(rule_set, 'select 1')[0].name == 'only_select'
+    assert cache.evaluate(rule_set, 'select 1')[0].branch == 0
+    assert cache.invalidate(rule_set) == 1
+
+    length_rule = MysqlDSL.compile(grammar.replace('@fac.is_admin_user == true', '@fun.char_length < 10'))
+    normalized = DecisionCache(fingerprint=lambda text: text.split()[0].lower())
+    assert normalized.unsafe(length_rule) == ['@fun.char_length']
+    assert normalized.cacheable(rule)
+    normalized.evaluate(length_rule, 'select 1')
+    assert normalized.stats()['bypassed'] == 1 and len(normalized) == 0
+
+    AuditDSL = make_dsl('AuditDSL', audited=(fac, True))
+    audit_rule = AuditDSL.compile(grammar.replace('@fac.is_admin_user', '@fac.audited'))
+    assert cache.unsafe(audit_rule) == ['@fac.audited']
+
+
+def test_fingerprint():
+    from dsl.cache import DecisionCache
+    from dsl.runner.fingerprint import fingerprint, fingerprint_hash
+    from dsl.runner.mysql import MysqlDSL
+    from dsl.runner.pg import PgDSL
+
+    assert fingerprint(
+        "SELECT * FROM t WHERE id IN (1, 2, 3) /* app */ AND name='it''s' -- x\n LIMIT 10;"
+    ) == 'select * from t where id in(?+) and name = ? limit ?'
+    assert fingerprint('select  a,b from t1 where c = "x\\"y" # c') == 'select a, b from t1 where c = ?'
+    assert fingerprint("insert into t (a, b) values (0x1F, -1.5e+3)") == 'insert into t(a, b) values(?, - ?)'
+    assert fingerprint('select 1abc, t1.c2, count(*) from `T` where a in (select b from u)') == (
+        'select 1abc, t1.c2, count(*) from `T` where a in(select b from u)'
+    )
+    assert fingerprint("select 'unterminated") == 'select ?'
+    assert fingerprint(
+        """SELECT x FROM t WHERE d = E'a\\'b' AND e = $1 AND f = $tag$a'b$tag$ AND g = "Col" """,
+        'postgres',
+    ) == 'select x from t where d = ? and e = ? and f = ? and g = "Col"'
+    with pytest.raises(ValueError):
+        fingerprint('select 1', 'oracle')
+    assert fingerprint_hash('select 1') == fingerprint_hash('SELECT 2 ;')
+    assert len(fingerprint_hash('select 1')) == 16
+
+    grammar = '''
+    if
+    @fac.fingerprint == "select * from t where id = ?"
+    then
+    @act.allow_execute
+    else
+    @act.reject_execute
+    end
+    '''
+    assert MysqlDSL(grammar, 'SELECT * FROM t WHERE id = 42').match_tree() is True
+    assert PgDSL.compile(grammar).evaluate('select * from t where id = $1').result is True
+
+    rule = MysqlDSL.compile(grammar)
+    decisions = DecisionCache(fingerprint=fingerprint_hash)
+    assert decisions.cacheable(rule)
+    decisions.evaluate(rule, 'select * from t where id = 1')
+    assert decisions.evaluate(rule, 'select * from t where id = 2').result is True
+    assert decisions.hits == 1
+
+
+def test_resp_pipeline():
+    from dsl import common
+    from dsl.exceptions import DSLError
+    from dsl.runner.redis import RedisDSL
+    from dsl.runner.resp import RespError, RespParser, evaluate_pipeline, parse_commands
+
+    def resp(*args):
+        data = b'*%d\r\n' % len(args)
+        for arg in args:
+            data += b'$%d\r\n%s\r\n' % (len(arg), arg.encode())
+        return data
+
+    data = (
+        resp('SET', 'k', 'v' * 100)
+        + resp('MSET', 'a', '1', 'b', '2')
+        + b'PING\r\n'
+        + resp('BLPOP', 'q1', 'q2', '0')
+        + resp('EVAL', 'return 1', '1', 'k1', 'x')
+        + resp('XREAD', 'BLOCK', '0', 'STREAMS', 's1', '0')
+        + resp('KEYS', '*')
+    )
+    commands = parse_commands(data)
+    assert [command.name for command in commands] == ['set', 'mset', 'ping', 'blpop', 'eval', 'xread', 'keys']
+    set_, mset, ping, blpop, eval_, xread, keys = commands
+    assert isinstance(set_.args[1], memoryview) and set_.arg_sizes == (1, 100)
+    assert [bytes(key) for key in mset.keys] == [b'a', b'b']
+    assert ping.key_count == 0 and str(ping) == 'PING'
+    assert blpop.key_count == 2 and blpop.is_blocking
+    assert [bytes(key) for key in eval_.keys] == [b'k1']
+    assert [bytes(key) for key in xread.keys] == [b's1'] and xread.is_blocking
+    assert keys.is_keyspace_scan and not set_.is_blocking
+    assert (set_.start, keys.end) == (0, len(data))
+
+    parser = RespParser()
+    fed = []
+    for pos in range(0, len(data), 5):
+        fed.extend(parser.feed(data[pos : pos + 5]))
+    parser.close()
+    assert [(c.name, c.start, c.end) for c in fed] == [(c.name, c.start, c.end) for c in commands]
+    with pytest.raises(RespError):
+        parse_commands(data[:-3])
+    with pytest.raises(RespError):
+        parse_commands(b'*1\r\n$x\r\nGET\r\n')
+
+    grammar = """if
+            @fac.is_keyspace_scan == true
+            then
+            @act.reject_execute keyspace
+            elseif
+            @fac.is_blocking == true or @fac.key_count > 1
+            then
+            @act.reject_execute blocking
+            else
+            @act.allow_execute
+            end"""
+    rule = RedisDSL.compile(grammar)
+    decisions = evaluate_pipeline(rule, data, common.User('u'))
+    assert [command for command, _ in decisions] == commands
+    assert [decision.result for _, decision in decisions] == [True, False, True, False, True, False, False]
+    assert rule.evaluate('FLUSHALL').end_msg == (False, 'keyspace')
+    assert rule.evaluate('GET k').result is True
+    # a text holds one command, the second one would not be checked
+    with pytest.raises(DSLError, match='evaluate_pipeline'):
+        rule.evaluate('GET a\r\nFLUSHALL\r\n')
+    with pytest.raises(DSLError, match='evaluate_pipeline'):
+        rule.evaluate(resp('GET', 'a') + resp('FLUSHALL'))
+
+    # a large bulk string received in small chunks
+    data = resp('SET', 'k', 'v' * (1 << 20)) + resp('GET', 'k')
+    parser = RespParser()
+    fed = []
+    for pos in range(0, len(data), 4096):
+        fed.extend(parser.feed(data[pos : pos + 4096]))
+    parser.close()
+    assert [(c.name, c.arg_sizes, c.end) for c in fed] == [
+        ('set', (1, 1 << 20), len(data) - len(resp('GET', 'k'))),
+        ('get', (1,), len(data)),
+    ]
+
+
+def test_rule_size_tracemalloc():
+    import gc
+    import tracemalloc
+
+    from dsl.bench import make_grammar
+    from dsl.cache import rule_size
+    from dsl.rule import CompiledRule
+    from dsl.runner.mysql import MysqlDSL
+    from dsl.utils import fac
+
+    grammars = [make_grammar(clauses=4, elseifs=3, in_size=8, regexes=1, seed=idx) for idx in range(20)]
+    # warm the process-wide caches (registry, regexes, literals)
+    warm = [CompiledRule(MysqlDSL, grammar) for grammar in grammars]
+    gc.collect()
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        rules = [CompiledRule(MysqlDSL, grammar) for grammar in grammars]
+        gc.collect()
+        measured = tracemalloc.get_traced_memory()[0] - base
+    finally:
+        tracemalloc.stop()
+    estimated = sum(rule_size(rule) for rule in rules)
+    assert 0.5 * measured < estimated < 2 * measured
+    assert len(warm) == len(rules)
+
+    # the factors of the dsl class are shared by its rules, not counted per rule
+    payload = 'x' * (1 << 20)
+    PayloadDSL = make_dsl('PayloadDSL', payload=(fac, lambda dsl: payload))
+    rule = PayloadDSL.compile('if\n@fac.payload == "x"\nthen\n@act.allow_execute\nend')
+    assert rule_size(rule) < len(payload) // 10
+
+
+def test_expression_max_depth():
+    from dsl import exceptions, expression
+
+    nested = '(' * expression.MAX_DEPTH + '@fac.sql_type == "select"' + ')' * expression.MAX_DEPTH
+    assert isinstance(expression.parse(nested), expression.Compare)
+    with pytest.raises(exceptions.GrammarError):
+        expression.parse('(' * 1000 + '@fac.sql_type == "select"' + ')' * 1000)
+    call = '@fac.sql_type'
+    for _ in range(expression.MAX_DEPTH + 1):
+        call = f'@fun.is_char_lower({call})'
+    with pytest.raises(exceptions.GrammarError):
+        expression.parse(call)
+
+
+def test_guard_order():
+    from dsl.utils import fac, fun
+
+    GuardDSL = make_dsl(
+        'GuardDSL',
+        table=(fac(), ''),
+        first_char_upper=(fun(), lambda dsl, value: value[0].isupper()),
+    )
+
+    string = """
+    if
+    @fac.table != "" and @fun.first_char_upper(@fac.table)
+    then
+    @act.reject_execute
+    else
+    @act.allow_execute
+    end
+    """
+    # the guard written on the left is evaluated first
+    for backend in ('closure', 'tree'):
+        assert GuardDSL.compile(string, backend=backend).evaluate('select 1').result is True
+
+
+def test_evaluate_async_actions_once():
+    import asyncio
+
+    from dsl.ruleset import RuleSet
+    from dsl.runner.mysql import MysqlDSL
+    from dsl.utils import act, fac
+
+    actions = []
+
+    class AsyncActDSL(MysqlDSL):
+        @fac()
+        async def user_role(self) -> str:
+            await asyncio.sleep(0.01)
+            return 'dba'
+
+        @act()
+        def record(self, msg: str = None) -> bool:
+            actions.append(msg)
+            return True
+
+    rule_set = RuleSet(
+        [
+            AsyncActDSL.compile('if\n@fac.sql_type == "select"\nthen\n@act.record one\nend'),
+            AsyncActDSL.compile('if\n@fac.sql_type != "delete"\nthen\n@act.record other\nend'),
+            AsyncActDSL.compile('if\n@fac.user_role == "dba"\nthen\n@act.record two\nend'),
+        ],
+        mode='all',
+    )
+    matches = asyncio.run(rule_set.evaluate_async('select * from t1'))
+    assert [match.name for match in matches] == [0, 1, 2]
+    # the actions run before the async fact was resolved are not run again
+    assert actions == ['one', 'other', 'two']
+
+
+def test_split_executable_comments():
+    import io
+
+    from dsl.runner.mysql import MysqlDSL
+    from dsl.runner.script import evaluate_script, split_statements
+
+    script = """/*!40101 SET NAMES utf8 */;
+/* plain comment */;
+/*!50001 DROP VIEW IF EXISTS v*/;
+select /*+ MAX_EXECUTION_TIME(1000) */ * from t;
+"""
+    statements = list(split_statements(script))
+    assert [st.text for st in statements] == [
+        '/*!40101 SET NAMES utf8 */',
+        '/*!50001 DROP VIEW IF EXISTS v*/',
+        'select /*+ MAX_EXECUTION_TIME(1000) */ * from t',
+    ]
+    for chunksize in (1, 2, 3, 7):
+        assert list(split_statements(io.BytesIO(script.encode()), chunksize=chunksize)) == statements
+
+    rule = MysqlDSL.compile("""
+    if
+    @fac.sql_type == "drop"
+    then
+    @act.reject_execute no drop
+    else
+    @act.allow_execute
+    end
+    """)
+    decisions = [decision.result for _, decision in evaluate_script(rule, script)]
+    assert decisions == [True, False, True]
+
+
+def test_dispatch_table_bounded():
+    from dsl.registry import BoundedDict, registry
+
+    ManyGrammarsDSL = make_dsl('ManyGrammarsDSL')
+    table = registry.dispatch(ManyGrammarsDSL)
+    table.funs.maxsize = table.acts.maxsize = table.runners.maxsize = 8
+    for idx in range(50):
+        md = ManyGrammarsDSL(
+            f'if\n@fun.is_char_lower("a{idx}")\nthen\n@act.reject_execute lower {idx}\nend',
+            'select 1',
+        )
+        md.match_tree()
+        assert md.end_msg == (False, f'lower {idx}')
+    assert len(table.funs) <= 8 and len(table.acts) <= 8 and len(table.runners) <= 8
+    assert '@fun.is_char_lower("a49")' in table.funs
+
+    cache = BoundedDict(2)
+    cache['a'] = cache['b'] = 1
+    cache['b'] = 2
+    cache['c'] = 3
+    assert list(cache.items()) == [('b', 2), ('c', 3)]
+
+
+def test_metrics_rule_labels():
+    from dsl.metrics import Metrics, metrics
+    from dsl.ruleset import RuleSet
+    from dsl.runner.mysql import MysqlDSL
+    from dsl.runner.redis import RedisDSL
+
+    allow = 'if\n@fac.sql_type == "select"\nthen\n@act.allow_execute\nend'
+    reject = 'if\n@fac.sql_type == "delete"\nthen\n@act.reject_execute no\nend'
+    first = RuleSet([MysqlDSL.compile(allow)])
+    second = RuleSet([MysqlDSL.compile(reject)])
+    named = {'rule': MysqlDSL.compile(allow)}
+    metrics.reset()
+    metrics.enabled = True
+    try:
+        first.evaluate('select 1')
+        second.evaluate('delete from t1')
+        second.evaluate('delete from t2')
+        RuleSet(named).evaluate('select 1')
+        RuleSet({'rule': RedisDSL.compile(allow.replace('sql_type == "select"', 'cmd_type == "get"'))}).evaluate('GET k')
+        snapshot = metrics.snapshot()
+    finally:
+        metrics.enabled = False
+        metrics.reset()
+    rules = snapshot['rules']
+    # rule 0 of each rule set has its own counter
+    assert rules[f'mysql:{first.digest[:12]}[0]']['evaluations'] == 1
+    assert rules[f'mysql:{second.digest[:12]}[0]']['evaluations'] == 2
+    # the same label of two engine types too
+    assert rules['mysql:rule']['type'] == 'mysql' and rules['redis:rule']['type'] == 'redis'
+    assert rules['mysql:rule']['evaluations'] == rules['redis:rule']['evaluations'] == 1
+
+    local = Metrics(enabled=True)
+    local.observe_rule('mysql', 'rule', 0, 0.001)
+    local.observe_rule('redis', 'rule', None, 0.001)
+    text = local.prometheus()
+    assert 'rule_dsl_rule_branch_total{type="mysql",rule="rule",branch="0"} 1' in text
+    assert 'rule_dsl_rule_branch_total{type="redis",rule="rule",branch="none"} 1' in text
+
+
+def test_fingerprint_executable_comments():
+    from dsl.cache import DecisionCache
+    from dsl.runner.fingerprint import fingerprint, fingerprint_hash
+    from dsl.runner.mysql import MysqlDSL
+
+    assert fingerprint('/*!40101 SET NAMES utf8 */') == '/*! set names utf8 */'
+    assert fingerprint('/*!40101 DROP TABLE t */;') == '/*! drop table t */'
+    assert fingerprint('SELECT /*+ MAX_EXECUTION_TIME(1000) */ * FROM t') == (
+        'select /*+ max_execution_time(?) */ * from t'
+    )
+    assert fingerprint('/* plain */ select 1') == 'select ?'
+
+    rule = MysqlDSL.compile('''
+    if
+    @fac.sql_type == "drop"
+    then
+    @act.reject_execute no drop
+    else
+    @act.allow_execute
+    end
+    ''')
+    decisions = DecisionCache(fingerprint=fingerprint_hash)
+    assert decisions.evaluate(rule, '/*!40101 SET NAMES utf8 */').result is True
+    # the cached allow of the SET does not leak to the DROP
+    assert decisions.evaluate(rule, '/*!40101 DROP TABLE t */') == rule.evaluate('/*!40101 DROP TABLE t */')
+    assert decisions.evaluate(rule, '/*!40101 DROP TABLE t */').end_msg == (False, 'no drop')
+
+
+def test_split_delimiter_after_comments():
+    import io
+
+    from dsl.runner.script import split_statements
+
+    script = """-- change delimiter
+DELIMITER //
+CREATE PROCEDURE p() BEGIN SELECT 1; SELECT 2; END //
+/* restore */ DELIMITER ;
+SELECT 3;
+/*!50003 SET @a = 1 */;
+# triggers
+DELIMITER ;;
+CREATE TRIGGER t BEFORE INSERT ON x FOR EACH ROW BEGIN SET @b = 2; END ;;
+DELIMITER ;
+"""
+    statements = list(split_statements(script))
+    assert [st.text for st in statements] == [
+        'CREATE PROCEDURE p() BEGIN SELECT 1; SELECT 2; END',
+        'SELECT 3',
+        '/*!50003 SET @a = 1 */',
+        'CREATE TRIGGER t BEFORE INSERT ON x FOR EACH ROW BEGIN SET @b = 2; END',
+    ]
+    assert [st.line for st in statements] == [3, 5, 6, 9]
+    for chunksize in (1, 2, 3, 7, 16):
+        assert list(split_statements(io.BytesIO(script.encode()), chunksize=chunksize)) == statements
+
+
+def test_decision_cache_rule_versions():
+    from dsl.cache import DecisionCache
+    from dsl.utils import fac
+
+    OpenDSL = make_dsl('OpenDSL', audited=(fac(depends='none'), True))
+    ClosedDSL = make_dsl('ClosedDSL', audited=(fac(depends='none'), False))
+
+    grammar = '''
+    if
+    @fac.audited == true
+    then
+    @act.allow_execute
+    else
+    @act.reject_execute not audited
+    end
+    '''
+    open_rule, closed_rule = OpenDSL.compile(grammar), ClosedDSL.compile(grammar)
+    assert open_rule.type_ == closed_rule.type_ and open_rule.digest != closed_rule.digest
+    assert len({
+        open_rule.digest,
+        OpenDSL.compile(grammar, backend='tree').digest,
+        OpenDSL.compile(grammar, reorder=True).digest,
+        OpenDSL.compile(grammar, allow_no_params=True).digest,
+    }) == 4
+    assert OpenDSL.compile(grammar).digest == open_rule.digest
+
+    cache = DecisionCache(fingerprint=lambda text: text)
+    assert cache.evaluate(open_rule, 'select 1').result is True
+    assert cache.evaluate(closed_rule, 'select 1').result is False
+    assert len(cache) == 2
+
+
+def test_fact_cache_shared_by_backends():
+    from dsl.context import EvaluationContext
+    from dsl.ruleset import RuleSet
+    from dsl.utils import fac, fun
+
+    calls = []
+    CountingDSL = make_dsl('CountingDSL', calls, sql_type=fac, char_length=fun)
+
+    grammar = 'if\n@fac.sql_type == "delete" and @fun.char_length < 100\nthen\n@act.reject_execute no delete\nend'
+    rules = [CountingDSL.compile(grammar), CountingDSL.compile(grammar, backend='tree')]
+    context = EvaluationContext()
+    matches = RuleSet(rules, mode='all').evaluate('delete from t1', context=context)
+    assert [match.result for match in matches] == [False, False]
+    assert calls == ['sql_type', 'char_length']
+    assert set(context.facts) == {('sql_type',), ('char_length',)}
+
+
+def test_rule_set_index_guard():
+    from dsl.ruleset import RuleSet, rule_predicate
+    from dsl.utils import fac
+
+    calls = []
+    GuardDSL = make_dsl('GuardDSL', calls, table=(fac(), ''), kind=(fac(), 'x'))
+    guarded = GuardDSL.compile('if\n@fac.table != "" and @fac.kind == "x"\nthen\n@act.reject_execute kind\nend')
+    leading = GuardDSL.compile('if\n@fac.kind == "x" and @fac.table != ""\nthen\n@act.reject_execute kind\nend')
+    assert rule_predicate(guarded) is None
+    assert rule_predicate(leading)[1] == {'x'}
+    # the guard written first short-circuits, @fac.kind is not resolved by the index
+    assert RuleSet([guarded]).evaluate('select 1') == []
+    assert calls == ['table']
+
+
+def test_bench_compare_json(tmp_path, capsys):
+    import json
+
+    from dsl import bench
+
+    base = tmp_path / 'base.json'
+    options = ['--iterations', '5', '--alloc-iterations', '2', '--corpus-size', '20', '--filter', 'parse_grammar[small]']
+    assert bench.main(options + ['--json', str(base)]) == 0
+    capsys.readouterr()
+    # the comparison is kept when the json goes to stdout
+    assert bench.main(options + ['--json', '-', '--compare', str(base)]) == 0
+    report = json.loads(capsys.readouterr().out)
+    assert list(report['comparison']) == ['parse_grammar[small]']
+
+
 # pytest dsl/tests.py -o log_cli=true
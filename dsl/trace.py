@@ -0,0 +1,205 @@
+"""
+Evaluation traces: the conditions evaluated, the factor values and the branch
+taken, recorded in a tree of steps.
+
+```
+trace = rule.explain('delete from t1', user)
+trace.result            # Decision, list of RuleMatch for a RuleSet
+print(trace.format())
+rule     3f2a9c01d4e5 => 1
+  branch   @fac.sql_type == "select" => False
+    compare  @fac.sql_type == "select" => False
+      fact     @fac.sql_type => 'delete'
+  branch   else => True
+  act      @act.reject_execute only select => False
+```
+
+A fraction of the evaluations can be traced too, the traces are handed to
+tracer.sink, kept in tracer.traces by default:
+
+```
+from dsl.trace import tracer
+
+tracer.rate = 0.001
+```
+
+Nothing is recorded while context.trace is None: the compiled rules build a
+second, traced program the first time they are traced, the default program
+has no tracing and no logging calls.
+"""
+import collections
+import random
+import typing
+
+__all__ = ('Step', 'Trace', 'Tracer', 'tracer', 'run_traced', 'run_sampled')
+
+
+class Step:
+    """
+    kind: rule, branch, and, or, compare, fact, act, call (a runner of the tree backend)
+    source: rule label, condition, factor reference
+    value: result of the step, None when it raised
+    error: repr of the exception raised by the step
+    """
+
+    __slots__ = ('kind', 'source', 'value', 'error', 'children')
+
+    def __init__(self, kind: str, source: typing.Any):
+        self.kind = kind
+        self.source = source
+        self.value = None
+        self.error = None
+        self.children = []
+
+    def __repr__(self):
+        return f'<{type(self).__name__} {self.kind} {self.source!r} => {self.value!r}>'
+
+    def to_dict(self) -> dict:
+        data = {'kind': self.kind, 'source': self.source, 'value': self.value}
+        if self.error is not None:
+            data['error'] = self.error
+        if self.children:
+            data['children'] = [child.to_dict() for child in self.children]
+        return data
+
+
+class Trace:
+    """
+    Args:
+        text (str): text being evaluated
+    """
+
+    def __init__(self, text: typing.Optional[str] = None):
+        self.text = text
+        self.steps = []
+        # Decision, or list of RuleMatch for a RuleSet
+        self.result = None
+        self._stack = []
+
+    def __repr__(self):
+        return f'<{type(self).__name__} steps={len(self.steps)} result={self.result!r}>'
+
+    def enter(self, kind: str, source: typing.Any) -> Step:
+        """start a step, the steps entered before exit() are its children"""
+        step = Step(kind, source)
+        (self._stack[-1].children if self._stack else self.steps).append(step)
+        self._stack.append(step)
+        return step
+
+    def exit(self, step: Step, value: typing.Any) -> None:
+        step.value = value
+        self._pop(step)
+
+    def fail(self, step: Step, error: BaseException) -> None:
+        step.error = repr(error)
+        self._pop(step)
+
+    def add(self, kind: str, source: typing.Any, value: typing.Any) -> Step:
+        step = self.enter(kind, source)
+        self.exit(step, value)
+        return step
+
+    def _pop(self, step: Step) -> None:
+        while self._stack:
+            if self._stack.pop() is step:
+                break
+
+    def walk(self) -> typing.Iterator[Step]:
+        """all the steps, depth first"""
+        stack = list(reversed(self.steps))
+        while stack:
+            step = stack.pop()
+            yield step
+            stack.extend(reversed(step.children))
+
+    def facts(self) -> typing.Dict[str, typing.Any]:
+        """{'@fac.sql_type': 'delete'}, factor values seen by the evaluation"""
+        return {
+            step.source: step.value
+            for step in self.walk()
+            if step.kind in ('fact', 'call') and step.error is None
+        }
+
+    def to_dict(self) -> dict:
+        return {'text': self.text, 'steps': [step.to_dict() for step in self.steps]}
+
+    def format(self, width: int = 80) -> str:
+        """one indented line per step, values longer than width are cut"""
+        lines = []
+
+        def add(step: Step, depth: int) -> None:
+            value = f'!{step.error}' if step.error is not None else repr(step.value)
+            if len(value) > width:
+                value = value[: width - 3] + '...'
+            lines.append(f'{"  " * depth}{step.kind:<8} {step.source} => {value}')
+            for child in step.children:
+                add(child, depth + 1)
+
+        for step in self.steps:
+            add(step, 0)
+        return '\n'.join(lines)
+
+
+class Tracer:
+    """
+    Traces a fraction of the CompiledRule / RuleSet evaluate() calls.
+
+    Args:
+        rate (float): fraction of the evaluations traced, 0 disables sampling
+        sink (Callable[[Trace], None]): receives the traces, by default they
+            are kept in traces
+        maxlen (int): traces kept without a sink
+    """
+
+    def __init__(
+        self,
+        rate: float = 0.0,
+        sink: typing.Optional[typing.Callable[[Trace], None]] = None,
+        maxlen: int = 100,
+    ):
+        self.rate = rate
+        self.sink = sink
+        self.traces = collections.deque(maxlen=maxlen)
+        self._random = random.random
+
+    def sample(self) -> bool:
+        return self._random() < self.rate
+
+    def emit(self, trace: Trace) -> None:
+        if self.sink is not None:
+            self.sink(trace)
+        else:
+            self.traces.append(trace)
+
+
+tracer = Tracer()
+
+
+def run_traced(run: typing.Callable, dsl, trace: typing.Optional[Trace] = None) -> Trace:
+    """
+    run(dsl) recorded in trace, trace.result is what run returned
+
+    Args:
+        run (Callable): evaluates dsl, e.g. lambda dsl: rule.run(dsl)[1]
+        dsl (BaseDSL): dsl instance bound to the text
+    """
+    if trace is None:
+        trace = Trace(dsl.text_str)
+    context = dsl.context
+    previous = context.trace
+    context.trace = trace
+    try:
+        trace.result = run(dsl)
+    finally:
+        context.trace = previous
+    return trace
+
+
+def run_sampled(run: typing.Callable, dsl) -> typing.Any:
+    """run(dsl) traced, the trace is handed to tracer.emit even when run raises"""
+    trace = Trace(dsl.text_str)
+    try:
+        run_traced(run, dsl, trace)
+    finally:
+        tracer.emit(trace)
+    return trace.result
@@ -2,7 +2,24 @@ import functools
 import inspect
 import typing
 
-from .dsl import BaseCommonDSL, BaseDSL
+from .registry import registry
+
+
+def _wrap(func):
+    """keep async def factors awaitable"""
+    if inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def wrap(*args, **kwargs):
+            return await func(*args, **kwargs)
+
+    else:
+
+        @functools.wraps(func)
+        def wrap(*args, **kwargs):
+            return func(*args, **kwargs)
+
+    return wrap
 
 
 def fac(
@@ -25,12 +42,7 @@ def fac(
             'rtype': rtype,
             **kwargs,
         }
-
-        @functools.wraps(func)
-        def wrap(*args, **kwargs):
-            return func(*args, **kwargs)
-
-        return wrap
+        return _wrap(func)
 
     def decorator_function(func):
         func_name = func.__name__
@@ -43,12 +55,7 @@ def fac(
             'rtype': rtype,
             **kwargs,
         }
-
-        @functools.wraps(func)
-        def wrap(*args, **kwargs):
-            return func(*args, **kwargs)
-
-        return wrap
+        return _wrap(func)
 
     return decorator_function
 
@@ -73,12 +80,7 @@ def fun(
             'rtype': rtype,
             **kwargs,
         }
-
-        @functools.wraps(func)
-        def wrap(*args, **kwargs):
-            return func(*args, **kwargs)
-
-        return wrap
+        return _wrap(func)
 
     def decorator_function(func):
         func_name = func.__name__
@@ -91,12 +93,7 @@ def fun(
             'rtype': rtype,
             **kwargs,
         }
-
-        @functools.wraps(func)
-        def wrap(*args, **kwargs):
-            return func(*args, **kwargs)
-
-        return wrap
+        return _wrap(func)
 
     return decorator_function
 
@@ -121,12 +118,7 @@ def act(
             'rtype': rtype,
             **kwargs,
         }
-
-        @functools.wraps(func)
-        def wrap(*args, **kwargs):
-            return func(*args, **kwargs)
-
-        return wrap
+        return _wrap(func)
 
     def decorator_function(func):
         func_name = func.__name__
@@ -139,17 +131,13 @@ def act(
             'rtype': rtype,
             **kwargs,
         }
-
-        @functools.wraps(func)
-        def wrap(*args, **kwargs):
-            return func(*args, **kwargs)
-
-        return wrap
+        return _wrap(func)
 
     return decorator_function
 
 
-DSL_MAP = {}
+# {type_: dsl class}, filled by the registry when a dsl class is created
+DSL_MAP = registry.classes
 
 
 def collect_register_fat(dsl_imports: list) -> list:
@@ -161,27 +149,6 @@ def collect_register_fat(dsl_imports: list) -> list:
     Returns:
         list: [{'name': '@fac.user_is_admin', 'title': 'user_is_admin', 'description': 'user_is_admin', 'func_type': 'fac', 'type': 'redis', 'enabled': True}]
     """
-
     for dsl_import in dsl_imports:
         __import__(dsl_import)
-    sub_classes = BaseCommonDSL.__subclasses__() + BaseDSL.__subclasses__()
-    all_register = []
-    for sub_class in sub_classes:
-        DSL_MAP[sub_class.type_] = sub_class
-        all_function_list = inspect.getmembers(sub_class, predicate=inspect.isfunction)
-        for function_tuple in all_function_list:
-            function = function_tuple[-1]
-            _dict = function.__dict__.get('_dict')
-            if _dict:
-                data = {
-                    'name': f'@{_dict["type"]}.{function.__name__}',
-                    'title': _dict['title'],
-                    'description': _dict['description'],
-                    'func_type': _dict['type'],
-                    'type': sub_class.type_,
-                    'enabled': _dict['enabled'],
-                    'ctype': _dict['ctype'],
-                    **_dict,
-                }
-                all_register.append(data)
-    return all_register
+    return registry.collect()